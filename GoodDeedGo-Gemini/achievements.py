@@ -0,0 +1,91 @@
+"""Achievement rules, evaluated in memory.
+
+Every rule is a threshold on one of a user's counters: total points,
+verified completions, or verified completions in one challenge category.
+Category counts live in UserCategoryStat and are updated in the same
+transaction as the point award, so checking every rule for a user takes
+two queries (earned titles, category counts) however many rules there are.
+
+New awards are added to the caller's session and committed with the
+submission; the unique (user_id, title) constraint on Achievement stops a
+concurrent worker from awarding the same badge twice. After adding a rule,
+award it to everyone who already qualifies with
+
+    flask --app main reevaluate-achievements
+"""
+from collections import namedtuple
+
+from app import db
+from models import User, Achievement, UserCategoryStat
+
+Rule = namedtuple('Rule', ['title', 'description', 'badge_icon', 'metric', 'threshold', 'category'])
+Rule.__new__.__defaults__ = (None,)
+
+POINTS = 'points'
+COMPLETIONS = 'completions'
+CATEGORY_COMPLETIONS = 'category_completions'
+
+RULES = [
+    Rule('First Steps', 'Completed your first challenge!', 'fas fa-baby', POINTS, 10),
+    Rule('Getting Started', 'Earned 50 points!', 'fas fa-star', POINTS, 50),
+    Rule('Century Club', 'Earned 100 points!', 'fas fa-trophy', POINTS, 100),
+    Rule('Recycling Hero', 'Completed 3 recycling challenges!', 'fas fa-recycle', CATEGORY_COMPLETIONS, 3, 'recycling'),
+]
+
+REEVALUATE_BATCH_SIZE = 1000
+
+
+def rule_value(rule, total_points, category_counts):
+    if rule.metric == POINTS:
+        return total_points or 0
+    if rule.metric == COMPLETIONS:
+        return sum(category_counts.values())
+    if rule.metric == CATEGORY_COMPLETIONS:
+        return category_counts.get(rule.category, 0)
+    raise ValueError(f"Unknown achievement metric '{rule.metric}'")
+
+
+def evaluate(total_points, category_counts, earned_titles, rules=None):
+    """Rules the user satisfies and has not been awarded yet"""
+    return [rule for rule in (RULES if rules is None else rules)
+            if rule.title not in earned_titles and rule_value(rule, total_points, category_counts) >= rule.threshold]
+
+
+def _achievement(user_id, rule):
+    return {'user_id': user_id, 'title': rule.title, 'description': rule.description, 'badge_icon': rule.badge_icon}
+
+
+def award(user):
+    """Add the achievements the user now qualifies for to the session; the caller commits"""
+    earned_titles = {title for (title,) in db.session.query(Achievement.title).filter(Achievement.user_id == user.id)}
+    category_counts = UserCategoryStat.counts_for([user.id])[user.id]
+    new_rules = evaluate(user.total_points, category_counts, earned_titles)
+    for rule in new_rules:
+        db.session.add(Achievement(**_achievement(user.id, rule)))
+    return new_rules
+
+
+def reevaluate_all(rules=None, batch_size=REEVALUATE_BATCH_SIZE):
+    """Award every rule to every user who qualifies, a batch of users per transaction; returns the awards made"""
+    awarded = 0
+    last_id = 0
+    while True:
+        users = db.session.query(User.id, User.total_points).filter(User.id > last_id) \
+            .order_by(User.id).limit(batch_size).all()
+        if not users:
+            return awarded
+        user_ids = [user_id for user_id, _ in users]
+        last_id = user_ids[-1]
+
+        earned = {user_id: set() for user_id in user_ids}
+        for user_id, title in db.session.query(Achievement.user_id, Achievement.title) \
+                .filter(Achievement.user_id.in_(user_ids)):
+            earned[user_id].add(title)
+        counts = UserCategoryStat.counts_for(user_ids)
+
+        rows = [_achievement(user_id, rule) for user_id, total_points in users
+                for rule in evaluate(total_points, counts[user_id], earned[user_id], rules)]
+        if rows:
+            db.session.execute(Achievement.__table__.insert(), rows)
+        db.session.commit()
+        awarded += len(rows)
@@ -0,0 +1,131 @@
+"""Deterministic benchmark databases.
+
+Builds a database of users, challenges and submissions from a fixed random
+seed, so every run (and every commit) measures against the same data.
+Rows are written with bulk Core inserts; geohashes, point totals, levels
+and completion counters are computed up front the way the app would have
+left them.
+
+    python benchmarks/seed.py 100k            # -> benchmarks/.data/bench-100k-v4.db
+"""
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SIZES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.data')
+SEED = 20240601
+DATA_VERSION = 4  # bump when the schema or the generated rows change, so stale databases are rebuilt
+
+CATEGORIES = ['recycling', 'community', 'environment', 'transport']
+CENTER = (40.7580, -73.9855)  # challenges cluster around Manhattan...
+SPREAD_DEGREES = 0.4  # ...within roughly +/- 45km
+CHUNK = 20_000
+
+
+def database_path(size):
+    return os.path.join(DATA_DIR, f"bench-{size}-v{DATA_VERSION}.db")
+
+
+def _chunks(rows):
+    for start in range(0, len(rows), CHUNK):
+        yield rows[start:start + CHUNK]
+
+
+def _level(points):
+    return 'Gold' if points >= 200 else 'Silver' if points >= 100 else 'Bronze'
+
+
+def seed(size):
+    """Create the database for a size label ('10k', '100k', '1m') unless it already exists"""
+    path = database_path(size)
+    if os.path.exists(path):
+        return path
+    os.makedirs(DATA_DIR, exist_ok=True)
+    building = path + '.building'
+    if os.path.exists(building):
+        os.remove(building)
+    os.environ['DATABASE_URL'] = f"sqlite:///{building}"
+
+    from app import app, db
+    from commands import init_db
+    from geo import geohash_encode
+    from models import User, Challenge, Submission, UserCategoryStat
+
+    rng = random.Random(SEED)
+    users = SIZES[size]
+    challenges = max(1000, users // 100)
+    now = datetime.utcnow()
+    started = time.perf_counter()
+
+    challenge_rows = []
+    for challenge_id in range(1, challenges + 1):
+        lat = CENTER[0] + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES)
+        lng = CENTER[1] + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES)
+        challenge_rows.append({
+            'id': challenge_id, 'title': f"Challenge {challenge_id}", 'description': 'Benchmark challenge',
+            'category': rng.choice(CATEGORIES), 'points': rng.choice([8, 10, 15, 20, 25]),
+            'latitude': lat, 'longitude': lng, 'geohash': geohash_encode(lat, lng), 'geofence_radius_km': 1.0,
+            'verification_prompt': 'Does this image show the challenge being completed?', 'is_active': True,
+            'verified_completions': 0, 'created_at': now,
+        })
+
+    points = [0] * (users + 1)
+    updated_at = [None] * (users + 1)
+    completed = set()
+    category_counts = {}
+    submission_rows = []
+    for submission_id in range(1, users + 1):
+        user_id = rng.randint(1, users)
+        challenge = challenge_rows[rng.randrange(challenges)]
+        submitted_at = now - timedelta(seconds=rng.randint(0, 30 * 24 * 3600))
+        status = rng.choices(['verified', 'rejected', 'pending'], weights=[6, 3, 1])[0]
+        if status == 'verified' and (user_id, challenge['id']) in completed:
+            status = 'rejected'
+        awarded = challenge['points'] if status == 'verified' else 0
+        if awarded:
+            completed.add((user_id, challenge['id']))
+            challenge['verified_completions'] += 1
+            points[user_id] += awarded
+            key = (user_id, challenge['category'])
+            category_counts[key] = category_counts.get(key, 0) + 1
+            updated_at[user_id] = max(updated_at[user_id] or submitted_at, submitted_at)
+        submission_rows.append({
+            'id': submission_id, 'user_id': user_id, 'challenge_id': challenge['id'],
+            'image_path': 'static/uploads/benchmark.jpg',
+            'user_location_lat': challenge['latitude'], 'user_location_lng': challenge['longitude'],
+            'status': status, 'ai_verification_result': None if status == 'pending' else status,
+            'points_awarded': awarded, 'submitted_at': submitted_at,
+            'verified_at': submitted_at if awarded else None,
+        })
+
+    user_rows = [{
+        'id': user_id, 'username': f"bench_{user_id}", 'email': f"bench_{user_id}@gooddeedgo.app",
+        'total_points': points[user_id], 'level': _level(points[user_id]),
+        'points_updated_at': updated_at[user_id], 'created_at': now,
+    } for user_id in range(1, users + 1)]
+    stat_rows = [{'user_id': user_id, 'category': category, 'verified_count': count}
+                 for (user_id, category), count in sorted(category_counts.items())]
+
+    with app.app_context():
+        init_db(seed=False)
+        for model, rows in ((User, user_rows), (Challenge, challenge_rows), (Submission, submission_rows),
+                            (UserCategoryStat, stat_rows)):
+            for chunk in _chunks(rows):
+                db.session.execute(model.__table__.insert(), chunk)
+        db.session.commit()
+        db.engine.dispose()
+
+    os.rename(building, path)
+    print(f"Seeded {size}: {users} users, {challenges} challenges, {users} submissions "
+          f"in {time.perf_counter() - started:.1f}s -> {path}", file=sys.stderr)
+    return path
+
+
+if __name__ == "__main__":
+    for size_label in sys.argv[1:] or ['10k']:
+        seed(size_label)
@@ -0,0 +1,296 @@
+"""Benchmark suite for the submission hot path.
+
+    python benchmarks/suite.py --sizes 10k,100k --output results.json
+    python benchmarks/suite.py --compare results.json     # exit 1 on regressions
+
+Groups:
+    imaging       ingest_upload vs. the same pipeline on a full-size decode, per photo size
+    submit        POST /challenge/<id> to 202, and end to end with a stubbed verifier
+    achievements  achievements.award for seeded users
+    rank          User.get_rank and /api/rank
+    leaderboard   /leaderboard and /api/leaderboard
+    nearby        /api/challenges/nearby
+
+The database groups run once per size against a fresh copy of a seeded
+database (see seed.py), each in its own interpreter. Results are JSON, keyed
+group -> benchmark, so two runs can be diffed with --compare. The Gemini
+client itself is load-tested with gemini_stub.py.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+
+from seed import SIZES, SEED, database_path  # noqa: E402
+
+LOCAL_GROUPS = ['imaging']
+DATABASE_GROUPS = ['submit', 'achievements', 'rank', 'leaderboard', 'nearby']
+
+PHOTO_SIZES = [(640, 480), (1280, 960), (2048, 1536), (4032, 3024)]
+STUB_VERIFICATION_RESULT = "Yes, this image shows the challenge being completed."
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'n': len(samples),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 3),
+        'p50_ms': round(statistics.median(samples) * 1000, 3),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 3),
+        'min_ms': round(samples[0] * 1000, 3),
+        'ops_per_s': round(len(samples) / sum(samples), 1),
+    }
+
+
+def timed(fn, iterations, warmup=3):
+    """Call fn(i) warmup + iterations times; summarize the timed calls"""
+    for i in range(warmup):
+        fn(i)
+    samples = []
+    for i in range(warmup, warmup + iterations):
+        started = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def sample_photo(width, height, quality=90):
+    """JPEG bytes of a smooth image with some noise, roughly phone-photo-like to compress"""
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(SEED)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 / width, y * 255 / height, (np.sin(x / 50) + np.cos(y / 40)) * 60 + 128], axis=-1)
+    pixels = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+    out = io.BytesIO()
+    Image.fromarray(pixels).save(out, 'JPEG', quality=quality)
+    return out.getvalue()
+
+
+def bench_imaging(iterations, scratch):
+    from PIL import Image
+    from imaging import JPEG_QUALITY, STORED_MAX_SIZE, content_hash, ingest_upload, perceptual_hash
+
+    results = {}
+    for width, height in PHOTO_SIZES:
+        photo = sample_photo(width, height)
+        dest = os.path.join(scratch, 'ingested.jpg')
+
+        def full_decode(i):
+            # ingest_upload's pipeline (hash, store, pHash) without the JPEG draft decode
+            stream = io.BytesIO(photo)
+            content_hash(stream)
+            with Image.open(stream) as img:
+                img.load()
+                if img.width > STORED_MAX_SIZE[0] or img.height > STORED_MAX_SIZE[1]:
+                    derivative = img.copy()
+                    derivative.thumbnail(STORED_MAX_SIZE, Image.Resampling.LANCZOS)
+                    derivative.save(dest, format='JPEG', optimize=True, quality=JPEG_QUALITY)
+                else:
+                    derivative = img
+                    with open(dest, 'wb') as out:
+                        out.write(photo)
+                perceptual_hash(derivative)
+
+        results[f"ingest_upload_{width}x{height}"] = timed(lambda i: ingest_upload(io.BytesIO(photo), dest), iterations)
+        results[f"full_decode_{width}x{height}"] = timed(full_decode, iterations)
+    return results
+
+
+def run_database_groups(size, groups, iterations, scratch):
+    """Runs inside a child interpreter whose DATABASE_URL points at a copy of the seeded database"""
+    from app import app, db
+    from models import User, Challenge
+    from ranking import rank_service
+    from leaderboard import leaderboard_service
+    import storage
+    import worker
+
+    storage.image_store = storage.LocalBackend(scratch)
+    client = app.test_client()
+    rng = random.Random(SEED)
+    users = SIZES[size]
+    results = {}
+
+    with app.app_context():
+        sample_users = [User.query.get(user_id) for user_id in rng.sample(range(1, users + 1), iterations + 3)]
+        challenges = db.session.query(Challenge.id, Challenge.latitude, Challenge.longitude) \
+            .order_by(Challenge.id).limit(2 * (iterations + 3)).all()
+
+    if 'submit' in groups:
+        photo = sample_photo(1280, 960)
+
+        def submit(i):
+            challenge_id, lat, lng = challenges[i]
+            response = client.post(f'/challenge/{challenge_id}', content_type='multipart/form-data', data={
+                'user_lat': str(lat), 'user_lng': str(lng),
+                # Bytes after the JPEG end marker keep every upload distinct, so none is served as a duplicate
+                'photo': (io.BytesIO(photo + i.to_bytes(4, 'big')), 'bench.jpg')})
+            assert response.status_code == 202, response.get_data(as_text=True)
+            return response.get_json()['submission_id']
+
+        def end_to_end(i):
+            submission_id = submit(iterations + 3 + i)
+            with app.app_context():
+                worker.finalize_submission(submission_id, verification_result=STUB_VERIFICATION_RESULT)
+
+        results['submit'] = {'request': timed(submit, iterations), 'end_to_end_stub_verifier': timed(end_to_end, iterations)}
+
+    if 'achievements' in groups:
+        import achievements
+
+        def check(i):
+            with app.app_context():
+                achievements.award(User.query.get(sample_users[i].id))
+                db.session.rollback()
+
+        results['achievements'] = {'check_achievements': timed(check, iterations)}
+
+    if 'rank' in groups:
+        with app.app_context():
+            started = time.perf_counter()
+            rank_service.refresh()
+            cold = round((time.perf_counter() - started) * 1000, 3)
+            results['rank'] = {
+                'cold_load_ms': cold,
+                'get_rank': timed(lambda i: sample_users[i].get_rank(), iterations),
+                'api_rank': timed(lambda i: client.get('/api/rank?window=5'), iterations),
+            }
+
+    if 'leaderboard' in groups:
+        with app.app_context():
+            started = time.perf_counter()
+            leaderboard_service.board_names()
+            cold = round((time.perf_counter() - started) * 1000, 3)
+        results['leaderboard'] = {
+            'cold_load_ms': cold,
+            'page': timed(lambda i: client.get('/leaderboard'), iterations),
+            'api_weekly': timed(lambda i: client.get('/api/leaderboard?board=weekly'), iterations),
+        }
+
+    if 'nearby' in groups:
+        from seed import CENTER, SPREAD_DEGREES
+        points = [(CENTER[0] + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES),
+                   CENTER[1] + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES)) for _ in range(iterations + 3)]
+        results['nearby'] = {
+            f"radius_{radius}km": timed(lambda i, radius=radius: client.get(
+                f'/api/challenges/nearby?lat={points[i][0]}&lng={points[i][1]}&radius_km={radius}'), iterations)
+            for radius in (2, 10, 50)
+        }
+
+    return results
+
+
+def run_size(size, groups, iterations):
+    """Seed (once), copy and benchmark one database size in a child interpreter"""
+    subprocess.run([sys.executable, os.path.join(BENCH_DIR, 'seed.py'), size], cwd=ROOT, check=True)
+    with tempfile.TemporaryDirectory() as scratch:
+        database = os.path.join(scratch, 'bench.db')
+        shutil.copyfile(database_path(size), database)
+        # One client submits every photo, as fast as it can: measure the path, not the rate limiter
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{database}", SUBMISSION_RATE_PER_MINUTE='0',
+                   ADMISSION_MAX_QUEUE_DEPTH='0', ADMISSION_MAX_QUEUE_SECONDS='0')
+        completed = subprocess.run([sys.executable, __file__, '--child', size, '--groups', ','.join(groups),
+                                    '--iterations', str(iterations)],
+                                   cwd=ROOT, env=env, capture_output=True, text=True)
+        if completed.returncode != 0:
+            sys.stderr.write(completed.stderr)
+            raise SystemExit(f"Benchmarks for {size} failed")
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(current, baseline, threshold, min_delta_ms):
+    """Print p50 changes against a baseline run; returns the regressed benchmark names"""
+    ours, theirs = flatten(current['results']), flatten(baseline['results'])
+    regressions = []
+    for key in sorted(ours):
+        if not (key.endswith('p50_ms') or key.endswith('cold_load_ms')) or not theirs.get(key):
+            continue
+        change = ours[key] / theirs[key] - 1
+        if abs(ours[key] - theirs[key]) < min_delta_ms:
+            change = 0.0  # too small to tell apart from timer noise
+        marker = 'REGRESSION' if change > threshold else 'faster' if change < -threshold else ''
+        print(f"{key:70} {theirs[key]:>10.3f} -> {ours[key]:>10.3f}  {change:+7.1%}  {marker}", file=sys.stderr)
+        if change > threshold:
+            regressions.append(key)
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10k', help=f"comma-separated database sizes: {', '.join(SIZES)}")
+    parser.add_argument('--groups', default=','.join(LOCAL_GROUPS + DATABASE_GROUPS))
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='baseline results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.15, help='p50 slowdown counted as a regression')
+    parser.add_argument('--min-delta-ms', type=float, default=0.05, help='ignore p50 changes smaller than this')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    groups = [group for group in args.groups.split(',') if group]
+
+    if args.child:
+        with tempfile.TemporaryDirectory() as scratch:
+            print(json.dumps(run_database_groups(args.child, groups, args.iterations, scratch)))
+        return
+
+    results = {}
+    with tempfile.TemporaryDirectory() as scratch:
+        if 'imaging' in groups:
+            results['imaging'] = bench_imaging(args.iterations, scratch)
+    database_groups = [group for group in groups if group in DATABASE_GROUPS]
+    if database_groups:
+        for size in args.sizes.split(','):
+            results[f"db_{size}"] = run_size(size, database_groups, args.iterations)
+
+    report = {
+        'meta': {'revision': git_revision(), 'python': platform.python_version(), 'machine': platform.machine(),
+                 'cpus': os.cpu_count(), 'iterations': args.iterations, 'sizes': args.sizes.split(',')},
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(output + "\n")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.threshold, args.min_delta_ms)
+        if regressions:
+            raise SystemExit(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""Application cache for read-mostly data.
+
+Every process keeps an LRU with per-entry TTL. CACHE_URL adds a shared tier
+behind it, so processes see each other's entries and invalidations:
+
+    CACHE_URL=redis://cache:6379/0          # needs the redis package
+    CACHE_URL=sqlite:///instance/cache.db   # stand-in shared by processes on one host
+
+Data that changes as a whole (the challenge catalogue) is cached under
+versioned keys: writers bump the namespace's version and readers simply stop
+finding entries built from the old one, which then age out. Without a shared
+tier a bump is only seen by the process that made it; others catch up
+within the entry TTL.
+
+init_app() also gives JSON GET responses an ETag and answers a matching
+If-None-Match with 304 Not Modified.
+"""
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+CACHE_URL = os.environ.get("CACHE_URL", "")
+CACHE_SIZE = int(os.environ.get("CACHE_SIZE", 1024))
+DEFAULT_TTL = float(os.environ.get("CACHE_TTL", 300))
+# How long a namespace version read from the shared tier is trusted before asking again
+VERSION_CHECK_INTERVAL = float(os.environ.get("CACHE_VERSION_CHECK_INTERVAL", 1.0))
+
+LOOKUPS = metrics.counter('gooddeedgo_app_cache_lookups_total', 'Application cache lookups by tier and result')
+
+
+class LocalBackend:
+    """LRU with per-entry expiry, private to one process"""
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+
+class SQLiteBackend:
+    """Pickled entries in a SQLite file, shared by every process on the host; each opens its own connection"""
+
+    PURGE_EVERY = 256  # writes between sweeps of expired rows
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._pid = None
+        self._inherited = []
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    @property
+    def _db(self):
+        # Opened in each process on first use: a SQLite connection must not cross a fork, and
+        # gunicorn forks its workers from a master that imported this module (preload_app)
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    if self._connection is not None:
+                        self._inherited.append(self._connection)  # the parent's; never used or closed here
+                    self._connection = self._connect()
+                    self._pid = os.getpid()
+        return self._connection
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS cache_entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)")
+        connection.execute("CREATE TABLE IF NOT EXISTS cache_counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        return connection
+
+    def get(self, key):
+        row = self._db.execute("SELECT value FROM cache_entries WHERE key = ? AND expires_at >= ?", (key, time.time())).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        self._db.execute("INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?)", (key, pickle.dumps(value), now + ttl))
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self._db.execute("DELETE FROM cache_entries WHERE expires_at < ?", (now,))
+
+    def delete(self, key):
+        self._db.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+
+    def counter(self, key):
+        row = self._db.execute("SELECT value FROM cache_counters WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def incr(self, key):
+        self._db.execute("INSERT INTO cache_counters VALUES (?, 1) ON CONFLICT(key) DO UPDATE SET value = value + 1", (key,))
+        return self.counter(key)
+
+
+class RedisBackend:
+    def __init__(self, url):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        raw = self._redis.get(key)
+        return pickle.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        self._redis.set(key, pickle.dumps(value), px=int(ttl * 1000))
+
+    def delete(self, key):
+        self._redis.delete(key)
+
+    def counter(self, key):
+        return int(self._redis.get(key) or 0)
+
+    def incr(self, key):
+        return self._redis.incr(key)
+
+
+def backend_from_url(url):
+    """Shared backend for CACHE_URL, or None for process-local caching only"""
+    if not url:
+        return None
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisBackend(url)
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):])
+    raise ValueError(f"Unsupported CACHE_URL '{url}'")
+
+
+class Cache:
+    def __init__(self, url=CACHE_URL, maxsize=CACHE_SIZE):
+        self.local = LocalBackend(maxsize)
+        self.shared = backend_from_url(url)
+        self._versions = {}  # namespace -> (checked_at, version), for the shared tier
+
+    def _shared(self, operation, *args, default=None):
+        # The shared tier is an optimisation: when it is down, behave as a miss
+        try:
+            return getattr(self.shared, operation)(*args)
+        except Exception as e:
+            logging.warning(f"Shared cache {operation} failed: {e}")
+            return default
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            LOOKUPS.inc(tier='local', result='hit')
+            return value
+        if self.shared is not None:
+            value = self._shared('get', key)
+            if value is not None:
+                LOOKUPS.inc(tier='shared', result='hit')
+                self.local.set(key, value, DEFAULT_TTL)
+                return value
+        LOOKUPS.inc(tier='all', result='miss')
+        return None
+
+    def set(self, key, value, ttl=DEFAULT_TTL):
+        self.local.set(key, value, ttl)
+        if self.shared is not None:
+            self._shared('set', key, value, ttl)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self._shared('delete', key)
+
+    def get_or_set(self, key, create, ttl=DEFAULT_TTL):
+        value = self.get(key)
+        if value is None:
+            value = create()
+            self.set(key, value, ttl)
+        return value
+
+    def version(self, namespace):
+        counter_key = f"{namespace}:version"
+        if self.shared is None:
+            return self.local.counter(counter_key)
+        checked = self._versions.get(namespace)
+        if checked is not None and time.monotonic() - checked[0] < VERSION_CHECK_INTERVAL:
+            return checked[1]
+        version = self._shared('counter', counter_key, default=checked[1] if checked else 0)
+        self._versions[namespace] = (time.monotonic(), version)
+        return version
+
+    def bump(self, namespace):
+        """Invalidate every versioned key in a namespace"""
+        counter_key = f"{namespace}:version"
+        self.local.incr(counter_key)
+        if self.shared is not None:
+            self._shared('incr', counter_key)
+            self._versions.pop(namespace, None)
+
+    def versioned_key(self, namespace, *parts):
+        return ':'.join([namespace, f"v{self.version(namespace)}", *map(str, parts)])
+
+
+app_cache = Cache()
+
+
+def init_app(app):
+    """ETags on JSON GET responses, with 304s for a matching If-None-Match"""
+    from flask import request
+
+    @app.after_request
+    def _conditional_json(response):
+        if request.method in ('GET', 'HEAD') and response.status_code == 200 \
+                and response.mimetype == 'application/json' and not response.direct_passthrough:
+            if response.get_etag()[0] is None:
+                response.add_etag()
+            response.make_conditional(request)
+        return response
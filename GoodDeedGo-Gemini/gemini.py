@@ -1,20 +1,142 @@
+import asyncio
+import base64
+import mimetypes
 import os
-import google.generativeai as genai
+import random
 
-# Configure API key
-genai.configure(api_key=os.environ.get("GEMINI_API_KEY", "default_key"))
+import aiohttp
 
-# Load Gemini model
-model = genai.GenerativeModel('gemini-pro')
+import metrics
 
-# Verification function
-def verify_challenge_completion(photo_path):
+# Configure API access; point GEMINI_API_BASE at gemini_stub.py for local load tests
+GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "default_key")
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com")
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
+
+# Client limits
+MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", 8))
+REQUEST_TIMEOUT = float(os.environ.get("GEMINI_TIMEOUT", 30))
+MAX_RETRIES = int(os.environ.get("GEMINI_MAX_RETRIES", 4))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+
+DEFAULT_PROMPT = "Does this image show someone doing a good environmental deed?"
+
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class GeminiError(Exception):
+    pass
+
+
+class GeminiClient:
+    """Asyncio client for the Gemini generateContent REST API.
+
+    One keep-alive connection pool is shared by every call, a semaphore caps
+    in-flight requests, and timeouts, connection errors and retryable HTTP
+    statuses are retried with jittered exponential backoff.
+    """
+
+    def __init__(self, api_key=GEMINI_API_KEY, base_url=GEMINI_API_BASE, model=GEMINI_MODEL,
+                 max_concurrency=MAX_CONCURRENCY, timeout=REQUEST_TIMEOUT, max_retries=MAX_RETRIES):
+        self.api_key = api_key
+        self.url = f"{base_url.rstrip('/')}/v1beta/models/{model}:generateContent"
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._session = None
+        self._semaphore = None
+        self.pending = 0  # calls waiting for a slot or in flight
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _get_session(self):
+        # Created lazily so the session and semaphore belong to the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), BACKOFF_MAX)
+            except ValueError:
+                pass
+        return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    async def generate(self, prompt, image_bytes, mime_type="image/jpeg"):
+        """Ask Gemini about one image and return the response text"""
+        session = self._get_session()
+        payload = {
+            "contents": [{
+                "parts": [
+                    {"text": prompt},
+                    {"inline_data": {"mime_type": mime_type, "data": base64.b64encode(image_bytes).decode("ascii")}}
+                ]
+            }]
+        }
+        headers = {"x-goog-api-key": self.api_key}
+
+        self.pending += 1
+        try:
+            return await self._post(session, payload, headers)
+        finally:
+            self.pending -= 1
+
+    async def _post(self, session, payload, headers):
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                async with self._semaphore:
+                    async with session.post(self.url, json=payload, headers=headers) as response:
+                        if response.status in RETRYABLE_STATUSES and attempt < self.max_retries:
+                            retry_after = response.headers.get("Retry-After")
+                        elif response.status >= 400:
+                            raise GeminiError(f"Gemini API returned {response.status}: {(await response.text())[:200]}")
+                        else:
+                            return _response_text(await response.json())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    raise GeminiError(f"Gemini API unreachable after {attempt + 1} attempts: {e!r}") from e
+
+            # Back off outside the semaphore so waiting retries don't hold a slot
+            await asyncio.sleep(self._backoff(attempt, retry_after))
+
+        raise GeminiError(f"Gemini API still failing after {self.max_retries + 1} attempts")
+
+
+def _response_text(data):
+    try:
+        parts = data["candidates"][0]["content"]["parts"]
+    except (KeyError, IndexError, TypeError):
+        raise GeminiError(f"Unexpected Gemini response: {str(data)[:200]}")
+    return "".join(part.get("text", "") for part in parts)
+
+
+def _read_image(photo_path):
     with open(photo_path, "rb") as img:
-        image_bytes = img.read()
+        return img.read()
+
+
+client = GeminiClient()
 
-    response = model.generate_content([
-        "Does this image show someone doing a good environmental deed?",
-        genai.types.Blob(part=image_bytes, mime_type="image/jpeg")
-    ])
+metrics.gauge('gooddeedgo_inference_queue_depth', 'Gemini calls waiting for a slot or in flight', callback=lambda: client.pending)
+
+
+# Verification function
+async def verify_challenge_completion(photo_path, verification_prompt=None):
+    image_bytes = await asyncio.to_thread(_read_image, photo_path)
+    mime_type = mimetypes.guess_type(photo_path)[0] or "image/jpeg"
 
-    return response.text
+    return await client.generate(verification_prompt or DEFAULT_PROMPT, image_bytes, mime_type)
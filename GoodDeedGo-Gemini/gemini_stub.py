@@ -0,0 +1,112 @@
+"""Local stand-in for the Gemini generateContent API, plus a load generator.
+
+Serve the stub:
+    python gemini_stub.py serve --port 8089 --latency 0.8 --error-rate 0.05
+
+Point the app or worker at it:
+    GEMINI_API_BASE=http://127.0.0.1:8089 python worker.py
+
+Measure client throughput against it:
+    GEMINI_API_BASE=http://127.0.0.1:8089 python gemini_stub.py loadtest --requests 500 --image photo.jpg
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+
+def make_app(latency=0.5, jitter=0.2, error_rate=0.0, answer="Yes, this image shows the challenge being completed."):
+    stats = {'requests': 0, 'errors': 0, 'in_flight': 0, 'max_in_flight': 0}
+
+    async def generate_content(request):
+        stats['requests'] += 1
+        stats['in_flight'] += 1
+        stats['max_in_flight'] = max(stats['max_in_flight'], stats['in_flight'])
+        try:
+            payload = await request.json()
+            if not payload.get('contents'):
+                return web.json_response({'error': {'code': 400, 'message': 'contents is required'}}, status=400)
+
+            await asyncio.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+            if random.random() < error_rate:
+                stats['errors'] += 1
+                return web.json_response({'error': {'code': 503, 'message': 'stub overloaded'}}, status=503)
+
+            return web.json_response({
+                'candidates': [{'content': {'role': 'model', 'parts': [{'text': answer}]}}]
+            })
+        finally:
+            stats['in_flight'] -= 1
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application(client_max_size=32 * 1024 * 1024)
+    app.router.add_post('/v1beta/models/{model}:generateContent', generate_content)
+    app.router.add_get('/stats', get_stats)
+    return app
+
+
+async def load_test(total_requests, image_path):
+    from gemini import GeminiClient, DEFAULT_PROMPT
+
+    with open(image_path, 'rb') as img:
+        image_bytes = img.read()
+
+    latencies = []
+    failures = 0
+
+    async def one(client):
+        nonlocal failures
+        started = time.perf_counter()
+        try:
+            await client.generate(DEFAULT_PROMPT, image_bytes)
+        except Exception:
+            failures += 1
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with GeminiClient() as client:
+        await asyncio.gather(*(one(client) for _ in range(total_requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': total_requests,
+        'failures': failures,
+        'concurrency': client.max_concurrency,
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(total_requests / elapsed, 2),
+        'p50_s': round(latencies[len(latencies) // 2], 3),
+        'p95_s': round(latencies[int(len(latencies) * 0.95) - 1], 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help='run the stub API server')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8089)
+    serve.add_argument('--latency', type=float, default=0.5, help='mean response delay in seconds')
+    serve.add_argument('--jitter', type=float, default=0.2)
+    serve.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    serve.add_argument('--answer', default="Yes, this image shows the challenge being completed.")
+
+    loadtest = commands.add_parser('loadtest', help='drive GeminiClient against GEMINI_API_BASE')
+    loadtest.add_argument('--requests', type=int, default=200)
+    loadtest.add_argument('--image', required=True)
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        web.run_app(make_app(args.latency, args.jitter, args.error_rate, args.answer), host=args.host, port=args.port)
+    else:
+        print(json.dumps(asyncio.run(load_test(args.requests, args.image)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
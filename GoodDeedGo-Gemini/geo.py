@@ -0,0 +1,137 @@
+"""Geospatial helpers: haversine distances and geohash cells.
+
+Challenges store a geohash of their location in an indexed column. A
+radius query covers the circle's bounding box with a few geohash cells,
+as fine as possible, and turns each cell into an index range scan on the
+geohash column. Exact distances are then computed only for the handful of
+rows that come back.
+"""
+from math import radians, cos, sin, asin, sqrt
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+KM_PER_DEGREE = 111.32
+DEFAULT_GEOFENCE_KM = 1.0
+
+GEOHASH_PRECISION = 9  # ~5m cells, stored on each challenge
+MAX_COVERING_CELLS = 12  # index range scans per radius query
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two points in kilometers"""
+    lat1, lng1, lat2, lng2 = map(radians, (lat1, lng1, lat2, lng2))
+    dlat = lat2 - lat1
+    dlng = lng2 - lng1
+    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(sqrt(a))
+
+
+def haversine_km_array(lat1, lng1, lat2, lng2):
+    """Element-wise great-circle distances in kilometers for arrays of points"""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(values, dtype=np.float64)) for values in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def check_geofences(user_lat, user_lng, challenge_lat, challenge_lng, radius_km=DEFAULT_GEOFENCE_KM):
+    """Vectorized geofence check.
+
+    Every argument may be an array (one element per submission) or a scalar;
+    radius_km is typically each submission's challenge radius. Returns
+    (distances_km, within) arrays.
+    """
+    distances = haversine_km_array(user_lat, user_lng, challenge_lat, challenge_lng)
+    return distances, distances <= np.asarray(radius_km, dtype=np.float64)
+
+
+def geohash_encode(lat, lng, precision=GEOHASH_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True  # geohash interleaves bits starting with longitude
+
+    while len(chars) < precision:
+        if even:
+            value, value_range = lng, lng_range
+        else:
+            value, value_range = lat, lat_range
+        mid = (value_range[0] + value_range[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            value_range[0] = mid
+        else:
+            bits <<= 1
+            value_range[1] = mid
+        even = not even
+
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(chars)
+
+
+def geohash_encode_array(lats, lngs, precision=GEOHASH_PRECISION):
+    """geohash_encode for arrays of points, bisecting all of them at once (same cells, bit for bit)"""
+    values = [np.asarray(lngs, dtype=np.float64), np.asarray(lats, dtype=np.float64)]
+    low = [np.full(values[0].shape, -180.0), np.full(values[0].shape, -90.0)]
+    high = [np.full(values[0].shape, 180.0), np.full(values[0].shape, 90.0)]
+    digits = np.zeros((precision,) + values[0].shape, dtype=np.int64)
+    for bit in range(precision * 5):
+        axis = bit % 2  # longitude first, as in geohash_encode
+        mid = (low[axis] + high[axis]) / 2
+        upper = values[axis] >= mid
+        low[axis] = np.where(upper, mid, low[axis])
+        high[axis] = np.where(upper, high[axis], mid)
+        digits[bit // 5] = (digits[bit // 5] << 1) | upper
+    return [''.join(_BASE32[digit] for digit in cell) for cell in digits.T.tolist()]
+
+
+def geohash_cell_size(precision):
+    """(lat_degrees, lng_degrees) covered by one cell at this precision"""
+    total_bits = 5 * precision
+    lng_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+
+def covering_cells(lat, lng, radius_km, max_cells=MAX_COVERING_CELLS):
+    """Geohash prefixes whose cells together cover the circle around (lat, lng).
+
+    Uses the finest precision that needs at most max_cells cells to cover the
+    circle's bounding box. Returns None if the radius is too large to be
+    worth an index lookup.
+    """
+    lat_span = radius_km / KM_PER_DEGREE
+    lng_scale = cos(radians(lat))
+    lng_span = min(radius_km / (KM_PER_DEGREE * lng_scale), 180.0) if lng_scale > 1e-9 else 180.0
+    min_lat, max_lat = max(lat - lat_span, -90.0), min(lat + lat_span, 90.0)
+    min_lng, max_lng = lng - lng_span, lng + lng_span
+
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        lat_deg, lng_deg = geohash_cell_size(precision)
+        rows = int(max_lat // lat_deg - min_lat // lat_deg) + 1
+        columns = int(max_lng // lng_deg - min_lng // lng_deg) + 1
+        if rows * columns > max_cells:
+            continue
+
+        cells = set()
+        for row in range(rows):
+            cell_lat = min(min_lat + row * lat_deg, max_lat)
+            for column in range(columns):
+                cell_lng = min(min_lng + column * lng_deg, max_lng)
+                cells.add(geohash_encode(cell_lat, (cell_lng + 180.0) % 360.0 - 180.0, precision))
+        return sorted(cells)
+    return None
+
+
+def prefix_upper_bound(prefix):
+    """Smallest string greater than every geohash starting with prefix"""
+    # '{' sorts right after 'z', the last geohash character
+    return prefix + '{'
@@ -1,4 +1,8 @@
 from app import app
 
 if __name__ == '__main__':
+    # Local development: make sure the schema and demo challenges exist
+    from commands import init_db
+    with app.app_context():
+        init_db()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,281 @@
+"""In-process metrics with a Prometheus text endpoint.
+
+Histograms keep cumulative bucket counts for Prometheus plus the most
+recent observations, which /status uses for p50/p95. Everything is plain
+Python and thread-safe, and nothing here depends on Flask except
+init_app().
+
+Hot-path stages are timed with
+
+    with metrics.timer('db_commit'):
+        db.session.commit()
+
+and land in gooddeedgo_stage_seconds{stage="db_commit"}. Processes without
+a web server (the worker) can expose the same registry with serve(port).
+Pool processes call collect_for_parent() and hand their observations back
+with drain(); the parent records them with replay().
+"""
+import bisect
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+RECENT_SAMPLES = 1024
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_registry = {}
+_registry_lock = threading.Lock()
+_pending = None  # observations since the last drain(), once collect_for_parent() is called
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def _register(metric):
+    with _registry_lock:
+        return _registry.setdefault(metric.name, metric)
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}  # label tuple -> [bucket counts, sum, count, recent samples]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0, deque(maxlen=RECENT_SAMPLES)]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+            series[3].append(value)
+        if _pending is not None:
+            _pending.append((self.name, key, value))
+
+    def percentiles(self, *quantiles, **labels):
+        """Quantiles over the most recent observations of one series, or None if it is empty"""
+        with self._lock:
+            series = self._series.get(tuple(sorted(labels.items())))
+            samples = sorted(series[3]) if series else []
+        if not samples:
+            return None
+        return [samples[min(len(samples) - 1, int(len(samples) * q))] for q in quantiles]
+
+    def series(self):
+        with self._lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count, _) in self._series.items()}
+
+    def render(self):
+        lines = []
+        for key, (counts, total, count) in sorted(self.series().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_label_text(key + (('le', repr(float(bound))),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_label_text(key + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{_label_text(key)} {total}")
+            lines.append(f"{self.name}_count{_label_text(key)} {count}")
+        return lines
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self):
+        with self._lock:
+            return [f"{self.name}{_label_text(key)} {value}" for key, value in sorted(self._values.items())]
+
+
+class Gauge:
+    """A value set directly, or read from a callback at scrape time"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, callback=None):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    def value(self):
+        if self.callback is not None:
+            try:
+                return self.callback()
+            except Exception as e:
+                logging.warning(f"Gauge {self.name} callback failed: {e}")
+                return float('nan')
+        return self._value
+
+    def render(self):
+        value = self.value()
+        return [f"{self.name} {'NaN' if value != value else value}"]
+
+
+def histogram(name, help, buckets=LATENCY_BUCKETS):
+    return _register(Histogram(name, help, buckets))
+
+
+def counter(name, help):
+    return _register(Counter(name, help))
+
+
+def gauge(name, help, callback=None):
+    metric = _register(Gauge(name, help, callback))
+    if callback is not None:
+        metric.callback = callback
+    return metric
+
+
+STAGE_SECONDS = histogram('gooddeedgo_stage_seconds', 'Time spent in each hot-path stage')
+REQUEST_SECONDS = histogram('gooddeedgo_http_request_seconds', 'HTTP request latency by endpoint')
+REQUEST_QUERIES = histogram('gooddeedgo_http_request_db_queries', 'SQL statements executed per HTTP request', COUNT_BUCKETS)
+DB_QUERIES = counter('gooddeedgo_db_queries_total', 'SQL statements executed')
+
+
+@contextmanager
+def timer(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+
+def summary(histogram, label):
+    """{label value: {'count', 'p50_ms', 'p95_ms'}} for one histogram's series in this process"""
+    result = {}
+    for key, (_, _, count) in sorted(histogram.series().items()):
+        labels = dict(key)
+        p50, p95 = histogram.percentiles(0.5, 0.95, **labels)
+        result[labels.get(label)] = {'count': count, 'p50_ms': round(p50 * 1000, 3), 'p95_ms': round(p95 * 1000, 3)}
+    return result
+
+
+def collect_for_parent():
+    """Start keeping observations for drain(); called in pool processes"""
+    global _pending
+    if _pending is None:
+        _pending = deque(maxlen=100_000)
+
+
+def drain():
+    """Observations recorded since the last drain, for handing back to a parent process"""
+    observations = []
+    while _pending:
+        observations.append(_pending.popleft())
+    return observations
+
+
+def replay(observations):
+    """Record observations drained in another process"""
+    for name, key, value in observations:
+        metric = _registry.get(name)
+        if isinstance(metric, Histogram):
+            metric.observe(value, **dict(key))
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format"""
+    lines = []
+    with _registry_lock:
+        metrics = list(_registry.values())
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    DB_QUERIES.inc()
+    from flask import g, has_request_context
+    if has_request_context():
+        g.metrics_queries = g.get('metrics_queries', 0) + 1
+
+
+def instrument_engine():
+    """Count every SQL statement run by any SQLAlchemy engine"""
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    if not event.contains(Engine, 'before_cursor_execute', _count_query):
+        event.listen(Engine, 'before_cursor_execute', _count_query)
+
+
+def init_app(app):
+    """Per-request latency and query counts, plus the /metrics endpoint"""
+    from flask import g, request, Response
+
+    instrument_engine()
+
+    @app.before_request
+    def _start_request_timer():
+        g.metrics_started = time.perf_counter()
+        g.metrics_queries = 0
+
+    @app.after_request
+    def _record_request(response):
+        started = g.get('metrics_started')
+        if started is not None:
+            endpoint = request.endpoint or 'unknown'
+            REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+            REQUEST_QUERIES.observe(g.get('metrics_queries', 0), endpoint=endpoint)
+        return response
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return Response(render(), content_type=CONTENT_TYPE)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host='0.0.0.0'):
+    """Expose /metrics from a background thread, for processes without a web server"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info(f"Serving metrics on :{port}/metrics")
+    return server
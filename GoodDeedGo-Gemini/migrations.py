@@ -0,0 +1,319 @@
+"""Additive schema upgrades and query-plan checks.
+
+db.create_all() creates missing tables but never changes existing ones, so
+upgrade() also brings older tables up to models.py: it adds missing
+columns, indexes and unique constraints, then backfills the derived
+columns it just added. Apart from dropping the indexes in RETIRED_INDEXES
+once their replacements exist, it only ever adds, so init-db runs it on
+every deploy and a second run changes nothing.
+
+check_indexes() EXPLAINs each hot query (routes, worker, leaderboard and
+rank sync) against the configured database and reports the ones whose
+plan reads a whole table or does not search the index meant for it:
+
+    flask --app main check-indexes
+"""
+import logging
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, inspect, text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from app import db
+
+
+def _add_missing_columns(conn, inspector, table):
+    existing = {column['name'] for column in inspector.get_columns(table.name)}
+    preparer = conn.dialect.identifier_preparer
+    added = []
+    for column in table.columns:
+        if column.name not in existing:
+            ddl = CreateColumn(column).compile(dialect=conn.dialect)
+            conn.execute(text(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {ddl}"))
+            added.append(column.name)
+    return added
+
+
+def _add_missing_unique_constraints(conn, inspector, table):
+    existing = {constraint['name'] for constraint in inspector.get_unique_constraints(table.name)}
+    existing |= {index['name'] for index in inspector.get_indexes(table.name) if index.get('unique')}
+    preparer = conn.dialect.identifier_preparer
+    added = []
+    for constraint in table.constraints:
+        if not isinstance(constraint, db.UniqueConstraint) or not constraint.name or constraint.name in existing:
+            continue
+        columns = list(constraint.columns)
+        # Keep the oldest row of each duplicate group, or the unique index cannot be built.
+        # Rows with a NULL in the constraint never collide, so they all stay.
+        keep = db.select(func.min(table.c.id)).group_by(*columns)
+        removed = conn.execute(table.delete().where(
+            and_(*[column.isnot(None) for column in columns]), table.c.id.not_in(keep))).rowcount
+        if removed:
+            logging.warning(f"Removed {removed} duplicate {table.name} row(s) before adding {constraint.name}")
+        # A unique index is what SQLite can add to an existing table, and Postgres treats it the same
+        conn.execute(text(f"CREATE UNIQUE INDEX {preparer.quote(constraint.name)} ON {preparer.format_table(table)} "
+                          f"({', '.join(preparer.quote(column.name) for column in columns)})"))
+        added.append(constraint.name)
+    return added
+
+
+def _demote_duplicate_completions(conn):
+    """Reject all but the first verified submission per user and challenge, taking back their points"""
+    from models import User, Submission, level_for
+
+    submissions = Submission.__table__
+    users = User.__table__
+    first = db.select(func.min(submissions.c.id)).where(submissions.c.status == 'verified') \
+        .group_by(submissions.c.user_id, submissions.c.challenge_id)
+    duplicates = conn.execute(db.select(submissions.c.id, submissions.c.user_id, submissions.c.points_awarded).where(
+        submissions.c.status == 'verified', submissions.c.id.not_in(first))).all()
+    for submission_id, user_id, points in duplicates:
+        conn.execute(submissions.update().where(submissions.c.id == submission_id)
+                     .values(status='rejected', points_awarded=0))
+        new_total = func.coalesce(users.c.total_points, 0) - (points or 0)
+        conn.execute(users.update().where(users.c.id == user_id).values(total_points=new_total, level=level_for(new_total)))
+    if duplicates:
+        logging.warning(f"Rejected {len(duplicates)} duplicate verified submission(s) and took back their points")
+    return len(duplicates)
+
+
+# Run before creating an index whose rows must first be made unique
+BEFORE_INDEX = {
+    'uq_submission_verified_user_challenge': _demote_duplicate_completions,
+}
+
+# Indexes that a newer index in models.py covers: {retired name: replacement}
+RETIRED_INDEXES = {
+    'ix_submission_user_submitted': 'ix_submission_user_history',
+}
+
+
+def _backfill(added_columns, new_tables, demoted=0):
+    from geo import geohash_encode
+    from models import Challenge, UserCategoryStat
+
+    if 'geohash' in added_columns.get('challenge', ()):
+        for challenge_id, lat, lng in db.session.query(Challenge.id, Challenge.latitude, Challenge.longitude).all():
+            Challenge.query.filter_by(id=challenge_id).update({Challenge.geohash: geohash_encode(lat, lng)}, synchronize_session=False)
+        db.session.commit()
+        logging.info("Backfilled challenge geohashes")
+    if 'verified_completions' in added_columns.get('challenge', ()) or demoted:
+        Challenge.reconcile_completion_counts()
+        logging.info("Backfilled challenge completion counts")
+    if 'user_category_stat' in new_tables or demoted:
+        UserCategoryStat.rebuild()
+        logging.info("Built per-category completion counters; run reevaluate-achievements to award existing users")
+    if 'challenge_daily_stat' in new_tables:
+        import analytics
+        rolled = analytics.rebuild()
+        logging.info(f"Built the analytics rollups from {rolled} settled submission(s)")
+    if 'stored_image' in new_tables:
+        import storage
+        adopted = storage.adopt_legacy_files()
+        if adopted:
+            logging.info(f"Moved {adopted} existing photo(s) into the image store")
+
+
+def upgrade():
+    """Create missing tables, add missing columns, indexes and unique constraints; returns what changed"""
+    existing_tables = set(inspect(db.engine).get_table_names())
+    db.create_all()
+    new_tables = {table.name for table in db.metadata.sorted_tables} - existing_tables
+
+    changes = [f"created table {name}" for name in sorted(new_tables)]
+    added_columns = {}
+    demoted = 0
+    with db.engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in db.metadata.sorted_tables:
+            if table.name in new_tables:
+                continue
+            added_columns[table.name] = _add_missing_columns(conn, inspector, table)
+            changes += [f"added column {table.name}.{name}" for name in added_columns[table.name]]
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    if index.name in BEFORE_INDEX:
+                        demoted += BEFORE_INDEX[index.name](conn)
+                    index.create(conn)
+                    changes.append(f"created index {index.name}")
+                    existing_indexes.add(index.name)
+            for retired, replacement in RETIRED_INDEXES.items():
+                if retired in existing_indexes and replacement in existing_indexes:
+                    conn.execute(text(f"DROP INDEX {conn.dialect.identifier_preparer.quote(retired)}"))
+                    changes.append(f"dropped index {retired}, replaced by {replacement}")
+            changes += [f"added unique constraint {name}" for name in _add_missing_unique_constraints(conn, inspector, table)]
+
+    for change in changes:
+        logging.info(f"Schema upgrade: {change}")
+    _backfill(added_columns, new_tables, demoted)
+    return changes
+
+
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, 'sqlite')
+def _explain_sqlite(element, compiler, **kw):
+    return "EXPLAIN QUERY PLAN " + compiler.process(element.statement, **kw)
+
+
+@compiles(Explain, 'postgresql')
+def _explain_postgresql(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kw)
+
+
+def _postgres_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from _postgres_nodes(child)
+
+
+def explain(query):
+    """(plan lines, full table scans, indexes searched) for a Query or select on the current database
+
+    A table's integer primary key, which SQLite keeps as the rowid, shows up as '<table>.rowid'.
+    """
+    statement = getattr(query, 'statement', query)
+    conn = db.session.connection()
+    if conn.dialect.name == 'sqlite':
+        # Raw rows: the result would otherwise be typed as the explained statement's columns
+        lines = [row[-1] for row in conn.execute(Explain(statement)).cursor.fetchall()]
+        # 'SCAN t USING INDEX i' still reads every entry of i; only SEARCH narrows to a range
+        scans = [line for line in lines if line.startswith('SCAN ') and line != 'SCAN CONSTANT ROW']
+        used = set()
+        for line in lines:
+            if match := SQLITE_SEARCH.match(line):
+                used.add(match['index'] or f"{match['table']}.rowid")
+        return lines, scans, used
+    if conn.dialect.name == 'postgresql':
+        # Tiny tables are cheaper to scan, so ask whether an index *can* serve the query
+        conn.execute(text("SET LOCAL enable_seqscan = off"))
+        plan = conn.execute(Explain(statement)).scalar()[0]['Plan']
+        nodes = list(_postgres_nodes(plan))
+        lines = [f"{node['Node Type']} {node.get('Relation Name', '')} {node.get('Index Name', '')}".strip() for node in nodes]
+        used = {node['Index Name'] for node in nodes if 'Index Name' in node}
+        return lines, [line for line in lines if line.startswith('Seq Scan')], used
+    raise NotImplementedError(f"No EXPLAIN support for {conn.dialect.name}")
+
+
+SQLITE_SEARCH = re.compile(r"SEARCH (?P<table>\S+) USING (?:(?:COVERING )?INDEX (?P<index>\S+)|INTEGER PRIMARY KEY)")
+
+
+def _index(model, name=None):
+    """The model's index or unique constraint called name, or its primary key"""
+    table = model.__table__
+    if name is None:
+        return table.primary_key
+    for index in [*table.indexes, *table.constraints]:
+        if index.name == name:
+            return index
+    raise KeyError(f"{table.name} has no index {name}")
+
+
+def index_name(index):
+    """Name the current database's query plans give an Index, UniqueConstraint or PrimaryKeyConstraint"""
+    conn = db.session.connection()
+    table = index.table.name
+    if isinstance(index, db.Index):
+        return index.name
+    if conn.dialect.name == 'sqlite':
+        # Constraints are served by indexes SQLite names itself: find the one on the same columns
+        columns = [column.name for column in index.columns]
+        for row in conn.exec_driver_sql(f"PRAGMA index_list({conn.dialect.identifier_preparer.quote(table)})").all():
+            info = conn.exec_driver_sql(f"PRAGMA index_info({conn.dialect.identifier_preparer.quote(row[1])})").all()
+            if [column[2] for column in sorted(info)] == columns:
+                return row[1]
+        if isinstance(index, db.PrimaryKeyConstraint) and len(columns) == 1:
+            return f"{table}.rowid"
+        raise LookupError(f"No index on {table} ({', '.join(columns)})")
+    return index.name or f"{table}_pkey"
+
+
+def hot_queries():
+    """[(name, query, expected index)] for the queries on the request, worker and sync paths.
+
+    Deliberately absent: the challenge catalogue (served from the application
+    cache, and nearly every row matches) and the leaderboards' periodic full
+    reload, which aggregates every verified submission by design.
+    """
+    from leaderboard import board_queries, week_start
+    from models import User, Challenge, Submission, Achievement, UserCategoryStat, StoredImage, ChallengeDailyStat, CategoryHourlyStat
+    import worker
+
+    since = datetime.utcnow() - timedelta(minutes=5)
+    by_status = _index(Submission, 'ix_submission_status')
+    category_board, weekly_board = board_queries(week_start(), [1, 2, 3])
+    return [
+        ('recent submissions', Submission.query.filter_by(user_id=1).order_by(Submission.submitted_at.desc()).limit(3),
+            _index(Submission, 'ix_submission_user_history')),
+        ('history page', Submission.history(1, before=(datetime.utcnow(), 1000)).limit(21),
+            _index(Submission, 'ix_submission_user_history')),
+        ('already completed', Submission.query.filter_by(user_id=1, challenge_id=1, status='verified'),
+            _index(Submission, 'ix_submission_user_challenge_status')),
+        ('profile achievements', Achievement.query.filter_by(user_id=1).order_by(Achievement.earned_at.desc()),
+            _index(Achievement, 'ix_achievement_user_earned')),
+        ('earned titles', db.session.query(Achievement.title).filter(Achievement.user_id == 1),
+            _index(Achievement, 'uq_achievement_user_title')),
+        ('category counters', db.session.query(UserCategoryStat.category, UserCategoryStat.verified_count)
+            .filter(UserCategoryStat.user_id.in_([1])), _index(UserCategoryStat)),
+        ('queue depth', db.session.query(func.count(Submission.id)).filter(Submission.status == 'pending'), by_status),
+        ('queue age', db.session.query(Submission.submitted_at).filter(Submission.status == 'pending').order_by(Submission.id).limit(1),
+            by_status),
+        *[(f'claim batch {i}', query.limit(16), by_status) for i, query in enumerate(worker.claim_queries(), 1)],
+        ('completion counts', db.session.query(Submission.challenge_id, func.count(Submission.id))
+            .filter(Submission.status == 'verified', Submission.challenge_id.in_([1, 2, 3]))
+            .group_by(Submission.challenge_id), _index(Submission, 'ix_submission_challenge_status')),
+        ('duplicate photo', db.session.query(Submission.id).filter(Submission.image_sha256 == '0' * 64),
+            _index(Submission, 'ix_submission_image_sha256')),
+        ('derivative backlog', db.session.query(StoredImage.sha256, StoredImage.key)
+            .filter(StoredImage.derivatives_ready == False, StoredImage.ref_count > 0).limit(32),
+            _index(StoredImage, 'ix_stored_image_derivatives')),
+        ('rejected photos', db.session.query(Submission.id)
+            .filter(Submission.status == 'rejected', Submission.image_path != '', Submission.submitted_at < since), by_status),
+        ('unreferenced photos', db.session.query(StoredImage.sha256, StoredImage.key)
+            .filter(StoredImage.ref_count <= 0, StoredImage.released_at < since),
+            _index(StoredImage, 'ix_stored_image_unreferenced')),
+        ('nearby challenges', Challenge.nearby_candidates(40.7580, -73.9855, 10.0), _index(Challenge, 'ix_challenge_geohash')),
+        ('rollup batch', db.session.query(Submission.id, Submission.status, Challenge.category)
+            .join(Challenge, Submission.challenge_id == Challenge.id).filter(Submission.id > 1000).order_by(Submission.id).limit(100),
+            _index(Submission)),
+        ('daily stats', db.session.query(ChallengeDailyStat.day, func.sum(ChallengeDailyStat.verified))
+            .filter(ChallengeDailyStat.day >= since.date(), ChallengeDailyStat.challenge_id == 1).group_by(ChallengeDailyStat.day),
+            _index(ChallengeDailyStat, 'ix_challenge_daily_stat_challenge_day')),
+        ('category stats', db.session.query(CategoryHourlyStat.category, func.sum(CategoryHourlyStat.verified))
+            .filter(CategoryHourlyStat.hour >= since).group_by(CategoryHourlyStat.category), _index(CategoryHourlyStat)),
+        ('rank sync', db.session.query(User.id, User.total_points).filter(User.points_updated_at > since),
+            _index(User, 'ix_user_points_updated_at')),
+        ('leaderboard sync', db.session.query(Submission.user_id).filter(Submission.verified_at > since),
+            _index(Submission, 'ix_submission_verified_user')),
+        ('category board sync', category_board, _index(Submission, 'uq_submission_verified_user_challenge')),
+        ('weekly board sync', weekly_board, _index(Submission, 'uq_submission_verified_user_challenge')),
+    ]
+
+
+def check_query(query, index):
+    """(plan lines, problems): the full table scans, and a note if the plan does not search index"""
+    lines, scans, used = explain(query)
+    expected = index_name(index)
+    problems = list(scans)
+    if expected not in used:
+        problems.append(f"does not search {expected}")
+    return lines, problems
+
+
+def check_indexes():
+    """[(name, plan lines, problems)] for every hot query; problems is empty when the plan is as intended"""
+    results = []
+    for name, query, index in hot_queries():
+        lines, problems = check_query(query, index)
+        results.append((name, lines, problems))
+    db.session.rollback()
+    return results
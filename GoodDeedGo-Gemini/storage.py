@@ -0,0 +1,348 @@
+"""Content-addressed image store.
+
+Every distinct upload is stored once, keyed by the SHA-256 of the uploaded
+bytes and sharded two directory levels deep so no directory holds more
+than a few thousand files:
+
+    ab/cd/abcd...ef.jpg             the photo (resized to 1024px at ingestion if larger)
+    ab/cd/abcd...ef.thumb.webp      derivatives, made in the background
+    ab/cd/abcd...ef.display.webp
+
+Submission.image_path holds the key, and a StoredImage row counts the
+submissions that reference it. A resubmitted photo only costs a hash and
+one more reference: no decode, no resize, no write.
+
+The verification worker (worker.py) keeps the store tidy. A DerivativeWorker
+makes the WebP derivatives on a thread pool, and collect_garbage() releases
+the photos of submissions rejected more than REJECTED_IMAGE_RETENTION_HOURS
+ago, then deletes photos that have been unreferenced for
+STORAGE_GC_GRACE_MINUTES, and files that no row owns (an upload rolled back)
+once they are that old. Deleting a dormant user releases their photos
+the same way.
+
+A backend provides exists, open, put, delete, keys and local_path. The local
+filesystem backend below is the reference one; STORAGE_URL picks its root
+(default: the app's UPLOAD_FOLDER):
+
+    STORAGE_URL=file:///var/lib/gooddeedgo/images
+"""
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from PIL import Image
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from imaging import content_hash, ingest_upload, perceptual_hash
+from models import Submission, StoredImage
+from metrics import timer
+import metrics
+
+STORAGE_URL = os.environ.get("STORAGE_URL", "")
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif'}
+DERIVATIVES = {'thumb': (256, 256), 'display': (1024, 1024)}  # name -> bounding box, all WebP
+WEBP_QUALITY = 80
+DERIVATIVE_THREADS = int(os.environ.get("STORAGE_DERIVATIVE_THREADS", 2))
+DERIVATIVE_BATCH = int(os.environ.get("STORAGE_DERIVATIVE_BATCH", 32))
+REJECTED_RETENTION = timedelta(hours=float(os.environ.get("REJECTED_IMAGE_RETENTION_HOURS", 24)))
+GC_GRACE = timedelta(minutes=float(os.environ.get("STORAGE_GC_GRACE_MINUTES", 10)))
+BATCH_SIZE = 500
+
+STORE_WRITES = metrics.counter('gooddeedgo_image_store_uploads_total', 'Stored uploads by outcome (new, duplicate, rewritten)')
+
+
+class LocalBackend:
+    """Objects as files under root, at their key"""
+
+    def __init__(self, root):
+        self.root = root
+        self.staging = os.path.join(root, '.staging')  # same filesystem as the objects, so put() is a rename
+
+    def local_path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def exists(self, key):
+        return os.path.isfile(self.local_path(key))
+
+    def open(self, key):
+        return open(self.local_path(key), 'rb')
+
+    def put(self, key, source_path):
+        """Move a finished local file to key; readers never see a partial object"""
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(source_path, path)
+
+    def delete(self, key, modified_before=None):
+        """Remove key; given modified_before (epoch seconds), only if it has not been written since"""
+        path = self.local_path(key)
+        try:
+            if modified_before is None or os.path.getmtime(path) < modified_before:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def keys(self, modified_before):
+        """Keys of the objects last written before modified_before (epoch seconds), shard by shard"""
+        for first in _shards(self.root):
+            for second in _shards(os.path.join(self.root, first)):
+                with os.scandir(os.path.join(self.root, first, second)) as entries:
+                    for entry in entries:
+                        if entry.is_file() and entry.stat().st_mtime < modified_before:
+                            yield f"{first}/{second}/{entry.name}"
+
+
+def _shards(directory):
+    # Only the two-hex-digit shard directories: legacy uploads and staging live beside them
+    try:
+        names = os.listdir(directory)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+    return sorted(name for name in names if len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+                  and os.path.isdir(os.path.join(directory, name)))
+
+
+def backend_from_url(url):
+    if not url:
+        return LocalBackend(app.config['UPLOAD_FOLDER'])
+    if url.startswith('file://'):
+        return LocalBackend(url[len('file://'):])
+    raise ValueError(f"Unsupported STORAGE_URL '{url}'")
+
+
+image_store = backend_from_url(STORAGE_URL)
+
+
+def object_key(sha256, image_format):
+    return f"{sha256[:2]}/{sha256[2:4]}/{sha256}.{EXTENSIONS[image_format]}"
+
+
+def derivative_key(key, name):
+    return f"{key.rsplit('.', 1)[0]}.{name}.webp"
+
+
+def _staging_path(suffix=''):
+    staging = getattr(image_store, 'staging', None)
+    if staging:
+        os.makedirs(staging, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=staging)
+    os.close(fd)
+    return path
+
+
+def _put_file(key, write):
+    staging = _staging_path(os.path.splitext(key)[1])
+    try:
+        result = write(staging)
+        image_store.put(key, staging)
+        return result
+    finally:
+        if os.path.exists(staging):
+            os.remove(staging)
+
+
+def _reference(sha256, key, phash):
+    """Take a reference to the photo's row, inserting it if there is none; (StoredImage, inserted)"""
+    if StoredImage.acquire(sha256):
+        return StoredImage.query.get(sha256), False
+    image = StoredImage(sha256=sha256, key=key, phash=phash, ref_count=1)
+    try:
+        with db.session.begin_nested():
+            db.session.add(image)
+    except IntegrityError:
+        # A concurrent upload of the same photo inserted the row first
+        StoredImage.acquire(sha256)
+        return StoredImage.query.get(sha256), False
+    return image, True
+
+
+def store_upload(stream):
+    """StoredImage for an uploaded photo, with one more reference taken in the caller's transaction.
+
+    The photo is decoded, resized and written to staging before its row is touched: taking
+    the reference is the transaction's first write, and under SQLite that holds the database
+    write lock until the caller commits, so none of the image work may happen after it.
+    """
+    sha256 = content_hash(stream)
+    image = StoredImage.query.get(sha256)
+    if image is not None and image_store.exists(image.key) and StoredImage.acquire(sha256):
+        STORE_WRITES.inc(outcome='duplicate')
+        return image
+    if image is not None:
+        db.session.expunge(image)  # collected, or its file is gone: read it again below
+
+    # The key depends on the decoded format, so write to staging first and name it afterwards
+    staging = _staging_path()
+    try:
+        ingested = ingest_upload(stream, staging, sha256=sha256)
+        key = object_key(sha256, ingested.format)
+        image, inserted = _reference(sha256, key, ingested.phash)
+        # Put after taking the reference: a collection racing this upload has then either
+        # deleted the old row and files already, or sees the reference and keeps the photo
+        with timer('image_store'):
+            image_store.put(key, staging)
+    finally:
+        if os.path.exists(staging):
+            os.remove(staging)
+    # A new file whose row never commits is an orphan; collect_garbage() sweeps those
+    STORE_WRITES.inc(outcome='new' if inserted else 'rewritten')
+    return image
+
+
+def _make_derivatives(key):
+    # Runs on a pool thread; Pillow releases the GIL while decoding, resizing and encoding
+    with image_store.open(key) as source, Image.open(source) as img:
+        if img.format == 'JPEG':
+            img.draft('RGB', max(DERIVATIVES.values()))
+        img.load()
+        for name, size in DERIVATIVES.items():
+            derivative = img.copy()
+            derivative.thumbnail(size, Image.Resampling.LANCZOS)
+            if derivative.mode not in ('RGB', 'RGBA'):
+                transparent = 'A' in derivative.mode or 'transparency' in derivative.info
+                derivative = derivative.convert('RGBA' if transparent else 'RGB')
+            _put_file(derivative_key(key, name), lambda path: derivative.save(path, format='WEBP', quality=WEBP_QUALITY))
+
+
+class DerivativeWorker:
+    """Makes missing derivatives on a thread pool without blocking the caller's loop"""
+
+    def __init__(self, threads=DERIVATIVE_THREADS):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='derivatives')
+        self.in_flight = {}  # future -> sha256
+
+    def poll(self, limit=DERIVATIVE_BATCH):
+        """Record finished photos and, once a batch is done, start the next; call within an app context"""
+        finished = [future for future in self.in_flight if future.done()]
+        if finished:
+            for future in finished:
+                error = future.exception()
+                if error is not None:
+                    # Still marked done: a photo that cannot be decoded would otherwise be retried forever
+                    logging.error(f"Could not make derivatives of image {self.in_flight[future]}: {error}")
+            done = [self.in_flight.pop(future) for future in finished]
+            StoredImage.query.filter(StoredImage.sha256.in_(done)).update(
+                {StoredImage.derivatives_ready: True}, synchronize_session=False)
+            db.session.commit()
+        if self.in_flight:
+            return
+
+        pending = db.session.query(StoredImage.sha256, StoredImage.key) \
+            .filter(StoredImage.derivatives_ready == False, StoredImage.ref_count > 0).limit(limit).all()
+        db.session.commit()
+        for sha256, key in pending:
+            self.in_flight[self.executor.submit(_make_derivatives, key)] = sha256
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def release_rejected():
+    """Give up the photos of submissions rejected over REJECTED_IMAGE_RETENTION_HOURS ago; returns how many"""
+    cutoff = datetime.utcnow() - REJECTED_RETENTION
+    released = 0
+    while True:
+        submission_ids = [submission_id for (submission_id,) in db.session.query(Submission.id).filter(
+            Submission.status == 'rejected', Submission.image_path != '', Submission.submitted_at < cutoff
+        ).order_by(Submission.id).limit(BATCH_SIZE)]
+        if not submission_ids:
+            return released
+        StoredImage.release(StoredImage.references(Submission.id.in_(submission_ids)))
+        Submission.query.filter(Submission.id.in_(submission_ids)).update(
+            {Submission.image_path: ''}, synchronize_session=False)
+        db.session.commit()
+        released += len(submission_ids)
+
+
+def sweep_orphans():
+    """Delete files older than STORAGE_GC_GRACE_MINUTES that no StoredImage row owns; returns how many photos.
+
+    They are left by uploads whose transaction rolled back (e.g. an Idempotency-Key replay)
+    or died after the file was put.
+    """
+    cutoff = time.time() - GC_GRACE.total_seconds()
+    keys = image_store.keys(cutoff)
+    deleted = 0
+    while True:
+        batch = {}  # sha256 -> the photo's keys and its derivatives'
+        for key in itertools.islice(keys, BATCH_SIZE):
+            batch.setdefault(key.rsplit('/', 1)[1].split('.', 1)[0], []).append(key)
+        if not batch:
+            return deleted
+        owned = {sha256 for (sha256,) in db.session.query(StoredImage.sha256).filter(StoredImage.sha256.in_(list(batch)))}
+        db.session.commit()
+        for sha256, orphans in batch.items():
+            if sha256 not in owned:
+                for key in orphans:
+                    image_store.delete(key, modified_before=cutoff)  # unless an upload just wrote it again
+                deleted += 1
+
+
+def collect_garbage():
+    """Release old rejected photos, then delete photos unreferenced for STORAGE_GC_GRACE_MINUTES
+    and files without a row; returns (submissions released, photos deleted)"""
+    released = release_rejected()
+    cutoff = datetime.utcnow() - GC_GRACE
+    deleted = 0
+    while True:
+        candidates = db.session.query(StoredImage.sha256, StoredImage.key) \
+            .filter(StoredImage.ref_count <= 0, StoredImage.released_at < cutoff).limit(BATCH_SIZE).all()
+        if not candidates:
+            db.session.commit()
+            return released, deleted + sweep_orphans()
+        for sha256, key in candidates:
+            # Conditional, so a photo re-acquired since the query stays. The files go before the
+            # commit: an upload blocked on this row then finds no row and writes the photo again.
+            if StoredImage.query.filter(StoredImage.sha256 == sha256, StoredImage.ref_count <= 0) \
+                    .delete(synchronize_session=False):
+                for object_name in (key, *(derivative_key(key, name) for name in DERIVATIVES)):
+                    image_store.delete(object_name)
+                deleted += 1
+            db.session.commit()
+
+
+def adopt_legacy_files(batch_size=BATCH_SIZE):
+    """Move photos saved before the image store (image_path is a file path) into it; returns how many"""
+    adopted = 0
+    last_id = 0
+    while True:
+        rows = db.session.query(Submission.id, Submission.image_path, Submission.image_sha256, Submission.image_phash) \
+            .filter(Submission.id > last_id, Submission.image_path != '', Submission.image_path.notlike('__/__/%')) \
+            .order_by(Submission.id).limit(batch_size).all()
+        if not rows:
+            return adopted
+        last_id = rows[-1].id
+
+        moved = set()
+        for submission_id, path, sha256, phash in rows:
+            values = {Submission.image_path: ''}  # the file is gone: nothing left to reference
+            if os.path.isfile(path):
+                try:
+                    with Image.open(path) as img:
+                        image_format = img.format
+                        phash = phash or perceptual_hash(img)
+                    with open(path, 'rb') as legacy:
+                        sha256 = sha256 or content_hash(legacy)
+                    key = object_key(sha256, image_format)
+                except Exception as e:
+                    logging.warning(f"Leaving {path} (submission {submission_id}) out of the image store: {e}")
+                    continue
+                if not StoredImage.acquire(sha256):
+                    db.session.add(StoredImage(sha256=sha256, key=key, phash=phash, ref_count=1))
+                    db.session.flush()
+                if not image_store.exists(key):
+                    _put_file(key, lambda staging: shutil.copyfile(path, staging))
+                values = {Submission.image_path: key, Submission.image_sha256: sha256, Submission.image_phash: phash}
+                moved.add(path)
+                adopted += 1
+            Submission.query.filter_by(id=submission_id).update(values, synchronize_session=False)
+        db.session.commit()
+
+        for path in moved:
+            os.remove(path)
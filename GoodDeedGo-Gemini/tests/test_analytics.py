@@ -0,0 +1,37 @@
+"""The rollups move past submissions still waiting for verification and add them once settled"""
+import uuid
+from datetime import datetime
+
+
+def test_unsettled_submission_does_not_hold_back_the_rollups(app_context):
+    from app import db
+    from models import User, Challenge, Submission, RollupPending
+    import analytics
+
+    name = f"rollup_{uuid.uuid4().hex[:8]}"
+    user = User(username=name, email=f"{name}@gooddeedgo.app")
+    challenge = Challenge(title=name, description='Rollup test', category=name, points=10,
+                          latitude=40.7580, longitude=-73.9855, verification_prompt='Rollup test')
+    db.session.add_all([user, challenge])
+    db.session.flush()
+    now = datetime.utcnow()
+    submissions = [Submission(user_id=user.id, challenge_id=challenge.id, image_path='', user_location_lat=40.7580,
+                              user_location_lng=-73.9855, status=status, points_awarded=points, submitted_at=now)
+                   for status, points in [('verified', 10), ('processing', None), ('rejected', 0)]]
+    db.session.add_all(submissions)
+    db.session.commit()
+    stuck = submissions[1].id
+
+    def totals():
+        return next((entry for entry in analytics.category_stats(1) if entry['category'] == name), None)
+
+    analytics.update_rollups()
+    assert totals()['verified'] == 1 and totals()['rejected'] == 1  # the one after the stuck submission too
+    assert db.session.get(RollupPending, stuck) is not None
+
+    Submission.query.filter_by(id=stuck).update({'status': 'rejected', 'points_awarded': 0})
+    db.session.commit()
+    analytics.update_rollups()
+    analytics.update_rollups()
+    assert totals()['verified'] == 1 and totals()['rejected'] == 2  # added exactly once
+    assert db.session.get(RollupPending, stuck) is None
@@ -0,0 +1,36 @@
+"""Each hot query must search the index meant for it, never scan a whole table"""
+import pytest
+
+from app import app, db
+from migrations import check_query, hot_queries, _index
+
+with app.app_context():
+    NAMES = [name for name, _, _ in hot_queries()]
+
+
+@pytest.mark.parametrize('name', NAMES)
+def test_hot_query_uses_its_index(app_context, name):
+    query, index = next((query, index) for hot, query, index in hot_queries() if hot == name)
+    lines, problems = check_query(query, index)
+    assert not problems, '\n'.join(lines)
+
+
+def test_check_rejects_a_plan_on_the_wrong_index(app_context):
+    from geo import covering_cells, prefix_upper_bound
+    from models import Challenge
+
+    # is_active == True is an equality SQLite takes as selective, so it searches the is_active index
+    query = db.session.query(Challenge.id).filter(Challenge.is_active == True, db.or_(*[
+        db.and_(Challenge.geohash >= cell, Challenge.geohash < prefix_upper_bound(cell))
+        for cell in covering_cells(40.7580, -73.9855, 10.0)]))
+    lines, problems = check_query(query, _index(Challenge, 'ix_challenge_geohash'))
+    assert problems == ['does not search ix_challenge_geohash'], '\n'.join(lines)
+
+
+def test_check_rejects_a_full_scan(app_context):
+    from models import Submission
+
+    lines, problems = check_query(db.session.query(Submission.id).filter(Submission.user_location_lat > 0),
+                                  _index(Submission, 'ix_submission_status'))
+    assert any(problem.startswith('SCAN submission') for problem in problems), '\n'.join(lines)
+    assert 'does not search ix_submission_status' in problems
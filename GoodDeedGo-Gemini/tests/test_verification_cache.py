@@ -0,0 +1,17 @@
+"""Verification cache lookups by exact and perceptual hash"""
+from verification_cache import VerificationCache, BANDS
+
+PHASH = 'ffff0000ffff0000'
+NEAR = 'fffe0000ffff0001'  # 2 bits away
+
+
+def test_near_photos_are_found_by_phash():
+    cache = VerificationCache(db_path=None)
+    cache.put('ns', 'a' * 64, PHASH, 'recycling', user_id=1, submission_id=1)
+    hit = cache.get('ns', 'b' * 64, NEAR)
+    assert hit.result == 'recycling' and not hit.exact
+    assert cache.get('ns', 'a' * 64).exact
+
+
+def test_distance_beyond_the_bands_is_lowered():
+    assert VerificationCache(db_path=None, max_distance=10).max_distance == BANDS - 1
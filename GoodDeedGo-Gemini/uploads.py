@@ -0,0 +1,83 @@
+"""Streaming photo uploads with early rejection.
+
+Werkzeug reads and parses the whole multipart body the first time
+request.form or request.files is touched, so the submission route does
+every check that does not need the photo first: the declared
+Content-Length, "already completed", and the geofence when the client sends
+its coordinates in the query string (POST /challenge/1?user_lat=..&user_lng=..).
+A rejected submission is answered without reading the body.
+
+Once the body is read, each file part streams through a SniffedUpload: the
+first bytes must carry a JPEG, PNG or GIF signature and the part may not
+grow past UPLOAD_MAX_BYTES. Either failure aborts the parse on that chunk,
+so a mislabelled or oversized upload is never spooled in full. Accepted
+parts stay in memory up to UPLOAD_SPOOL_BYTES, then spill to a temp file.
+"""
+import os
+import tempfile
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 16 * 1024 * 1024))
+UPLOAD_SPOOL_BYTES = int(os.environ.get("UPLOAD_SPOOL_BYTES", 512 * 1024))
+
+SIGNATURES = {
+    b'\xff\xd8\xff': 'JPEG',
+    b'\x89PNG\r\n\x1a\n': 'PNG',
+    b'GIF87a': 'GIF',
+    b'GIF89a': 'GIF',
+}
+SNIFF_BYTES = max(len(signature) for signature in SIGNATURES)
+
+
+def sniff(head):
+    """Image format named by a file's first bytes, or None"""
+    for signature, image_format in SIGNATURES.items():
+        if head.startswith(signature):
+            return image_format
+    return None
+
+
+class SniffedUpload:
+    """Spool for one uploaded file that checks its signature and size as chunks arrive"""
+
+    def __init__(self, limit=UPLOAD_MAX_BYTES):
+        self.limit = limit
+        self.size = 0
+        self.format = None
+        self._head = b''
+        self._file = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise RequestEntityTooLarge(f"Photos can be at most {round(self.limit / (1024 * 1024), 1):g}MB.")
+        if self.format is None:
+            self._head = (self._head + data)[:SNIFF_BYTES]
+            if len(self._head) == SNIFF_BYTES:
+                self.format = sniff(self._head)
+                if self.format is None:
+                    raise UnsupportedMediaType("Invalid file type. Please upload a JPEG, PNG or GIF photo.")
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return SniffedUpload()
+
+
+def coordinates(values):
+    """(lat, lng) from request args or form values, or None if either is missing"""
+    try:
+        return float(values['user_lat']), float(values['user_lng'])
+    except (KeyError, ValueError):
+        return None
+
+
+def upload_format(file):
+    """Sniffed image format of an uploaded file, or None if it is not an accepted image"""
+    return getattr(file.stream, 'format', None)
@@ -0,0 +1,241 @@
+"""Pre-aggregated submission analytics.
+
+The stats API reads two rollup tables and never Submission itself:
+
+    ChallengeDailyStat   verified and rejected submissions and points per challenge and day
+    CategoryHourlyStat   the same per challenge category and hour
+
+Buckets are UTC, by submitted_at. Only settled (verified or rejected)
+submissions are rolled up, and a settled submission never changes again,
+so the rollups are maintained incrementally: RollupState holds a
+high-water mark (the last read submission id and its submitted_at), and
+update_rollups() reads the submissions after it in id order. Ids grow
+with submitted_at, so reading past the mark is a primary key range scan.
+The mark moves past submissions still waiting for verification too, so
+one stuck in the queue does not hold back the rest: their ids go to
+RollupPending, and each run first adds the ones settled since.
+
+Each batch is aggregated with NumPy and added to the rollup rows in the
+same transaction that moves the mark or clears its pending ids. rebuild()
+empties the tables and recomputes them with the same aggregation over
+much larger batches, for backfills:
+
+    flask --app main rollup-stats [--rebuild]
+
+The verification worker calls update_rollups() every WORKER_ROLLUP_INTERVAL
+seconds, and init-db rebuilds the tables when it creates them.
+"""
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import func, tuple_
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from models import Challenge, Submission, ChallengeDailyStat, CategoryHourlyStat, RollupState, RollupPending
+
+BATCH_SIZE = int(os.environ.get("ROLLUP_BATCH_SIZE", 10000))
+REBUILD_BATCH_SIZE = 200000
+LOOKUP_CHUNK = 2000  # keys per IN (...) lookup, well under SQLite's bound-variable limit
+MEASURES = ['verified', 'rejected', 'points_awarded']
+SETTLED = ('verified', 'rejected')
+STATE = 'submissions'
+
+
+def _rollup_rows():
+    return db.session.query(Submission.id, Submission.submitted_at, Submission.status, Submission.points_awarded,
+                            Submission.challenge_id, Challenge.category) \
+        .join(Challenge, Submission.challenge_id == Challenge.id)
+
+
+def _batch(after_id, limit):
+    """Submissions after after_id in id order, settled or not"""
+    return _rollup_rows().filter(Submission.id > after_id).order_by(Submission.id).limit(limit).all()
+
+
+def _settled_pending(limit):
+    """Pending submissions that have been verified or rejected since the mark passed them"""
+    return _rollup_rows().join(RollupPending, RollupPending.submission_id == Submission.id) \
+        .filter(Submission.status.in_(SETTLED)).order_by(Submission.id).limit(limit).all()
+
+
+def _sum_by(key_columns, values):
+    """Unique key rows and the column sums of values for each"""
+    keys, inverse = np.unique(np.column_stack(key_columns), axis=0, return_inverse=True)
+    totals = np.zeros((len(keys), values.shape[1]), dtype=np.int64)
+    np.add.at(totals, inverse.reshape(-1), values)
+    return keys, totals
+
+
+def aggregate(rows):
+    """Roll up settled submission rows: ([(day, challenge_id)], totals), ([(hour, category)], totals)
+
+    totals has one row of MEASURES per key.
+    """
+    _, submitted_at, statuses, points, challenge_ids, categories = zip(*rows)
+    submitted_at = np.array(submitted_at, dtype='datetime64[us]')
+    verified = np.array(statuses) == 'verified'
+    points = np.array([value or 0 for value in points], dtype=np.int64)
+    values = np.column_stack([verified, ~verified, np.where(verified, points, 0)]).astype(np.int64)
+
+    days = submitted_at.astype('datetime64[D]')
+    keys, daily = _sum_by([days.astype(np.int64), np.array(challenge_ids, dtype=np.int64)], values)
+    daily_keys = list(zip(keys[:, 0].astype('datetime64[D]').astype(object).tolist(), keys[:, 1].tolist()))
+
+    hours = submitted_at.astype('datetime64[h]')
+    names, codes = np.unique(np.array(categories, dtype=object), return_inverse=True)
+    keys, hourly = _sum_by([hours.astype(np.int64), codes.reshape(-1)], values)
+    hourly_keys = list(zip(keys[:, 0].astype('datetime64[h]').astype('datetime64[us]').astype(object).tolist(),
+                           names[keys[:, 1]].tolist()))
+    return (daily_keys, daily), (hourly_keys, hourly)
+
+
+def _add_totals(model, key_names, keys, totals):
+    """Add totals to the model's rows at keys, inserting the missing rows, in the caller's transaction"""
+    key_columns = [getattr(model, name) for name in key_names]
+    existing = {}
+    for start in range(0, len(keys), LOOKUP_CHUNK):
+        chunk = keys[start:start + LOOKUP_CHUNK]
+        for row in db.session.query(*key_columns, *[getattr(model, name) for name in MEASURES]) \
+                .filter(tuple_(*key_columns).in_(chunk)):
+            existing[tuple(row[:len(key_names)])] = row[len(key_names):]
+
+    inserts, updates = [], []
+    for key, values in zip(keys, totals.tolist()):
+        mapping = dict(zip(key_names, key))
+        if key in existing:
+            values = [old + new for old, new in zip(existing[key], values)]
+            updates.append(dict(mapping, **dict(zip(MEASURES, values))))
+        else:
+            inserts.append(dict(mapping, **dict(zip(MEASURES, values))))
+    if inserts:
+        db.session.execute(db.insert(model), inserts)
+    if updates:
+        db.session.execute(db.update(model), updates)
+
+
+def _add_rows(rows):
+    daily, hourly = aggregate(rows)
+    _add_totals(ChallengeDailyStat, ['day', 'challenge_id'], *daily)
+    _add_totals(CategoryHourlyStat, ['hour', 'category'], *hourly)
+
+
+def _mark():
+    query = db.session.query(RollupState.last_submission_id).filter(RollupState.name == STATE)
+    mark = query.scalar()
+    if mark is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(RollupState(name=STATE, last_submission_id=0))
+        except IntegrityError:
+            pass  # another runner created it first
+        mark = query.scalar()
+    return mark
+
+
+def _roll_up_pending(batch_size):
+    """Add the pending submissions settled since the mark passed them; returns how many"""
+    rolled, limit = 0, min(batch_size, LOOKUP_CHUNK)
+    while True:
+        rows = _settled_pending(limit)
+        if not rows:
+            return rolled
+        try:
+            _add_rows(rows)
+            # Only the runner that clears every id of the batch adds it
+            cleared = RollupPending.query.filter(RollupPending.submission_id.in_([row.id for row in rows])) \
+                .delete(synchronize_session=False)
+        except IntegrityError:
+            cleared = 0  # the other runner inserted the same new buckets first
+        if cleared != len(rows):
+            db.session.rollback()
+            return rolled
+        db.session.commit()
+        rolled += len(rows)
+        if len(rows) < limit:
+            return rolled
+
+
+def update_rollups(batch_size=BATCH_SIZE):
+    """Add the newly settled submissions to the rollups; returns how many"""
+    rolled = _roll_up_pending(batch_size)
+    while True:
+        mark = _mark()
+        rows = _batch(mark, batch_size)
+        if not rows:
+            db.session.commit()
+            return rolled
+        settled = [row for row in rows if row.status in SETTLED]
+        pending = [{'submission_id': row.id} for row in rows if row.status not in SETTLED]
+        try:
+            if settled:
+                _add_rows(settled)
+            if pending:
+                db.session.execute(db.insert(RollupPending), pending)
+            # Conditional, so a batch two runners read at once is only added by one of them
+            moved = RollupState.query.filter_by(name=STATE, last_submission_id=mark).update({
+                RollupState.last_submission_id: rows[-1].id,
+                RollupState.last_submitted_at: rows[-1].submitted_at,
+                RollupState.updated_at: datetime.utcnow(),
+            }, synchronize_session=False)
+        except IntegrityError:
+            moved = 0  # the other runner inserted the same new buckets first
+        if not moved:
+            db.session.rollback()
+            return rolled
+        db.session.commit()
+        rolled += len(settled)
+        if len(rows) < batch_size:
+            return rolled
+
+
+def rebuild():
+    """Recompute the rollups from every settled submission; returns how many were rolled up.
+
+    Until it finishes, the stats only cover the submissions recomputed so far.
+    """
+    ChallengeDailyStat.query.delete(synchronize_session=False)
+    CategoryHourlyStat.query.delete(synchronize_session=False)
+    RollupPending.query.delete(synchronize_session=False)
+    RollupState.query.filter_by(name=STATE).update(
+        {RollupState.last_submission_id: 0, RollupState.last_submitted_at: None}, synchronize_session=False)
+    return update_rollups(batch_size=REBUILD_BATCH_SIZE)
+
+
+# --- Reads, for the stats API: rollup tables only ---
+
+def _entry(entry, verified, rejected, points):
+    verified, rejected = verified or 0, rejected or 0
+    settled = verified + rejected
+    entry.update(verified=verified, rejected=rejected, points_awarded=points or 0,
+                 reject_rate=round(rejected / settled, 4) if settled else None)
+    return entry
+
+
+def rolled_up_to():
+    """submitted_at of the last submission read past, or None; some before it may still be pending"""
+    return db.session.query(RollupState.last_submitted_at).filter(RollupState.name == STATE).scalar()
+
+
+def daily_stats(days, challenge_id=None):
+    """Totals per day for the last `days` days, oldest first; one challenge's if challenge_id is given"""
+    since = (datetime.utcnow() - timedelta(days=days - 1)).date()
+    query = db.session.query(ChallengeDailyStat.day, func.sum(ChallengeDailyStat.verified),
+                             func.sum(ChallengeDailyStat.rejected), func.sum(ChallengeDailyStat.points_awarded)) \
+        .filter(ChallengeDailyStat.day >= since)
+    if challenge_id is not None:
+        query = query.filter(ChallengeDailyStat.challenge_id == challenge_id)
+    return [_entry({'day': day.isoformat()}, *totals)
+            for day, *totals in query.group_by(ChallengeDailyStat.day).order_by(ChallengeDailyStat.day)]
+
+
+def category_stats(hours):
+    """Totals per category over the last `hours` hours, most points first"""
+    since = datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=hours - 1)
+    points = func.sum(CategoryHourlyStat.points_awarded)
+    query = db.session.query(CategoryHourlyStat.category, func.sum(CategoryHourlyStat.verified),
+                             func.sum(CategoryHourlyStat.rejected), points) \
+        .filter(CategoryHourlyStat.hour >= since).group_by(CategoryHourlyStat.category) \
+        .order_by(points.desc(), CategoryHourlyStat.category)
+    return [_entry({'category': category}, *totals) for category, *totals in query]
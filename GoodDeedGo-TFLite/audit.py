@@ -0,0 +1,42 @@
+"""Bulk geofence audits over stored submissions.
+
+Submissions are read in keyset-ordered batches of bare columns (no ORM
+objects, no lazy challenge loads) and checked with one vectorized
+haversine per batch against each challenge's own geofence radius.
+"""
+import numpy as np
+
+from app import db
+from geo import check_geofences, DEFAULT_GEOFENCE_KM
+from models import Challenge, Submission
+
+AUDIT_BATCH_SIZE = 100_000
+
+
+def audit_submission_locations(status=None, batch_size=AUDIT_BATCH_SIZE):
+    """Yield (submission_ids, distances_km, within) arrays, one batch at a time"""
+    last_id = 0
+    while True:
+        query = db.session.query(
+            Submission.id,
+            Submission.user_location_lat,
+            Submission.user_location_lng,
+            Challenge.latitude,
+            Challenge.longitude,
+            Challenge.geofence_radius_km
+        ).join(Challenge, Submission.challenge_id == Challenge.id).filter(Submission.id > last_id)
+        if status is not None:
+            query = query.filter(Submission.status == status)
+
+        rows = query.order_by(Submission.id).limit(batch_size).all()
+        if not rows:
+            return
+
+        # Column-wise conversion is much faster than np.array over Row objects
+        columns = [np.array(column, dtype=np.float64) for column in zip(*rows)]
+        submission_ids = columns[0].astype(np.int64)
+        radii = np.where(np.isnan(columns[5]), DEFAULT_GEOFENCE_KM, columns[5])
+        distances, within = check_geofences(columns[1], columns[2], columns[3], columns[4], radii)
+        yield submission_ids, distances, within
+
+        last_id = int(submission_ids[-1])
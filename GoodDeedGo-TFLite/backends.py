@@ -0,0 +1,110 @@
+"""Registry of TFLite model backends.
+
+Each backend is one .tflite file plus what it takes to feed it: labels,
+input size, pixel scaling, thread count and whether the XNNPACK delegate
+is used. Quantized models (int8/uint8 inputs) are fed by quantizing the
+scaled pixels with the input tensor's own scale and zero point, and their
+outputs are dequantized the same way, so callers never see the difference.
+
+Only model.tflite ships with the repo. Converted variants are registered
+when their file sits beside it (model_float16.tflite, model_int8.tflite, as
+written by the TFLite converter), and a backend without its file falls back
+to float32. Which backend verifies a photo is chosen per challenge category:
+
+    TFLITE_BACKEND=int8
+    TFLITE_CATEGORY_BACKENDS="recycling=float32,planting=int8"
+"""
+import logging
+import os
+from collections import namedtuple
+
+import numpy as np
+
+MODEL_DIR = os.environ.get("TFLITE_MODEL_DIR", os.path.dirname(os.path.abspath(__file__)))
+
+LABELS = ('not_a_deed', 'planting', 'trash_pickup', 'recycling')
+
+ModelConfig = namedtuple('ModelConfig', ['name', 'filename', 'labels', 'input_size', 'pixel_scale', 'pixel_offset',
+                                         'num_threads', 'xnnpack'])
+ModelConfig.__new__.__defaults__ = (LABELS, (224, 224), 1 / 255.0, 0.0,
+                                    int(os.environ.get("TFLITE_NUM_THREADS", 2)),
+                                    os.environ.get("TFLITE_XNNPACK", "1") == "1")
+
+DEFAULT_BACKEND = os.environ.get("TFLITE_BACKEND", "float32")
+
+_registry = {}
+_warned = set()
+
+
+def register(config):
+    _registry[config.name] = config
+    return config
+
+
+# float16 models keep float32 inputs and outputs; only their weights are halved.
+# int8 models get their input quantization from the file itself.
+register(ModelConfig('float32', os.environ.get("TFLITE_MODEL_PATH", 'model.tflite')))
+for _name, _filename in [('float16', 'model_float16.tflite'), ('int8', 'model_int8.tflite')]:
+    if os.path.exists(os.path.join(MODEL_DIR, _filename)):
+        register(ModelConfig(_name, _filename))
+
+
+def model_path(config):
+    return os.path.join(MODEL_DIR, config.filename)
+
+
+def available():
+    """{name: ModelConfig} for every registered backend whose model file exists"""
+    return {name: config for name, config in _registry.items() if os.path.exists(model_path(config))}
+
+
+def get_config(name):
+    config = _registry.get(name)
+    if config is None:
+        raise KeyError(f"Unknown TFLite backend '{name}'")
+    return config
+
+
+def _parse_routes(spec):
+    routes = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        category, _, name = item.partition('=')
+        routes[category.strip()] = name.strip()
+    return routes
+
+
+CATEGORY_BACKENDS = _parse_routes(os.environ.get("TFLITE_CATEGORY_BACKENDS", ""))
+
+
+def backend_for(category=None):
+    """Name of the backend that verifies photos for a challenge category"""
+    name = CATEGORY_BACKENDS.get(category, DEFAULT_BACKEND)
+    if name in _registry and os.path.exists(model_path(_registry[name])):
+        return name
+    if name not in _warned:
+        _warned.add(name)
+        logging.warning(f"TFLite backend '{name}' is not available, falling back to float32")
+    return 'float32'
+
+
+def routed_backends():
+    """Names of every backend the current routing can pick"""
+    return sorted({backend_for(category) for category in [None, *CATEGORY_BACKENDS]})
+
+
+def quantize(pixels, dtype, quantization):
+    """Scaled float pixels as the input tensor's dtype, applying its (scale, zero_point)"""
+    scale, zero_point = quantization
+    if not np.issubdtype(dtype, np.integer):
+        return pixels.astype(dtype)
+    info = np.iinfo(dtype)
+    if not scale:  # no quantization parameters: the values are taken as they are
+        return np.clip(np.round(pixels), info.min, info.max).astype(dtype)
+    return np.clip(np.round(pixels / scale + zero_point), info.min, info.max).astype(dtype)
+
+
+def dequantize(values, quantization):
+    scale, zero_point = quantization
+    if not np.issubdtype(values.dtype, np.integer) or not scale:
+        return values.astype(np.float32)
+    return (values.astype(np.float32) - zero_point) * scale
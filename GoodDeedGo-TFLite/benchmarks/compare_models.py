@@ -0,0 +1,122 @@
+"""Compare TFLite backends on accuracy, latency and CPU per verification.
+
+    python benchmarks/compare_models.py --images path/to/photos [--backends float32,int8] [--xnnpack both]
+
+If the images directory has one sub-directory per label (planting/,
+recycling/, ...), accuracy is reported against those labels. Otherwise only
+agreement with the reference backend is reported. Timings are end to end
+(decode, preprocess, inference) because that is what a verification costs
+the worker.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backends  # noqa: E402
+import tflite  # noqa: E402
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif'}
+
+
+def load_dataset(directory):
+    """[(path, label or None)] from a flat directory or one sub-directory per label"""
+    dataset = []
+    for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+        if entry.is_dir():
+            dataset.extend((os.path.join(entry.path, name), entry.name) for name in sorted(os.listdir(entry.path))
+                           if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+        elif os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+            dataset.append((entry.path, None))
+    return dataset
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(name, paths, latency_samples):
+    engine = tflite.get_engine(name)
+    tflite.predict(paths[:1], name)  # warm up: first invoke allocates tensors
+
+    latencies = []
+    for path in paths[:latency_samples]:
+        started = time.perf_counter()
+        tflite.predict([path], name)
+        latencies.append(time.perf_counter() - started)
+
+    wall_started, cpu_started = time.perf_counter(), time.process_time()
+    results = tflite.predict(paths, name)
+    wall, cpu = time.perf_counter() - wall_started, time.process_time() - cpu_started
+
+    return results, {
+        'input_dtype': np.dtype(engine.input_details['dtype']).name,
+        'xnnpack': engine.config.xnnpack,
+        'model_kb': round(os.path.getsize(backends.model_path(engine.config)) / 1024, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'throughput_per_s': round(len(paths) / wall, 1),
+        'cpu_ms_per_image': round(cpu / len(paths) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', required=True, help='directory of photos, optionally one sub-directory per label')
+    parser.add_argument('--backends', help='comma-separated backend names (default: every available backend)')
+    parser.add_argument('--reference', default='float32', help='backend other backends are compared against')
+    parser.add_argument('--xnnpack', choices=['on', 'off', 'both'], default='on')
+    parser.add_argument('--latency-samples', type=int, default=50, help='images timed one at a time for p50/p95')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    dataset = load_dataset(args.images)
+    if not dataset:
+        parser.error(f"no images found in {args.images}")
+    paths = [path for path, _ in dataset]
+    labels = [label for _, label in dataset]
+    labelled = all(label is not None for label in labels)
+
+    names = args.backends.split(',') if args.backends else sorted(backends.available())
+    if args.reference not in names:
+        names.insert(0, args.reference)
+    if args.xnnpack != 'on':
+        for name in list(names):
+            variant = backends.register(backends.get_config(name)._replace(name=f"{name}-no-xnnpack", xnnpack=False))
+            names.insert(names.index(name) + 1, variant.name)
+            if args.xnnpack == 'off':
+                names.remove(name)
+
+    report = {'images': len(paths), 'labelled': labelled, 'reference': args.reference, 'backends': {}}
+    reference = None
+    for name in names:
+        results, stats = measure(name, paths, args.latency_samples)
+        ok = [(i, result) for i, result in enumerate(results) if not isinstance(result, Exception)]
+        stats['errors'] = len(results) - len(ok)
+        if labelled:
+            stats['accuracy'] = round(sum(result[0] == labels[i] for i, result in ok) / len(paths), 4)
+        if reference is None and name.split('-')[0] == args.reference:
+            reference = results
+        if reference is not None and reference is not results:
+            pairs = [(result, reference[i]) for i, result in ok if not isinstance(reference[i], Exception)]
+            stats['agreement'] = round(sum(ours[0] == theirs[0] for ours, theirs in pairs) / max(1, len(pairs)), 4)
+            stats['mean_abs_score_diff'] = round(float(np.mean([np.abs(ours[1] - theirs[1]).mean() for ours, theirs in pairs])), 5) if pairs else None
+        report['backends'][name] = stats
+        tflite.get_engine(name).shutdown()
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Startup benchmark: import time, memory and first-inference latency.
+
+Every probe runs in a fresh interpreter, so nothing is imported or cached
+beforehand, and is repeated to report medians:
+
+    python benchmarks/startup.py --repeat 5 [--image photo.jpg] [--output startup.json]
+
+Probes:
+    app          import main (Flask app, models and routes)
+    worker       import worker
+    inference    import tflite, build the engine, first and warm inference
+    preloaded    the same, with the model read into memory first (fork-shared mode)
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PRELUDE = """
+import json, os, resource, time
+_started = time.perf_counter()
+timings = {}
+def mark(name):
+    timings[name] = time.perf_counter() - _started
+IMAGE = os.environ['BENCH_IMAGE']
+"""
+
+EPILOGUE = """
+timings['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps(timings))
+"""
+
+INFERENCE = """
+import tflite
+mark('import_s')
+{preload}
+tflite.get_engine()
+mark('engine_ready_s')
+tflite.verify_challenge_completion(IMAGE)
+mark('first_inference_s')
+warm_started = time.perf_counter()
+tflite.verify_challenge_completion(IMAGE)
+timings['warm_inference_s'] = time.perf_counter() - warm_started
+"""
+
+PROBES = {
+    'app': "import main\nmark('import_s')",
+    'worker': "import worker\nmark('import_s')",
+    'inference': INFERENCE.format(preload=""),
+    'preloaded': INFERENCE.format(preload="tflite.preload()\nmark('preload_s')"),
+}
+
+
+def run_probe(code, env):
+    completed = subprocess.run([sys.executable, "-c", PRELUDE + code + EPILOGUE], cwd=ROOT, env=env,
+                               capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def sample_image(directory):
+    from PIL import Image
+    import numpy as np
+
+    path = os.path.join(directory, "sample.jpg")
+    pixels = (np.random.default_rng(0).random((1200, 900, 3)) * 255).astype(np.uint8)
+    Image.fromarray(pixels).save(path, quality=85)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--image', help='photo to run inference on (default: a generated JPEG)')
+    parser.add_argument('--probe', action='append', choices=sorted(PROBES), help='run only these probes')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        env = dict(os.environ,
+                   DATABASE_URL=os.environ.get("DATABASE_URL", f"sqlite:///{os.path.join(scratch, 'bench.db')}"),
+                   BENCH_IMAGE=args.image or sample_image(scratch))
+        results = {}
+        for name in args.probe or PROBES:
+            runs = [run_probe(PROBES[name], env) for _ in range(args.repeat)]
+            results[name] = {key: round(statistics.median(run[key] for run in runs), 4) for key in runs[0]}
+
+    report = json.dumps({'python': sys.version.split()[0], 'repeat': args.repeat, 'probes': results}, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""Bulk challenge import and export.
+
+A city's worth of challenges arrives as one file, so imports stream the
+file record by record and write in batches: one lookup of the batch's
+external ids, one multi-row INSERT for the new challenges and one
+executemany UPDATE for the known ones, then a commit. Bulk writes skip
+the mapper events that maintain Challenge.geohash, so each batch's
+geohashes are computed here, in one vectorized pass.
+
+Formats (picked by --format / ?format=, or the file extension):
+
+    csv      a header row naming the fields below
+    ndjson   one JSON object per line
+    geojson  a FeatureCollection of Point features, the other fields in properties
+
+Fields: external_id, title, description, category, points (a whole number,
+0 or more), latitude, longitude, geofence_radius_km, verification_prompt,
+is_active. A record whose external_id matches a challenge updates it, any
+other is inserted; records without an external_id are always inserted.
+Invalid records are skipped and reported. A file that cannot be parsed
+stops the import, but the batches before it stay committed, so fix the file
+and run it again.
+"""
+import csv
+import io
+import json
+import math
+import os
+from collections import namedtuple
+
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from cache import app_cache
+from geo import geohash_encode_array, DEFAULT_GEOFENCE_KM
+from models import Challenge, CHALLENGE_CATALOGUE
+
+BATCH_SIZE = int(os.environ.get("CHALLENGE_IMPORT_BATCH", 5000))
+EXPORT_BATCH = 1000
+MAX_REPORTED_ERRORS = 20
+
+FIELDS = ['external_id', 'title', 'description', 'category', 'points', 'latitude', 'longitude',
+          'geofence_radius_km', 'verification_prompt', 'is_active']
+REQUIRED = ['title', 'description', 'category', 'points', 'latitude', 'longitude', 'verification_prompt']
+EXTENSIONS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson', '.geojson': 'geojson', '.json': 'geojson'}
+MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson', 'geojson': 'application/geo+json'}
+TRUE = {'1', 'true', 'yes', 'y', 't'}
+FALSE = {'0', 'false', 'no', 'n', 'f'}
+
+ImportResult = namedtuple('ImportResult', ['inserted', 'updated', 'skipped', 'errors'])
+
+
+def format_for(filename='', mimetype=''):
+    """Format named by a file extension or content type, or None"""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in EXTENSIONS:
+        return EXTENSIONS[extension]
+    return next((fmt for fmt, known in MIMETYPES.items() if known == mimetype), None)
+
+
+# --- Readers: text stream in, one dict per record out, without loading the whole file ---
+
+def read_csv(stream):
+    reader = csv.DictReader(stream)
+    try:
+        for row in reader:
+            yield {field: value for field, value in row.items() if field}
+    except csv.Error as e:  # a NUL byte, an oversized field: the file cannot be read on
+        raise ValueError(f"line {reader.reader.line_num}: {e}") from None  # DictReader's own count lags a row
+
+
+def read_ndjson(stream):
+    for number, line in enumerate(stream, 1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"line {number}: {e}") from None
+
+
+def read_geojson(stream, chunk_size=64 * 1024):
+    """Features of a FeatureCollection, decoded one at a time as chunks of the file arrive"""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+
+    def more():
+        nonlocal buffer, position, eof
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+        return not eof
+
+    def next_char():
+        # First non-blank character at or after position, reading on as needed
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if not more():
+                raise ValueError("GeoJSON ended unexpectedly")
+
+    def expect(char):
+        nonlocal position
+        if next_char() != char:
+            raise ValueError(f"GeoJSON: expected '{char}' after \"features\"")
+        position += 1
+
+    while (found := buffer.find('"features"', position)) < 0:
+        position = max(0, len(buffer) - len('"features"'))
+        if not more():
+            raise ValueError('GeoJSON: no "features" array, expected a FeatureCollection')
+    position = found + len('"features"')
+    expect(':')
+    expect('[')
+    if next_char() == ']':
+        return
+    while True:
+        next_char()
+        try:
+            feature, end = decoder.raw_decode(buffer, position)
+        except ValueError as e:
+            if eof or not more():
+                raise ValueError(f"GeoJSON: {e}") from None
+            continue
+        position = end
+        yield _feature_record(feature)
+        separator = next_char()
+        position += 1
+        if separator == ']':
+            return
+        if separator != ',':
+            raise ValueError(f"GeoJSON: expected ',' or ']' between features, found '{separator}'")
+
+
+def _feature_record(feature):
+    record = dict(feature.get('properties') or {}) if isinstance(feature, dict) else {}
+    geometry = feature.get('geometry') if isinstance(feature, dict) else None
+    if isinstance(geometry, dict) and geometry.get('type') == 'Point' and len(geometry.get('coordinates') or ()) >= 2:
+        record['longitude'], record['latitude'] = geometry['coordinates'][:2]  # GeoJSON order is lng, lat
+    return record
+
+
+READERS = {'csv': read_csv, 'ndjson': read_ndjson, 'geojson': read_geojson}
+
+
+# --- Import ---
+
+def _text(record, field, max_length=None):
+    value = str(record[field]).strip()
+    if not value:
+        raise ValueError(f"{field} is empty")
+    if max_length and len(value) > max_length:
+        raise ValueError(f"{field} is longer than {max_length} characters")
+    return value
+
+
+def _number(record, field, low, high):
+    value = float(record[field])
+    if not math.isfinite(value) or not low <= value <= high:
+        raise ValueError(f"{field} {record[field]} is out of range")
+    return value
+
+
+def _points(record):
+    value = _number(record, 'points', 0, 2 ** 31 - 1)
+    if not value.is_integer():
+        raise ValueError(f"points {record['points']} is not a whole number")
+    return int(value)
+
+
+def _flag(value):
+    if value is None or value == '':
+        return True
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in TRUE or text in FALSE:
+        return text in TRUE
+    raise ValueError(f"is_active {value!r} is not true or false")
+
+
+def to_mapping(record):
+    """Column values for one record; raises ValueError naming the first bad field"""
+    if not isinstance(record, dict):
+        raise ValueError("not an object")
+    missing = [field for field in REQUIRED if record.get(field) is None or record.get(field) == '']
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    latitude = _number(record, 'latitude', -90, 90)
+    longitude = _number(record, 'longitude', -180, 180)
+    radius = record.get('geofence_radius_km')
+    external_id = record.get('external_id')
+    external_id = str(external_id).strip() if external_id is not None else ''
+    if len(external_id) > 100:
+        raise ValueError("external_id is longer than 100 characters")
+    return {
+        'external_id': external_id or None,
+        'title': _text(record, 'title', 100),
+        'description': _text(record, 'description'),
+        'category': _text(record, 'category', 50),
+        'points': _points(record),
+        'latitude': latitude,
+        'longitude': longitude,
+        'geofence_radius_km': DEFAULT_GEOFENCE_KM if radius is None or radius == '' else _number(record, 'geofence_radius_km', 0, 20000),
+        'verification_prompt': _text(record, 'verification_prompt'),
+        'is_active': _flag(record.get('is_active')),
+    }
+
+
+def _write_batch(batch):
+    """Insert or update one batch in a single transaction; returns (inserted, updated)"""
+    try:
+        return _write(batch)
+    except IntegrityError:
+        # A concurrent import inserted some of these external ids first: they are updates now
+        db.session.rollback()
+        return _write(batch)
+
+
+def _write(batch):
+    geohashes = geohash_encode_array([mapping['latitude'] for mapping in batch], [mapping['longitude'] for mapping in batch])
+    keyed = {}
+    inserts = []
+    for mapping, geohash in zip(batch, geohashes):
+        mapping['geohash'] = geohash
+        if mapping['external_id'] is None:
+            inserts.append(mapping)
+        else:
+            keyed[mapping['external_id']] = mapping  # the last record wins when a file repeats an id
+    existing = dict(db.session.query(Challenge.external_id, Challenge.id).filter(Challenge.external_id.in_(list(keyed))))
+    updates = [dict(mapping, id=existing[external_id]) for external_id, mapping in keyed.items() if external_id in existing]
+    inserts += [mapping for external_id, mapping in keyed.items() if external_id not in existing]
+    if inserts:
+        db.session.execute(db.insert(Challenge), inserts)
+    if updates:
+        db.session.execute(db.update(Challenge), updates)
+    db.session.commit()
+    return len(inserts), len(updates)
+
+
+def import_records(records, batch_size=BATCH_SIZE):
+    """Insert or update (by external_id) challenges from an iterable of dicts"""
+    inserted = updated = skipped = 0
+    errors = []
+    batch = []
+    try:
+        for number, record in enumerate(records, 1):
+            try:
+                batch.append(to_mapping(record))
+            except (ValueError, TypeError) as e:
+                skipped += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append(f"record {number}: {e}")
+                continue
+            if len(batch) >= batch_size:
+                written = _write_batch(batch)
+                inserted, updated = inserted + written[0], updated + written[1]
+                batch = []
+        if batch:
+            written = _write_batch(batch)
+            inserted, updated = inserted + written[0], updated + written[1]
+    finally:
+        if inserted or updated:
+            app_cache.bump(CHALLENGE_CATALOGUE)  # bulk writes skip the events that usually do this
+    return ImportResult(inserted, updated, skipped, errors)
+
+
+def import_file(stream, fmt, batch_size=BATCH_SIZE):
+    """Import a text stream in one of READERS' formats"""
+    return import_records(READERS[fmt](stream), batch_size)
+
+
+# --- Export: records out, as chunks of text, reading the table in batches ---
+
+def export_records():
+    columns = [getattr(Challenge, field) for field in FIELDS]
+    for row in db.session.query(Challenge.id, *columns).order_by(Challenge.id).yield_per(EXPORT_BATCH):
+        yield dict(zip(['id', *FIELDS], row))
+
+
+def write_csv(records):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=['id', *FIELDS])
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def write_ndjson(records):
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+
+def write_geojson(records):
+    yield '{"type": "FeatureCollection", "features": [\n'
+    separator = ''
+    for record in records:
+        coordinates = [record.pop('longitude'), record.pop('latitude')]
+        feature = {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': coordinates}, 'properties': record}
+        yield separator + json.dumps(feature)
+        separator = ',\n'
+    yield '\n]}\n'
+
+
+WRITERS = {'csv': write_csv, 'ndjson': write_ndjson, 'geojson': write_geojson}
+
+
+def export(fmt):
+    """Every challenge, as chunks of text in one of WRITERS' formats"""
+    return WRITERS[fmt](export_records())
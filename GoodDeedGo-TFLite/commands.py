@@ -0,0 +1,239 @@
+"""Maintenance commands, run with `flask --app main <command>`"""
+import logging
+
+import click
+
+from app import app, db
+from models import Challenge
+
+DEFAULT_CHALLENGES = [
+    {
+        'title': 'Recycling Selfie',
+        'description': 'Take a selfie while throwing trash in a recycling bin near this park.',
+        'category': 'recycling',
+        'points': 10,
+        'latitude': 40.7831,
+        'longitude': -73.9712,
+        'verification_prompt': 'Is this person taking a selfie while recycling or near a recycling bin?'
+    },
+    {
+        'title': 'Support Local Women-Led Business',
+        'description': 'Find a local women-led business and write a positive review.',
+        'category': 'community',
+        'points': 15,
+        'latitude': 40.7589,
+        'longitude': -73.9851,
+        'verification_prompt': 'Does this image show someone at or near a local business?'
+    },
+    {
+        'title': 'Climate Awareness Mural',
+        'description': 'Visit a mural related to climate awareness and share its story.',
+        'category': 'environment',
+        'points': 20,
+        'latitude': 40.7505,
+        'longitude': -73.9934,
+        'verification_prompt': 'Does this image show a climate or environmental awareness mural or artwork?'
+    },
+    {
+        'title': 'Community Garden Volunteer',
+        'description': 'Help at a community garden and document your contribution.',
+        'category': 'environment',
+        'points': 25,
+        'latitude': 40.7614,
+        'longitude': -73.9776,
+        'verification_prompt': 'Does this image show someone working in or helping with a community garden?'
+    },
+    {
+        'title': 'Public Transport Check-in',
+        'description': 'Use public transportation and share your eco-friendly choice.',
+        'category': 'transport',
+        'points': 8,
+        'latitude': 40.7527,
+        'longitude': -73.9772,
+        'verification_prompt': 'Does this image show someone using public transportation (bus, subway, train)?'
+    }
+]
+
+
+def init_db(seed=True):
+    """Create or upgrade the schema and, on an empty database, add the default challenges"""
+    from migrations import upgrade
+    upgrade()
+    if seed and Challenge.query.count() == 0:
+        from challenge_io import import_records
+        import_records(DEFAULT_CHALLENGES)
+        logging.info("Default challenges created")
+
+
+@app.cli.command('init-db')
+@click.option('--seed/--no-seed', default=True, help='Add the default challenges to an empty database.')
+def init_db_command(seed):
+    """Create the database tables (run once per deploy, not on every worker boot)."""
+    init_db(seed=seed)
+    click.echo("Database initialised")
+
+
+@app.cli.command('import-challenges')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson', 'geojson']), default=None, help='Default: from the file extension.')
+@click.option('--batch-size', type=int, default=None, help='Challenges written per transaction. Default: CHALLENGE_IMPORT_BATCH (5000).')
+def import_challenges(path, fmt, batch_size):
+    """Insert challenges from a CSV, NDJSON or GeoJSON file, updating those whose external_id exists."""
+    import time
+    import challenge_io
+
+    fmt = fmt or challenge_io.format_for(path)
+    if fmt is None:
+        raise click.UsageError("Cannot tell the format from the file name; pass --format.")
+    started = time.perf_counter()
+    with click.open_file(path, encoding='utf-8') as stream:
+        try:
+            result = challenge_io.import_file(stream, fmt, batch_size or challenge_io.BATCH_SIZE)
+        except ValueError as e:
+            raise click.ClickException(f"{e} (batches before this point were imported)")
+    for error in result.errors:
+        click.echo(f"skipped {error}", err=True)
+    click.echo(f"Imported challenges in {time.perf_counter() - started:.1f}s: {result.inserted} inserted, "
+               f"{result.updated} updated, {result.skipped} skipped")
+
+
+@app.cli.command('export-challenges')
+@click.argument('path', type=click.Path(dir_okay=False, allow_dash=True), default='-')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson', 'geojson']), default=None, help='Default: from the file extension, else ndjson.')
+def export_challenges(path, fmt):
+    """Write every challenge to a file (default: stdout) that import-challenges reads back."""
+    import challenge_io
+
+    fmt = fmt or challenge_io.format_for(path) or 'ndjson'
+    with click.open_file(path, 'w', encoding='utf-8') as out:
+        for chunk in challenge_io.export(fmt):
+            out.write(chunk)
+
+
+@app.cli.command('check-indexes')
+@click.option('--verbose', is_flag=True, help='Print the plan of every query, not just the failing ones.')
+def check_indexes_command(verbose):
+    """EXPLAIN the hot queries and exit 1 if any of them scans a whole table or misses its index."""
+    from migrations import check_indexes
+
+    failures = 0
+    for name, lines, problems in check_indexes():
+        click.echo(f"{'FAIL' if problems else 'ok':4}  {name}")
+        for problem in problems:
+            click.echo(f"      ! {problem}")
+        if problems or verbose:
+            for line in lines:
+                click.echo(f"      {line}")
+        failures += bool(problems)
+    if failures:
+        raise SystemExit(f"{failures} hot quer{'y' if failures == 1 else 'ies'} not served by their index")
+
+
+@app.cli.command('reconcile-completions')
+def reconcile_completions():
+    """Recount Challenge.verified_completions from verified submissions."""
+    fixed = Challenge.reconcile_completion_counts()
+    click.echo(f"Reconciled completion counts, {fixed} challenge(s) corrected")
+
+
+@app.cli.command('reevaluate-achievements')
+@click.option('--rebuild-stats/--no-rebuild-stats', default=True, help='Recount per-category completions from verified submissions first.')
+@click.option('--batch-size', default=1000, show_default=True, help='Users evaluated per transaction.')
+def reevaluate_achievements(rebuild_stats, batch_size):
+    """Award every achievement rule to the users who already qualify, e.g. after adding a rule."""
+    from achievements import reevaluate_all
+    from models import UserCategoryStat
+
+    if rebuild_stats:
+        rows = UserCategoryStat.rebuild()
+        click.echo(f"Rebuilt {rows} category counter(s)")
+    awarded = reevaluate_all(batch_size=batch_size)
+    click.echo(f"Awarded {awarded} achievement(s)")
+
+
+@app.cli.command('prune-users')
+@click.option('--idle-days', default=30, show_default=True, help='Remove zero-point users with no submission for this many days.')
+def prune_users(idle_days):
+    """Delete dormant zero-point users along with their submissions, releasing their photos."""
+    from models import User
+
+    removed = User.prune_dormant(idle_days)
+    click.echo(f"Removed {removed} dormant user(s)")
+
+
+@app.cli.command('collect-garbage')
+def collect_garbage():
+    """Release old rejected submissions' photos and delete unreferenced ones from the image store."""
+    import storage
+
+    released, deleted = storage.collect_garbage()
+    click.echo(f"Released {released} rejected submission photo(s), deleted {deleted} unreferenced photo(s)")
+
+
+@app.cli.command('reconcile-images')
+def reconcile_images():
+    """Recount StoredImage references from submissions."""
+    from models import StoredImage
+
+    fixed = StoredImage.reconcile_ref_counts()
+    click.echo(f"Reconciled image references, {fixed} image(s) corrected")
+
+
+@app.cli.command('rollup-stats')
+@click.option('--rebuild', is_flag=True, help='Recompute the rollups from every submission instead of from the high-water mark.')
+def rollup_stats(rebuild):
+    """Add newly settled submissions to the analytics rollups (the worker also does this periodically)."""
+    import time
+    import analytics
+
+    started = time.perf_counter()
+    rolled = analytics.rebuild() if rebuild else analytics.update_rollups()
+    click.echo(f"Rolled up {rolled} submission(s) in {time.perf_counter() - started:.1f}s, "
+               f"up to submissions made at {analytics.rolled_up_to() or 'the start'}")
+
+
+@app.cli.command('audit-locations')
+@click.option('--status', default=None, help='Only audit submissions with this status, e.g. verified.')
+@click.option('--output', type=click.Path(dir_okay=False), default=None, help='Write submissions outside their geofence to this CSV file.')
+def audit_locations(status, output):
+    """Re-check every submission's location against its challenge geofence."""
+    import csv
+    import time
+    from audit import audit_submission_locations
+
+    started = time.perf_counter()
+    total = outside = 0
+    writer = None
+    out_file = open(output, 'w', newline='') if output else None
+    try:
+        if out_file:
+            writer = csv.writer(out_file)
+            writer.writerow(['submission_id', 'distance_km'])
+        for submission_ids, distances, within in audit_submission_locations(status=status):
+            total += len(submission_ids)
+            outside += int((~within).sum())
+            if writer:
+                writer.writerows(zip(submission_ids[~within].tolist(), distances[~within].round(3).tolist()))
+    finally:
+        if out_file:
+            out_file.close()
+
+    click.echo(f"Audited {total} submission(s) in {time.perf_counter() - started:.1f}s, {outside} outside their geofence")
+
+
+@app.cli.command('find-duplicates')
+@click.option('--min-users', default=2, show_default=True, help='Report photos submitted by at least this many users.')
+def find_duplicates(min_users):
+    """List photos (by content hash) submitted from more than one account."""
+    from sqlalchemy import func
+    from models import Submission
+
+    duplicates = db.session.query(Submission.image_sha256, func.count(func.distinct(Submission.user_id)), func.count(Submission.id)) \
+        .filter(Submission.image_sha256.isnot(None)) \
+        .group_by(Submission.image_sha256) \
+        .having(func.count(func.distinct(Submission.user_id)) >= min_users) \
+        .order_by(func.count(func.distinct(Submission.user_id)).desc()) \
+        .all()
+    for sha256, users, submissions in duplicates:
+        click.echo(f"{sha256}  {users} user(s)  {submissions} submission(s)")
+    click.echo(f"{len(duplicates)} photo(s) shared across accounts")
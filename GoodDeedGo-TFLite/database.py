@@ -0,0 +1,91 @@
+"""Database engine profile for the two supported deployments.
+
+SQLite (single node): every connection switches to WAL, so the web server
+and the verification worker read while the other writes, and waits on a
+lock for DB_BUSY_TIMEOUT_MS instead of failing with "database is locked".
+synchronous=NORMAL is safe under WAL (a power cut can lose the last
+commits, never corrupt the file).
+
+Postgres (psycopg2): a bounded pool per process. Every web worker, the
+verification worker and each of its pool processes hold their own pool, so
+keep  processes x (DB_POOL_SIZE + DB_MAX_OVERFLOW)  under max_connections.
+
+SQLite plans queries without table statistics (nothing runs ANALYZE), so it
+rates every equality as selective. Wrap a filter that most rows pass in
+Unselective() where the same query has a narrower index to use.
+"""
+import os
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ColumnElement
+from sqlalchemy.sql.visitors import InternalTraversal
+from sqlalchemy.types import Boolean
+
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 5))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 300))
+BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", 5000))
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    'busy_timeout': BUSY_TIMEOUT_MS,
+    'cache_size': -1024 * int(os.environ.get("SQLITE_CACHE_MB", 64)),  # negative: KiB rather than pages
+    'mmap_size': 1024 * 1024 * int(os.environ.get("SQLITE_MMAP_MB", 256)),
+    'temp_store': 'MEMORY',
+}
+
+
+def engine_options(url):
+    """SQLALCHEMY_ENGINE_OPTIONS for a database URL"""
+    if url.startswith('sqlite'):
+        # The default pool for file databases keeps one connection per thread; only the busy timeout needs setting
+        return {'connect_args': {'timeout': BUSY_TIMEOUT_MS / 1000}}
+    return {
+        'pool_size': POOL_SIZE,
+        'max_overflow': MAX_OVERFLOW,
+        'pool_timeout': POOL_TIMEOUT,
+        'pool_recycle': POOL_RECYCLE,
+        'pool_pre_ping': True,
+    }
+
+
+@event.listens_for(Engine, 'connect')
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    if type(dbapi_connection).__module__.split('.')[0] not in ('sqlite3', 'pysqlite2'):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+class Unselective(ColumnElement):
+    """A filter most rows pass, such as status = 'verified'.
+
+    On SQLite it is wrapped in likely(), which changes nothing but the
+    planner's estimate, so an index that only matches on it loses to one
+    the rest of the query matches as well. A partial index whose WHERE is
+    this filter is preferred. Other databases keep statistics and get the
+    filter as it is.
+    """
+    inherit_cache = True
+    _traverse_internals = [('clause', InternalTraversal.dp_clauseelement)]
+    type = Boolean()
+    _is_implicitly_boolean = True  # a comparison already: no "= 1" after it where booleans are integers
+
+    def __init__(self, clause):
+        self.clause = clause
+
+
+@compiles(Unselective)
+def _unselective(element, compiler, **kw):
+    return compiler.process(element.clause, **kw)
+
+
+@compiles(Unselective, 'sqlite')
+def _unselective_sqlite(element, compiler, **kw):
+    return f"likely({compiler.process(element.clause, **kw)})"
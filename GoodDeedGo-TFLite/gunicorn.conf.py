@@ -0,0 +1,16 @@
+"""Gunicorn settings, used with `gunicorn -c gunicorn.conf.py main:app`"""
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+
+# Import the app once in the master and fork workers from it: they share the
+# imported modules copy-on-write and boot without re-importing anything
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+
+def post_fork(server, worker):
+    # Connections the master may have opened while importing must not be shared between workers
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
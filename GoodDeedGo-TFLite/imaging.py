@@ -0,0 +1,107 @@
+"""Upload ingestion: decode once, write once.
+
+An upload is decoded a single time, straight from the request stream. For
+JPEGs Pillow's draft mode lets the decoder scale down by a power of two
+while decoding, so a 12MP phone photo is never fully decoded just to be
+shrunk to 1024px, and the upload hits the disk exactly once: either the
+original bytes (already small enough) or the resized derivative.
+Ingestion also fingerprints the upload (SHA-256 of the bytes and a 64-bit
+perceptual hash) for the verification cache.
+
+The model input is not made here: the verification worker decodes the
+stored photo itself (load_model_input), in its own process and at reduced
+scale, so the request path never pays for it.
+"""
+import hashlib
+import shutil
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image
+
+from metrics import timer
+
+STORED_MAX_SIZE = (1024, 1024)
+MODEL_INPUT_SIZE = (224, 224)
+JPEG_QUALITY = 85
+
+PHASH_SIZE = 32  # pHash works on a 32x32 grayscale thumbnail...
+PHASH_BITS = 8  # ...keeping the 8x8 lowest DCT frequencies
+
+IngestedImage = namedtuple('IngestedImage', ['path', 'width', 'height', 'format', 'sha256', 'phash'])
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+_DCT = _dct_matrix(PHASH_SIZE)
+
+
+def perceptual_hash(img):
+    """64-bit DCT perceptual hash as 16 hex digits; similar images differ in few bits"""
+    pixels = np.asarray(img.convert("L").resize((PHASH_SIZE, PHASH_SIZE), Image.Resampling.LANCZOS), dtype=np.float64)
+    low_frequencies = (_DCT @ pixels @ _DCT.T)[:PHASH_BITS, :PHASH_BITS].flatten()
+    # The DC term only reflects overall brightness, so leave it out of the median
+    bits = low_frequencies > np.median(low_frequencies[1:])
+    return np.packbits(bits).tobytes().hex()
+
+
+def content_hash(stream):
+    """SHA-256 of a seekable stream's bytes, leaving the stream rewound"""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(1 << 16), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def to_model_input(img, size=MODEL_INPUT_SIZE):
+    """(224, 224, 3) uint8 RGB array for the classifier"""
+    return np.asarray(img.convert("RGB").resize(size), dtype=np.uint8)
+
+
+def ingest_upload(stream, dest_path, sha256=None):
+    """Decode an uploaded image once and store it (resized if needed) at dest_path"""
+    with timer('image_decode'):
+        sha256 = sha256 or content_hash(stream)
+        img = Image.open(stream)
+        image_format = img.format
+        if image_format == 'JPEG':
+            # Decode at the smallest power-of-two scale that still covers STORED_MAX_SIZE
+            img.draft('RGB', STORED_MAX_SIZE)
+        img.load()
+
+    with img:
+        if img.width > STORED_MAX_SIZE[0] or img.height > STORED_MAX_SIZE[1]:
+            with timer('image_resize'):
+                derivative = img.copy()
+                derivative.thumbnail(STORED_MAX_SIZE, Image.Resampling.LANCZOS)
+                if image_format == 'JPEG' and derivative.mode not in ('RGB', 'L'):
+                    derivative = derivative.convert('RGB')
+            with timer('upload_save'):
+                derivative.save(dest_path, format=image_format, optimize=True, quality=JPEG_QUALITY)
+        else:
+            # Already small enough: keep the original bytes, no re-encode
+            derivative = img
+            with timer('upload_save'):
+                stream.seek(0)
+                with open(dest_path, 'wb') as out:
+                    shutil.copyfileobj(stream, out)
+
+        with timer('image_fingerprint'):
+            phash = perceptual_hash(derivative)
+        return IngestedImage(dest_path, derivative.width, derivative.height, image_format, sha256, phash)
+
+
+def load_model_input(photo_path, size=MODEL_INPUT_SIZE):
+    """Model input for a stored image, decoding JPEGs at reduced scale"""
+    with Image.open(photo_path) as img:
+        if img.format == 'JPEG':
+            img.draft('RGB', size)
+        return to_model_input(img, size)
@@ -0,0 +1,144 @@
+"""Leaderboards served from memory.
+
+The global board is the rank service's index itself. Per-category boards
+and this week's board are RankIndex instances built from verified
+submissions, refreshed in place: every few seconds the users with newly
+verified submissions have their board scores recomputed, so page views only
+read sorted lists and never query the database at steady state.
+"""
+import os
+import threading
+import time
+from collections import namedtuple, defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from app import db
+from database import Unselective
+from models import Challenge, Submission
+from ranking import RankIndex, rank_service, SYNC_INTERVAL, FULL_RELOAD_INTERVAL, SYNC_OVERLAP
+
+TOP_K = int(os.environ.get("LEADERBOARD_SIZE", 20))
+
+GLOBAL_BOARD = 'global'
+WEEKLY_BOARD = 'weekly'
+
+LeaderboardEntry = namedtuple('LeaderboardEntry', ['rank', 'id', 'username', 'level', 'total_points'])
+
+
+def week_start(now=None):
+    """Monday 00:00 (UTC) of the current week"""
+    now = now or datetime.utcnow()
+    return datetime(now.year, now.month, now.day) - timedelta(days=now.weekday())
+
+
+def board_queries(since_week, user_ids=None):
+    """(per-category points, weekly points) of verified submissions, for every user or only user_ids"""
+    verified = Submission.status == 'verified'
+    if user_ids is not None:
+        # A few users' rows: search their verified submissions, not every one by status
+        verified = Unselective(verified)
+    by_category = db.session.query(Submission.user_id, Challenge.category, func.sum(Submission.points_awarded)) \
+        .join(Challenge, Submission.challenge_id == Challenge.id) \
+        .filter(verified)
+    weekly = db.session.query(Submission.user_id, func.sum(Submission.points_awarded)) \
+        .filter(verified, Submission.verified_at >= since_week)
+    if user_ids is not None:
+        by_category = by_category.filter(Submission.user_id.in_(user_ids))
+        weekly = weekly.filter(Submission.user_id.in_(user_ids))
+    return by_category.group_by(Submission.user_id, Challenge.category), weekly.group_by(Submission.user_id)
+
+
+class LeaderboardService:
+    def __init__(self):
+        self.boards = {}
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._synced_at = None
+        self._high_water = None
+        self._week_start = None
+
+    def _ensure_fresh(self):
+        now = time.monotonic()
+        if self._synced_at is not None and now - self._synced_at < SYNC_INTERVAL:
+            return
+        with self._lock:
+            if self._synced_at is not None and now - self._synced_at < SYNC_INTERVAL:
+                return
+            if (self._loaded_at is None or now - self._loaded_at > FULL_RELOAD_INTERVAL
+                    or self._week_start != week_start()):
+                self._reload()
+                self._loaded_at = now
+            else:
+                self._sync()
+            self._synced_at = now
+
+    def _board_scores(self, user_ids=None):
+        """{board: {user_id: points}} for category and weekly boards"""
+        scores = defaultdict(dict)
+        by_category, weekly = board_queries(self._week_start, user_ids)
+        for user_id, category, points in by_category:
+            scores[category][user_id] = points
+        for user_id, points in weekly:
+            scores[WEEKLY_BOARD][user_id] = points
+        return scores
+
+    def _reload(self):
+        self._high_water = datetime.utcnow()
+        self._week_start = week_start()
+        boards = {}
+        for board, board_scores in self._board_scores().items():
+            boards[board] = RankIndex()
+            boards[board].load((user_id, points) for user_id, points in board_scores.items() if points)
+        boards.setdefault(WEEKLY_BOARD, RankIndex())
+        self.boards = boards
+
+    def _sync(self):
+        since = self._high_water - SYNC_OVERLAP
+        self._high_water = datetime.utcnow()
+        # Deduplicated here: DISTINCT would tempt the planner into walking a user_id index end to end
+        user_ids = list({user_id for user_id, in db.session.query(Submission.user_id).filter(Submission.verified_at > since)})
+        if not user_ids:
+            return
+
+        scores = self._board_scores(user_ids)
+        for board in set(self.boards) | set(scores):
+            index = self.boards.setdefault(board, RankIndex())
+            for user_id in user_ids:
+                points = scores.get(board, {}).get(user_id)
+                if points:
+                    index.update(user_id, points)
+                else:
+                    index.remove(user_id)
+
+    def record_award(self, user_id, category, points):
+        """Apply a just-committed award to this process's boards in place"""
+        if self._loaded_at is None:
+            return  # nothing loaded here yet; the first read builds the boards from the database
+        for board in (category, WEEKLY_BOARD):
+            index = self.boards.setdefault(board, RankIndex())
+            index.update(user_id, (index.score(user_id) or 0) + points)
+
+    def board_names(self):
+        self._ensure_fresh()
+        return [GLOBAL_BOARD, WEEKLY_BOARD] + sorted(board for board in self.boards if board != WEEKLY_BOARD)
+
+    def top(self, board=GLOBAL_BOARD, n=TOP_K):
+        """[LeaderboardEntry] for the n best users on a board"""
+        if board == GLOBAL_BOARD:
+            ranked = rank_service.top(n)
+        else:
+            self._ensure_fresh()
+            rank_service.refresh()
+            index = self.boards.get(board)
+            ranked = index.top(n) if index is not None else []
+
+        entries = []
+        for rank, user_id, points in ranked:
+            username, level = rank_service.profile(user_id)
+            entries.append(LeaderboardEntry(rank, user_id, username, level, points))
+        return entries
+
+
+leaderboard_service = LeaderboardService()
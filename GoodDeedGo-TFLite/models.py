@@ -1,13 +1,26 @@
+import pickle
 from app import db
-from datetime import datetime
-from sqlalchemy import func
+from datetime import datetime, timedelta
+from sqlalchemy import func, event, or_, and_, case, text, tuple_
+from sqlalchemy.orm import Session, object_session, joinedload
+from cache import app_cache
+from geo import haversine_km, geohash_encode, covering_cells, prefix_upper_bound, DEFAULT_GEOFENCE_KM
+
+LEVELS = [('Gold', 200), ('Silver', 100)]  # minimum points, highest first; Bronze below
+
+def level_for(points):
+    """SQL expression for the level that a total_points expression earns"""
+    return case(*[(points >= minimum, level) for level, minimum in LEVELS], else_='Bronze')
 
 class User(db.Model):
+    is_anonymous = False
+    
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    total_points = db.Column(db.Integer, default=0)
+    total_points = db.Column(db.Integer, default=0, index=True)
     level = db.Column(db.String(20), default='Bronze')  # Bronze, Silver, Gold
+    points_updated_at = db.Column(db.DateTime, index=True)  # lets the rank service pick up point changes
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
@@ -15,28 +28,98 @@ class User(db.Model):
     
     def update_level(self):
         """Update user level based on total points"""
-        if self.total_points >= 200:
-            self.level = 'Gold'
-        elif self.total_points >= 100:
-            self.level = 'Silver'
-        else:
-            self.level = 'Bronze'
+        self.level = next((level for level, minimum in LEVELS if self.total_points >= minimum), 'Bronze')
+    
+    @classmethod
+    def award_points(cls, user_id, points):
+        """Add points (and move the level along) in one UPDATE in the caller's transaction.
+        
+        The database adds to whatever total is current when the row is written, so
+        concurrent awards for the same user never overwrite each other.
+        """
+        new_total = func.coalesce(cls.total_points, 0) + points
+        cls.query.filter_by(id=user_id).update({
+            cls.total_points: new_total,
+            cls.level: level_for(new_total),
+            cls.points_updated_at: datetime.utcnow(),
+        }, synchronize_session=False)
     
     def get_rank(self):
         """Get user's rank among all users"""
-        users_above = User.query.filter(User.total_points > self.total_points).count()
-        return users_above + 1
+        from ranking import rank_service
+        return rank_service.get_rank(self.total_points)
+    
+    def get_neighbors(self, size=2):
+        """Users ranked just above and below this one as (rank, user_id, points)"""
+        from ranking import rank_service
+        return rank_service.around(self.id, self.total_points, size)
+    
+    @classmethod
+    def prune_dormant(cls, idle_days, batch_size=1000):
+        """Delete zero-point users with no submission in the last idle_days, with their
+        submissions, releasing their photos; returns how many users were removed"""
+        cutoff = datetime.utcnow() - timedelta(days=idle_days)
+        active = db.session.query(Submission.id).filter(
+            Submission.user_id == cls.id,
+            or_(Submission.submitted_at >= cutoff, Submission.status.in_(('pending', 'processing'))))
+        dormant = db.session.query(cls.id).filter(
+            or_(cls.total_points == 0, cls.total_points.is_(None)), cls.created_at < cutoff, ~active.exists())
+        
+        removed = 0
+        while True:
+            user_ids = [user_id for (user_id,) in dormant.order_by(cls.id).limit(batch_size)]
+            if not user_ids:
+                return removed
+            # The files go when storage.collect_garbage finds them unreferenced
+            StoredImage.release(StoredImage.references(Submission.user_id.in_(user_ids)))
+            for model in (Achievement, UserCategoryStat, Submission):
+                model.query.filter(model.user_id.in_(user_ids)).delete(synchronize_session=False)
+            cls.query.filter(cls.id.in_(user_ids)).delete(synchronize_session=False)
+            db.session.commit()
+            removed += len(user_ids)
+
+class AnonymousUser:
+    """Stand-in for visitors without a user row; one is only created on their first submission"""
+    is_anonymous = True
+    id = None
+    username = 'Guest'
+    email = None
+    total_points = 0
+    level = 'Bronze'
+    points_updated_at = None
+    created_at = None
+    submissions = ()
+    achievements = ()
+    
+    def get_rank(self):
+        """Where a new user would rank"""
+        from ranking import rank_service
+        return rank_service.get_rank(0)
+    
+    def get_neighbors(self, size=2):
+        return []
+
+CHALLENGE_CATALOGUE = 'challenges'  # cache namespace, bumped whenever a challenge is written
 
 class Challenge(db.Model):
+    __table_args__ = (
+        db.Index('ix_challenge_active_category', 'is_active', 'category'),  # the catalogue and category pages
+        db.UniqueConstraint('external_id', name='uq_challenge_external_id'),  # upsert key for bulk imports
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
+    external_id = db.Column(db.String(100))  # the id in the source a challenge was imported from
     title = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text, nullable=False)
     category = db.Column(db.String(50), nullable=False)  # recycling, community, environment, transport
     points = db.Column(db.Integer, nullable=False)
     latitude = db.Column(db.Float, nullable=False)
     longitude = db.Column(db.Float, nullable=False)
+    geohash = db.Column(db.String(12), index=True)  # kept in sync with latitude/longitude on save
+    geofence_radius_km = db.Column(db.Float, nullable=False, default=DEFAULT_GEOFENCE_KM, server_default=str(DEFAULT_GEOFENCE_KM))
     verification_prompt = db.Column(db.Text, nullable=False)
     is_active = db.Column(db.Boolean, default=True)
+    verified_completions = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # denormalized, see record_completion
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
@@ -44,40 +127,183 @@ class Challenge(db.Model):
     
     def get_completion_count(self):
         """Get number of verified completions"""
-        return Submission.query.filter_by(challenge_id=self.id, status='verified').count()
+        return self.verified_completions or 0
+    
+    @classmethod
+    def record_completion(cls, challenge_id):
+        """Increment the completion counter in the caller's transaction"""
+        cls.query.filter_by(id=challenge_id).update(
+            {cls.verified_completions: cls.verified_completions + 1}, synchronize_session=False)
+    
+    @classmethod
+    def catalogue(cls, category=None):
+        """Active challenges (optionally of one category) from the application cache, attached to this session"""
+        key = app_cache.versioned_key(CHALLENGE_CATALOGUE, 'active')
+        cached = app_cache.get(key)
+        if cached is None:
+            challenges = cls.query.filter_by(is_active=True).order_by(cls.id).all()
+            # Cache detached copies; the loaded instances stay with this request's session
+            app_cache.set(key, pickle.loads(pickle.dumps(challenges)))
+            return [challenge for challenge in challenges if category is None or challenge.category == category]
+        return [db.session.merge(challenge, load=False) for challenge in cached
+                if category is None or challenge.category == category]
+    
+    @staticmethod
+    def completion_counts(challenge_ids=None):
+        """Verified completions per challenge id, counted from Submission in one grouped query"""
+        query = db.session.query(Submission.challenge_id, func.count(Submission.id)).filter(Submission.status == 'verified')
+        if challenge_ids is not None:
+            query = query.filter(Submission.challenge_id.in_(challenge_ids))
+        return dict(query.group_by(Submission.challenge_id).all())
+    
+    @classmethod
+    def reconcile_completion_counts(cls):
+        """Reset every verified_completions counter from Submission; returns how many were wrong"""
+        counts = cls.completion_counts()
+        fixed = 0
+        for challenge_id, current in db.session.query(cls.id, cls.verified_completions):
+            expected = counts.get(challenge_id, 0)
+            if current != expected:
+                cls.query.filter_by(id=challenge_id).update({cls.verified_completions: expected}, synchronize_session=False)
+                fixed += 1
+        db.session.commit()
+        return fixed
+    
+    @classmethod
+    def nearby_candidates(cls, lat, lng, radius_km):
+        """(id, latitude, longitude) of the active challenges in the geohash cells covering the radius"""
+        # != so SQLite cannot search the is_active index with it: nearly every challenge is active,
+        # and the geohash ranges below are the narrow filter
+        query = db.session.query(cls.id, cls.latitude, cls.longitude).filter(cls.is_active != False)
+        cells = covering_cells(lat, lng, radius_km)
+        if cells is not None:
+            # One index range scan per covering geohash cell
+            query = query.filter(or_(*[
+                and_(cls.geohash >= cell, cls.geohash < prefix_upper_bound(cell)) for cell in cells
+            ]))
+        return query
+    
+    @classmethod
+    def nearby(cls, lat, lng, radius_km, limit):
+        """Active challenges within radius_km of a point as (challenge, distance_km), nearest first"""
+        # Rank the candidates on bare coordinates, then load only the rows we return
+        distances = {}
+        for challenge_id, challenge_lat, challenge_lng in cls.nearby_candidates(lat, lng, radius_km):
+            distance_km = haversine_km(lat, lng, challenge_lat, challenge_lng)
+            if distance_km <= radius_km:
+                distances[challenge_id] = distance_km
+        nearest_ids = sorted(distances, key=distances.get)[:limit]
+        if not nearest_ids:
+            return []
+        
+        challenges = cls.query.filter(cls.id.in_(nearest_ids)).all()
+        challenges.sort(key=lambda challenge: distances[challenge.id])
+        return [(challenge, distances[challenge.id]) for challenge in challenges]
+
+@event.listens_for(Challenge, 'before_insert')
+@event.listens_for(Challenge, 'before_update')
+def update_challenge_geohash(mapper, connection, challenge):
+    challenge.geohash = geohash_encode(challenge.latitude, challenge.longitude)
+
+@event.listens_for(Challenge, 'after_insert')
+@event.listens_for(Challenge, 'after_update')
+@event.listens_for(Challenge, 'after_delete')
+def mark_catalogue_changed(mapper, connection, challenge):
+    session = object_session(challenge)
+    if session is not None:
+        session.info['catalogue_changed'] = True
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_catalogue(session):
+    # Bumped only once the change is visible, so no reader caches the old rows under the new version.
+    # Bulk UPDATE/DELETE queries skip mapper events; callers bump CHALLENGE_CATALOGUE themselves.
+    if session.info.pop('catalogue_changed', False):
+        app_cache.bump(CHALLENGE_CATALOGUE)
+
+@event.listens_for(Session, 'after_rollback')
+def forget_catalogue_change(session):
+    session.info.pop('catalogue_changed', None)
 
 class Submission(db.Model):
+    # Each index matches a hot query; `flask --app main check-indexes` verifies the plans
+    __table_args__ = (
+        db.Index('ix_submission_user_history', 'user_id', 'submitted_at', 'id'),  # a user's history, in keyset order
+        db.Index('ix_submission_user_challenge_status', 'user_id', 'challenge_id', 'status'),  # already completed?
+        db.Index('ix_submission_challenge_status', 'challenge_id', 'status'),  # completion counts
+        db.Index('ix_submission_status', 'status'),  # worker queue and queue depth, in id order
+        db.Index('ix_submission_verified_user', 'verified_at', 'user_id'),  # leaderboard sync and the weekly board
+        # At most one verified completion per user and challenge, however many workers race to award it
+        db.Index('uq_submission_verified_user_challenge', 'user_id', 'challenge_id', unique=True,
+                 sqlite_where=text("status = 'verified'"), postgresql_where=text("status = 'verified'")),
+        db.UniqueConstraint('user_id', 'idempotency_key', name='uq_submission_user_idempotency_key'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     challenge_id = db.Column(db.Integer, db.ForeignKey('challenge.id'), nullable=False)
-    image_path = db.Column(db.String(200), nullable=False)
+    image_path = db.Column(db.String(200), nullable=False)  # image store key (storage.py); '' once the photo is released
+    image_sha256 = db.Column(db.String(64), index=True)  # fingerprints used by the verification cache
+    image_phash = db.Column(db.String(16), index=True)
     user_location_lat = db.Column(db.Float, nullable=False)
     user_location_lng = db.Column(db.Float, nullable=False)
-    status = db.Column(db.String(20), default='pending')  # pending, verified, rejected
+    status = db.Column(db.String(20), default='pending')  # pending, processing, verified, rejected
     ai_verification_result = db.Column(db.Text)
+    claimed_at = db.Column(db.DateTime)  # when a worker picked the submission up for verification
     points_awarded = db.Column(db.Integer, default=0)
+    idempotency_key = db.Column(db.String(64))  # the client's Idempotency-Key header, unique per user
     submitted_at = db.Column(db.DateTime, default=datetime.utcnow)
     verified_at = db.Column(db.DateTime)
     
-    def verify_location(self, max_distance_km=1.0):
-        """Check if user was within acceptable distance of challenge location"""
-        from math import radians, cos, sin, asin, sqrt
-        
-        # Haversine formula to calculate distance between two points on Earth
-        challenge_lat = radians(self.challenge.latitude)
-        challenge_lng = radians(self.challenge.longitude)
-        user_lat = radians(self.user_location_lat)
-        user_lng = radians(self.user_location_lng)
-        
-        dlng = user_lng - challenge_lng
-        dlat = user_lat - challenge_lat
-        a = sin(dlat/2)**2 + cos(challenge_lat) * cos(user_lat) * sin(dlng/2)**2
-        c = 2 * asin(sqrt(a))
-        distance_km = 6371 * c  # Radius of earth in kilometers
+    def distance_km(self, challenge=None):
+        """Distance between the user and the challenge location"""
+        challenge = challenge or self.challenge
+        return haversine_km(self.user_location_lat, self.user_location_lng, challenge.latitude, challenge.longitude)
+    
+    @classmethod
+    def history(cls, user_id, before=None):
+        """A user's submissions, newest first, with the challenge columns history pages show.
         
-        return distance_km <= max_distance_km
+        before is a (submitted_at, id) cursor: only older submissions follow it.
+        """
+        query = cls.query.options(joinedload(cls.challenge).load_only(Challenge.title, Challenge.category, Challenge.points)) \
+            .filter(cls.user_id == user_id)
+        if before is not None:
+            query = query.filter(tuple_(cls.submitted_at, cls.id) < tuple_(*before))
+        return query.order_by(cls.submitted_at.desc(), cls.id.desc())
+    
+    @classmethod
+    def history_page(cls, user_id, before=None, limit=20):
+        """(up to limit submissions, cursor for the next page or None)"""
+        submissions = cls.history(user_id, before).limit(limit + 1).all()
+        if len(submissions) <= limit:
+            return submissions, None
+        last = submissions[limit - 1]
+        return submissions[:limit], (last.submitted_at, last.id)
+    
+    @staticmethod
+    def queue_depth():
+        """Submissions waiting for a verification worker"""
+        return db.session.query(func.count(Submission.id)).filter(Submission.status == 'pending').scalar()
+    
+    @staticmethod
+    def oldest_pending():
+        """submitted_at of the submission that has waited longest for a worker, or None"""
+        return db.session.query(Submission.submitted_at).filter(Submission.status == 'pending') \
+            .order_by(Submission.id).limit(1).scalar()
+    
+    def verify_location(self, max_distance_km=None, challenge=None):
+        """Check if user was within acceptable distance of challenge location"""
+        challenge = challenge or self.challenge
+        if max_distance_km is None:
+            max_distance_km = challenge.geofence_radius_km or DEFAULT_GEOFENCE_KM
+        return self.distance_km(challenge) <= max_distance_km
 
 class Achievement(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'title', name='uq_achievement_user_title'),
+        db.Index('ix_achievement_user_earned', 'user_id', 'earned_at'),  # profile page
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     title = db.Column(db.String(100), nullable=False)
@@ -87,3 +313,121 @@ class Achievement(db.Model):
     
     # Relationships
     user = db.relationship('User', backref='achievements')
+
+class UserCategoryStat(db.Model):
+    """Verified completions per user and challenge category, read by the achievement rules"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    category = db.Column(db.String(50), primary_key=True)
+    verified_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
+    @classmethod
+    def record_completion(cls, user_id, category):
+        """Increment the user's counter for a category in the caller's transaction"""
+        updated = cls.query.filter_by(user_id=user_id, category=category).update(
+            {cls.verified_count: cls.verified_count + 1}, synchronize_session=False)
+        if not updated:
+            db.session.add(cls(user_id=user_id, category=category, verified_count=1))
+    
+    @classmethod
+    def counts_for(cls, user_ids):
+        """{user_id: {category: verified_count}} in one query"""
+        counts = {user_id: {} for user_id in user_ids}
+        for user_id, category, verified_count in db.session.query(cls.user_id, cls.category, cls.verified_count) \
+                .filter(cls.user_id.in_(user_ids)):
+            counts[user_id][category] = verified_count
+        return counts
+    
+    @classmethod
+    def rebuild(cls):
+        """Recompute every counter from verified submissions; returns the number of rows written"""
+        cls.query.delete(synchronize_session=False)
+        grouped = db.session.query(Submission.user_id, Challenge.category, func.count(Submission.id)) \
+            .join(Challenge, Submission.challenge_id == Challenge.id) \
+            .filter(Submission.status == 'verified') \
+            .group_by(Submission.user_id, Challenge.category)
+        result = db.session.execute(cls.__table__.insert().from_select(['user_id', 'category', 'verified_count'], grouped))
+        db.session.commit()
+        return result.rowcount
+
+class StoredImage(db.Model):
+    """A photo in the content-addressed image store (storage.py), shared by every submission of the same upload"""
+    __table_args__ = (
+        db.Index('ix_stored_image_derivatives', 'derivatives_ready'),  # derivative backlog
+        db.Index('ix_stored_image_unreferenced', 'ref_count', 'released_at'),  # garbage collection
+    )
+    
+    sha256 = db.Column(db.String(64), primary_key=True)  # of the uploaded bytes, like Submission.image_sha256
+    key = db.Column(db.String(200), nullable=False)
+    phash = db.Column(db.String(16))
+    ref_count = db.Column(db.Integer, nullable=False, default=0)  # submissions whose image_path is key
+    derivatives_ready = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    released_at = db.Column(db.DateTime)  # last time a reference was dropped
+    
+    @classmethod
+    def acquire(cls, sha256):
+        """Take a reference in the caller's transaction; False if the image has no row"""
+        return bool(cls.query.filter_by(sha256=sha256).update(
+            {cls.ref_count: cls.ref_count + 1}, synchronize_session=False))
+    
+    @classmethod
+    def release(cls, counts):
+        """Drop {sha256: references} in the caller's transaction"""
+        now = datetime.utcnow()
+        for sha256, count in counts.items():
+            cls.query.filter_by(sha256=sha256).update(
+                {cls.ref_count: cls.ref_count - count, cls.released_at: now}, synchronize_session=False)
+    
+    @staticmethod
+    def references(*criteria):
+        """{sha256: submissions still holding the photo} for the submissions matching criteria"""
+        return dict(db.session.query(Submission.image_sha256, func.count(Submission.id))
+                    .filter(Submission.image_path != '', Submission.image_sha256.isnot(None), *criteria)
+                    .group_by(Submission.image_sha256).all())
+    
+    @classmethod
+    def reconcile_ref_counts(cls):
+        """Reset every ref_count from Submission; returns how many were wrong"""
+        counts = cls.references()
+        fixed = 0
+        for sha256, current in db.session.query(cls.sha256, cls.ref_count):
+            expected = counts.get(sha256, 0)
+            if current != expected:
+                values = {cls.ref_count: expected}
+                if expected == 0:
+                    values[cls.released_at] = datetime.utcnow()
+                cls.query.filter_by(sha256=sha256).update(values, synchronize_session=False)
+                fixed += 1
+        db.session.commit()
+        return fixed
+
+class ChallengeDailyStat(db.Model):
+    """Settled submissions per challenge and UTC day of submission, maintained by analytics.py"""
+    __table_args__ = (
+        db.Index('ix_challenge_daily_stat_challenge_day', 'challenge_id', 'day'),  # one challenge's days
+    )
+    
+    day = db.Column(db.Date, primary_key=True)
+    challenge_id = db.Column(db.Integer, primary_key=True)
+    verified = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rejected = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    points_awarded = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+class CategoryHourlyStat(db.Model):
+    """Settled submissions per challenge category and UTC hour of submission, maintained by analytics.py"""
+    hour = db.Column(db.DateTime, primary_key=True)
+    category = db.Column(db.String(50), primary_key=True)
+    verified = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rejected = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    points_awarded = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+class RollupState(db.Model):
+    """High-water mark of a rollup: everything up to last_submission_id has been read, see RollupPending"""
+    name = db.Column(db.String(50), primary_key=True)
+    last_submission_id = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_submitted_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+
+class RollupPending(db.Model):
+    """Submissions the rollup mark passed before they were settled, added by analytics.py once they are"""
+    submission_id = db.Column(db.Integer, primary_key=True)
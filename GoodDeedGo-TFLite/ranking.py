@@ -0,0 +1,175 @@
+"""In-process user ranking.
+
+RankIndex keeps (score, key) pairs in a sorted list, so a rank lookup or
+an "around me" window is a bisect instead of a COUNT(*) over the user
+table. The global rank_service mirrors User.total_points for users with
+points: it loads them once, then every few seconds applies the users whose
+points_updated_at moved, so awards made by the verification worker process
+show up here shortly after they commit.
+"""
+import bisect
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from app import db
+from models import User
+
+SYNC_INTERVAL = float(os.environ.get("RANK_SYNC_INTERVAL", 5))
+FULL_RELOAD_INTERVAL = float(os.environ.get("RANK_FULL_RELOAD_INTERVAL", 600))
+# Re-read a little history on every sync so rows committed out of timestamp order are not missed
+SYNC_OVERLAP = timedelta(seconds=30)
+
+
+class RankIndex:
+    """Scores sorted high to low with logarithmic rank queries"""
+
+    def __init__(self):
+        self._entries = []  # sorted (-score, key)
+        self._scores = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self, pairs):
+        """Replace the contents with (key, score) pairs"""
+        scores = {key: score for key, score in pairs}
+        entries = sorted((-score, key) for key, score in scores.items())
+        with self._lock:
+            self._scores = scores
+            self._entries = entries
+
+    def update(self, key, score):
+        with self._lock:
+            old_score = self._scores.get(key)
+            if old_score == score:
+                return
+            if old_score is not None:
+                self._remove(key, old_score)
+            self._scores[key] = score
+            bisect.insort(self._entries, (-score, key))
+
+    def remove(self, key):
+        with self._lock:
+            old_score = self._scores.pop(key, None)
+            if old_score is not None:
+                self._remove(key, old_score)
+
+    def _remove(self, key, score):
+        index = bisect.bisect_left(self._entries, (-score, key))
+        if index < len(self._entries) and self._entries[index] == (-score, key):
+            del self._entries[index]
+
+    def score(self, key):
+        return self._scores.get(key)
+
+    def rank(self, score):
+        """1 + number of keys with a strictly higher score"""
+        with self._lock:
+            # (-score,) sorts before every (-score, key), so this counts only higher scores
+            return bisect.bisect_left(self._entries, (-score,)) + 1
+
+    def top(self, n):
+        """[(rank, key, score)] for the n highest scores"""
+        with self._lock:
+            return self._ranked(0, n)
+
+    def bottom(self, n):
+        """[(rank, key, score)] for the n lowest scores"""
+        with self._lock:
+            return self._ranked(max(len(self._entries) - n, 0), len(self._entries))
+
+    def around(self, key, score, size):
+        """[(rank, key, score)] for up to size entries either side of key's position"""
+        with self._lock:
+            position = bisect.bisect_left(self._entries, (-score, key))
+            return self._ranked(max(position - size, 0), position + size + 1)
+
+    def _ranked(self, start, stop):
+        ranked = []
+        for negative_score, key in self._entries[start:stop]:
+            ranked.append((bisect.bisect_left(self._entries, (negative_score,)) + 1, key, -negative_score))
+        return ranked
+
+
+class UserRankService:
+    """RankIndex over users with points, kept in step with the user table.
+
+    Also remembers each ranked user's username and level so leaderboards can
+    be rendered without a query.
+    """
+
+    def __init__(self):
+        self.index = RankIndex()
+        self.profiles = {}
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._synced_at = None
+        self._high_water = None
+
+    def _ensure_fresh(self):
+        now = time.monotonic()
+        if self._synced_at is not None and now - self._synced_at < SYNC_INTERVAL:
+            return
+        with self._lock:
+            if self._synced_at is not None and now - self._synced_at < SYNC_INTERVAL:
+                return
+            if self._loaded_at is None or now - self._loaded_at > FULL_RELOAD_INTERVAL:
+                self._reload()
+                self._loaded_at = now
+            else:
+                self._sync()
+            self._synced_at = now
+
+    def refresh(self):
+        """Bring the index up to date if the sync interval has passed"""
+        self._ensure_fresh()
+
+    def _reload(self):
+        self._high_water = datetime.utcnow()
+        rows = db.session.query(User.id, User.total_points, User.username, User.level).filter(User.total_points > 0).all()
+        self.profiles = {user_id: (username, level) for user_id, _, username, level in rows}
+        self.index.load((user_id, points) for user_id, points, _, _ in rows)
+
+    def _sync(self):
+        since = self._high_water - SYNC_OVERLAP
+        self._high_water = datetime.utcnow()
+        rows = db.session.query(User.id, User.total_points, User.username, User.level).filter(User.points_updated_at > since)
+        for user_id, points, username, level in rows:
+            self.record(user_id, points, username, level)
+
+    def record(self, user_id, points, username=None, level=None):
+        """Apply a committed change to a user's points"""
+        if points and points > 0:
+            if username is not None:
+                self.profiles[user_id] = (username, level)
+            self.index.update(user_id, points)
+        else:
+            self.profiles.pop(user_id, None)
+            self.index.remove(user_id)
+
+    def profile(self, user_id):
+        """(username, level) for a ranked user"""
+        return self.profiles.get(user_id, (None, None))
+
+    def get_rank(self, points):
+        self._ensure_fresh()
+        return self.index.rank(points or 0)
+
+    def top(self, n):
+        self._ensure_fresh()
+        return self.index.top(n)
+
+    def around(self, user_id, points, size=2):
+        """[(rank, user_id, points)] for the users ranked around this one"""
+        self._ensure_fresh()
+        if points and points > 0:
+            self.index.update(user_id, points)
+            return self.index.around(user_id, points, size)
+        # Users without points are not indexed; show the bottom of the table
+        return self.index.bottom(size)
+
+
+rank_service = UserRankService()
@@ -0,0 +1,236 @@
+"""Rate limiting and admission control for photo submissions.
+
+Every submission costs a photo decode and an inference, so POST
+/challenge/<id> passes two gates before its body is read, and a refused
+request gets 429 with a Retry-After header:
+
+1. A token bucket per client: the signed-in user, else the client IP (a
+   cookieless script gets no fresh allowance from the user row its first
+   submission creates). SUBMISSION_RATE_PER_MINUTE tokens (default 6) drip
+   in, up to SUBMISSION_RATE_BURST (default 10).
+
+2. Admission control for the whole site: while the verification queue is
+   ADMISSION_MAX_QUEUE_DEPTH deep (default 1000) or its oldest pending
+   submission has waited ADMISSION_MAX_QUEUE_SECONDS (default 120), new
+   submissions are shed. Each process reads the queue at most once every
+   ADMISSION_CHECK_INTERVAL seconds.
+
+Buckets live in process by default, so each web worker limits on its own.
+RATE_LIMIT_URL moves them to a backend shared by every process, as with
+the application cache:
+
+    RATE_LIMIT_URL=redis://cache:6379/1          # needs the redis package
+    RATE_LIMIT_URL=sqlite:///instance/ratelimit.db
+
+A backend provides take(key, rate, burst) -> (allowed, seconds until the
+next token). If the shared backend fails, the process-local buckets stand in.
+"""
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import request
+
+from models import Submission
+import metrics
+
+RATE_PER_MINUTE = float(os.environ.get("SUBMISSION_RATE_PER_MINUTE", 6))  # 0 disables
+BURST = int(os.environ.get("SUBMISSION_RATE_BURST", 10))
+RATE_LIMIT_URL = os.environ.get("RATE_LIMIT_URL", "")
+MAX_LOCAL_BUCKETS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", 100000))
+MAX_QUEUE_DEPTH = int(os.environ.get("ADMISSION_MAX_QUEUE_DEPTH", 1000))  # 0 disables
+MAX_QUEUE_SECONDS = float(os.environ.get("ADMISSION_MAX_QUEUE_SECONDS", 120))  # 0 disables
+CHECK_INTERVAL = float(os.environ.get("ADMISSION_CHECK_INTERVAL", 1.0))
+SHED_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", 30))
+
+SHED = metrics.counter('gooddeedgo_submissions_refused_total', 'Submissions refused with 429 by reason')
+
+
+def _take(tokens, updated, now, rate, burst):
+    """(allowed, tokens left) for a bucket that held `tokens` at `updated`; a new bucket starts full"""
+    tokens = burst if tokens is None else min(burst, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return True, tokens - 1
+    return False, tokens
+
+
+def _wait(tokens, rate):
+    return (1 - tokens) / rate
+
+
+class LocalBackend:
+    """Buckets in a bounded LRU, private to one process"""
+
+    def __init__(self, maxsize=MAX_LOCAL_BUCKETS):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (None, None))
+            allowed, tokens = _take(tokens, updated, now, rate, burst)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)  # a forgotten bucket comes back full
+        return allowed, 0.0 if allowed else _wait(tokens, rate)
+
+
+class SQLiteBackend:
+    """Buckets in a SQLite file, shared by every process on the host; each opens its own connection"""
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._pid = None
+        self._inherited = []
+        self._lock = threading.Lock()
+
+    def _db(self):
+        # Opened in each process on first use, under self._lock: a SQLite connection must not
+        # cross a fork, and gunicorn forks its workers from a master that imported this module
+        if self._pid != os.getpid():
+            if self._connection is not None:
+                self._inherited.append(self._connection)  # the parent's; never used or closed here
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS rate_buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+            self._pid = os.getpid()
+        return self._connection
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")  # read-modify-write under the file's write lock
+            try:
+                row = db.execute("SELECT tokens, updated FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+                allowed, tokens = _take(*(row or (None, None)), now, rate, burst)
+                db.execute("INSERT OR REPLACE INTO rate_buckets VALUES (?, ?, ?)", (key, tokens, now))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return allowed, 0.0 if allowed else _wait(tokens, rate)
+
+
+class RedisBackend:
+    # The whole refill-and-take runs atomically in Redis, on the server's clock
+    TAKE = """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = burst
+    if bucket[1] then
+        tokens = math.min(burst, tonumber(bucket[1]) + (now - tonumber(bucket[2])) * rate)
+    end
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+    return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._take = self._redis.register_script(self.TAKE)
+
+    def take(self, key, rate, burst):
+        allowed, tokens = self._take(keys=[f"ratelimit:{key}"], args=[rate, burst])
+        return bool(allowed), 0.0 if allowed else _wait(float(tokens), rate)
+
+
+def backend_from_url(url):
+    """Shared backend for RATE_LIMIT_URL, or None to keep buckets in process"""
+    if not url:
+        return None
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisBackend(url)
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):])
+    raise ValueError(f"Unsupported RATE_LIMIT_URL '{url}'")
+
+
+class RateLimiter:
+    def __init__(self, per_minute=RATE_PER_MINUTE, burst=BURST, url=RATE_LIMIT_URL):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.local = LocalBackend()
+        self.shared = backend_from_url(url)
+
+    def retry_after(self, key):
+        """Take a token for key; None if there was one, else seconds until there is"""
+        if not self.rate:
+            return None
+        allowed, wait = None, 0.0
+        if self.shared is not None:
+            try:
+                allowed, wait = self.shared.take(key, self.rate, self.burst)
+            except Exception as e:
+                logging.warning(f"Shared rate limiter failed, limiting in process: {e}")
+        if allowed is None:
+            allowed, wait = self.local.take(key, self.rate, self.burst)
+        return None if allowed else wait
+
+
+class AdmissionController:
+    """Sheds new submissions while the verification queue is too deep or too slow"""
+
+    def __init__(self, max_depth=MAX_QUEUE_DEPTH, max_seconds=MAX_QUEUE_SECONDS, interval=CHECK_INTERVAL):
+        self.max_depth = max_depth
+        self.max_seconds = max_seconds
+        self.interval = interval
+        self._checked_at = None
+        self._verdict = None
+
+    def _evaluate(self):
+        if self.max_depth and Submission.queue_depth() >= self.max_depth:
+            return 'queue_depth'
+        if self.max_seconds:
+            oldest = Submission.oldest_pending()
+            if oldest is not None and (datetime.utcnow() - oldest).total_seconds() >= self.max_seconds:
+                return 'queue_age'
+        return None
+
+    def overloaded(self):
+        """Why submissions are being shed ('queue_depth' or 'queue_age'), or None"""
+        if not (self.max_depth or self.max_seconds):
+            return None
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at >= self.interval:
+            self._verdict = self._evaluate()
+            self._checked_at = now
+        return self._verdict
+
+
+limiter = RateLimiter()
+admission = AdmissionController()
+
+
+def client_key(user):
+    return f"ip:{request.remote_addr}" if user.is_anonymous else f"user:{user.id}"
+
+
+def refuse_submission(user):
+    """(message, Retry-After seconds) if this submission must wait, else None"""
+    wait = limiter.retry_after(client_key(user))
+    if wait is not None:
+        SHED.inc(reason='rate_limited')
+        return 'You are submitting too fast. Please wait a moment and try again.', max(1, math.ceil(wait))
+    reason = admission.overloaded()
+    if reason is not None:
+        SHED.inc(reason=reason)
+        return 'We are verifying a lot of photos right now. Please try again shortly.', SHED_RETRY_AFTER
+    return None
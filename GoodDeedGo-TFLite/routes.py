@@ -1,46 +1,76 @@
+import hmac
+import io
+import json
 import os
 import uuid
 from datetime import datetime
-from flask import render_template, request, redirect, url_for, flash, session, jsonify
-from werkzeug.utils import secure_filename
-from PIL import Image
+from flask import render_template, request, redirect, url_for, flash, session, jsonify, abort, Response, stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+from sqlalchemy.exc import IntegrityError
 from app import app, db
-from models import User, Challenge, Submission, Achievement
-from tflite import verify_challenge_completion
+from models import User, AnonymousUser, Challenge, Submission, Achievement, CHALLENGE_CATALOGUE
+from leaderboard import leaderboard_service, GLOBAL_BOARD
+import analytics
+import challenge_io
+import storage
+from uploads import coordinates, upload_format
+from ratelimit import refuse_submission
+from cache import app_cache
+from metrics import timer
+import metrics
 
 import logging
 
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
-
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+DEFAULT_RADIUS_KM = 10.0
+MAX_RADIUS_KM = 500.0
+DEFAULT_NEARBY_LIMIT = 50
+MAX_NEARBY_LIMIT = 200
+NEARBY_COORDINATE_DECIMALS = 4  # ~11m; nearby requests from the same spot share a cache entry
+# Short, because the cached payload includes completion counts, which change without a catalogue bump
+NEARBY_CACHE_TTL = float(os.environ.get("NEARBY_CACHE_TTL", 30))
+MAX_IDEMPOTENCY_KEY_LENGTH = 64
+HISTORY_PAGE_SIZE = 20
+MAX_HISTORY_PAGE_SIZE = 100
+HISTORY_EXPORT_BATCH = 500
+MAX_STATS_DAYS = 366
+MAX_STATS_HOURS = 24 * 90
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+CHALLENGE_IMPORT_MAX_BYTES = int(os.environ.get("CHALLENGE_IMPORT_MAX_BYTES", 512 * 1024 * 1024))
+MAX_IMPORT_BATCH = 20000
 
 def get_current_user():
-    if 'user_id' not in session:
-        username = f"user_{uuid.uuid4().hex[:8]}"
-        user = User(username=username, email=f"{username}@gooddeedgo.app")
-        db.session.add(user)
-        db.session.commit()
-        session['user_id'] = user.id
-        session['username'] = user.username
-        logging.info(f"Created new user: {username}")
-    return User.query.get(session['user_id'])
+    """The session's user, or an AnonymousUser; reads never create rows"""
+    user_id = session.get('user_id')
+    if user_id is not None:
+        user = User.query.get(user_id)
+        if user is not None:
+            return user
+        session.pop('user_id', None)  # pruned while dormant
+    return AnonymousUser()
+
+def create_user():
+    """Give an anonymous visitor a user row, on their first submission"""
+    username = f"user_{uuid.uuid4().hex[:8]}"
+    user = User(username=username, email=f"{username}@gooddeedgo.app", total_points=0)
+    db.session.add(user)
+    db.session.flush()
+    session['user_id'] = user.id
+    session['username'] = user.username
+    logging.info(f"Created new user: {username}")
+    return user
 
 @app.route('/')
 def index():
     user = get_current_user()
-    recent_challenges = Challenge.query.filter_by(is_active=True).limit(3).all()
-    user_submissions = Submission.query.filter_by(user_id=user.id).order_by(Submission.submitted_at.desc()).limit(3).all()
+    recent_challenges = Challenge.catalogue()[:3]
+    user_submissions = [] if user.is_anonymous else Submission.query.filter_by(user_id=user.id).order_by(Submission.submitted_at.desc()).limit(3).all()
     return render_template('index.html', user=user, recent_challenges=recent_challenges, user_submissions=user_submissions)
 
 @app.route('/challenges')
 def challenges():
     user = get_current_user()
     category = request.args.get('category', 'all')
-    if category == 'all':
-        challenges = Challenge.query.filter_by(is_active=True).all()
-    else:
-        challenges = Challenge.query.filter_by(is_active=True, category=category).all()
+    challenges = Challenge.catalogue(None if category == 'all' else category)
     categories = ['all', 'recycling', 'community', 'environment', 'transport']
     return render_template('challenges.html', user=user, challenges=challenges, categories=categories, selected_category=category)
 
@@ -48,121 +78,234 @@ def challenges():
 def challenge_detail(challenge_id):
     user = get_current_user()
     challenge = Challenge.query.get_or_404(challenge_id)
-    existing_submission = Submission.query.filter_by(user_id=user.id, challenge_id=challenge_id, status='verified').first()
     if request.method == 'GET':
+        existing_submission = None if user.is_anonymous else Submission.query.filter_by(user_id=user.id, challenge_id=challenge_id, status='verified').first()
         return render_template('challenge_detail.html', user=user, challenge=challenge, completed=existing_submission is not None)
     return submit_challenge_logic(challenge_id, user, challenge)
 
 def submit_challenge_logic(challenge_id, user, challenge):
-    user = get_current_user()
-    challenge = Challenge.query.get_or_404(challenge_id)
-    existing_submission = Submission.query.filter_by(user_id=user.id, challenge_id=challenge_id, status='verified').first()
-    if existing_submission:
+    # Everything up to request.files runs before the multipart body is read (see uploads.py)
+    idempotency_key = request.headers.get('Idempotency-Key') or None
+    if idempotency_key and len(idempotency_key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        return jsonify({'success': False, 'message': f'Idempotency-Key is longer than {MAX_IDEMPOTENCY_KEY_LENGTH} characters.'}), 400
+    replayed = find_idempotent_submission(user, idempotency_key)
+    if replayed is not None:
+        return submission_accepted(replayed, replayed=True)
+    refused = refuse_submission(user)
+    if refused is not None:
+        return jsonify({'success': False, 'message': refused[0]}), 429, {'Retry-After': str(refused[1])}
+    if not user.is_anonymous and Submission.query.filter_by(user_id=user.id, challenge_id=challenge_id, status='verified').first():
         return jsonify({'success': False, 'message': 'You have already completed this challenge!'})
+    if request.content_length and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({'success': False, 'message': 'Photo is too large.'}), 413
 
-    user_lat = float(request.form.get('user_lat', 0))
-    user_lng = float(request.form.get('user_lng', 0))
+    location = coordinates(request.args)
+    if location is not None and not within_geofence(challenge, *location):
+        return jsonify({'success': False, 'message': 'You are too far from the challenge location!'})
 
-    if 'photo' not in request.files:
-        return jsonify({'success': False, 'message': 'No photo uploaded!'})
+    try:
+        file = request.files.get('photo')
+        location = location or coordinates(request.form) or (0.0, 0.0)
+    except (RequestEntityTooLarge, UnsupportedMediaType) as e:
+        return jsonify({'success': False, 'message': e.description}), e.code
 
-    file = request.files['photo']
+    if file is None:
+        return jsonify({'success': False, 'message': 'No photo uploaded!'})
     if file.filename == '':
         return jsonify({'success': False, 'message': 'No photo selected!'})
+    if upload_format(file) is None:
+        return jsonify({'success': False, 'message': 'Invalid file type. Please upload a valid image.'})
+
+    # Clients that only send form coordinates are checked here, after the upload streamed in
+    if not within_geofence(challenge, *location):
+        return jsonify({'success': False, 'message': 'You are too far from the challenge location!'})
+
+    try:
+        stored = storage.store_upload(file.stream)
+    except Exception as e:
+        logging.error(f"Error processing image: {e}")
+        return jsonify({'success': False, 'message': 'Invalid file type. Please upload a valid image.'})
 
-    if file and allowed_file(file.filename):
-        filename = secure_filename(f"{uuid.uuid4().hex}_{file.filename}")
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-        file.save(filepath)
-
-        try:
-            with Image.open(filepath) as img:
-                if img.width > 1024 or img.height > 1024:
-                    img.thumbnail((1024, 1024), Image.Resampling.LANCZOS)
-                    img.save(filepath, optimize=True, quality=85)
-        except Exception as e:
-            logging.error(f"Error processing image: {e}")
-
-        submission = Submission(
-            user_id=user.id,
-            challenge_id=challenge_id,
-            image_path=filepath,
-            user_location_lat=user_lat,
-            user_location_lng=user_lng
-        )
-
-        if not submission.verify_location():
-            os.remove(filepath)
-            return jsonify({'success': False, 'message': 'You are too far from the challenge location!'})
-
-        try:
-            verification_result = verify_challenge_completion(filepath)
-            submission.ai_verification_result = verification_result
-
-            if verification_result != "not_a_deed":
-                submission.status = 'verified'
-                submission.points_awarded = challenge.points
-                submission.verified_at = datetime.utcnow()
-                user.total_points += challenge.points
-                user.update_level()
-                check_achievements(user)
-                db.session.add(submission)
-                db.session.commit()
-                return jsonify({'success': True, 'message': f'Challenge completed! You earned {challenge.points} points!', 'points_awarded': challenge.points})
-            else:
-                submission.status = 'rejected'
-                db.session.add(submission)
-                db.session.commit()
-                return jsonify({'success': False, 'message': 'Your submission could not be verified. Please try again with a clearer photo.'})
-
-        except Exception as e:
-            logging.error(f"TFLite verification failed: {e}")
-            submission.ai_verification_result = f"Verification failed: {str(e)}"
-            submission.status = 'rejected'
-            db.session.add(submission)
+    # Queue for the verification worker (worker.py), which awards points
+    if user.is_anonymous:
+        user = create_user()
+    submission = Submission(
+        user_id=user.id,
+        challenge_id=challenge_id,
+        user_location_lat=location[0],
+        user_location_lng=location[1],
+        image_path=stored.key,
+        image_sha256=stored.sha256,
+        image_phash=stored.phash,
+        idempotency_key=idempotency_key,
+        status='pending'
+    )
+    db.session.add(submission)
+    try:
+        with timer('db_commit'):
             db.session.commit()
-            return jsonify({'success': False, 'message': 'Verification failed. Please try again later.'})
-
-    return jsonify({'success': False, 'message': 'Invalid file type. Please upload a valid image.'})
-
-def check_achievements(user):
-    achievements_to_award = []
-    if user.total_points >= 10 and not Achievement.query.filter_by(user_id=user.id, title='First Steps').first():
-        achievements_to_award.append({'title': 'First Steps', 'description': 'Completed your first challenge!', 'badge_icon': 'fas fa-baby'})
-    if user.total_points >= 50 and not Achievement.query.filter_by(user_id=user.id, title='Getting Started').first():
-        achievements_to_award.append({'title': 'Getting Started', 'description': 'Earned 50 points!', 'badge_icon': 'fas fa-star'})
-    if user.total_points >= 100 and not Achievement.query.filter_by(user_id=user.id, title='Century Club').first():
-        achievements_to_award.append({'title': 'Century Club', 'description': 'Earned 100 points!', 'badge_icon': 'fas fa-trophy'})
-    recycling_count = Submission.query.join(Challenge).filter(Submission.user_id == user.id, Submission.status == 'verified', Challenge.category == 'recycling').count()
-    if recycling_count >= 3 and not Achievement.query.filter_by(user_id=user.id, title='Recycling Hero').first():
-        achievements_to_award.append({'title': 'Recycling Hero', 'description': 'Completed 3 recycling challenges!', 'badge_icon': 'fas fa-recycle'})
-    for achievement_data in achievements_to_award:
-        achievement = Achievement(user_id=user.id, **achievement_data)
-        db.session.add(achievement)
-    if achievements_to_award:
-        db.session.commit()
+    except IntegrityError:
+        # A concurrent retry with the same Idempotency-Key committed first; answer as it was answered
+        db.session.rollback()
+        replayed = find_idempotent_submission(user, idempotency_key)
+        if replayed is None:
+            raise
+        return submission_accepted(replayed, replayed=True)
+    return submission_accepted(submission)
+
+def find_idempotent_submission(user, idempotency_key):
+    if user.is_anonymous or not idempotency_key:
+        return None
+    return Submission.query.filter_by(user_id=user.id, idempotency_key=idempotency_key).first()
+
+def submission_accepted(submission, replayed=False):
+    response = jsonify({
+        'success': True,
+        'pending': True,
+        'message': 'Photo received! We are verifying your submission.',
+        'submission_id': submission.id,
+        'status_url': url_for('submission_status', submission_id=submission.id)
+    })
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response, 202
+
+def within_geofence(challenge, lat, lng):
+    with timer('location_check'):
+        return Submission(user_location_lat=lat, user_location_lng=lng).verify_location(challenge=challenge)
+
+def submission_message(submission):
+    if submission.status == 'verified':
+        return f'Challenge completed! You earned {submission.points_awarded} points!'
+    if submission.status == 'rejected':
+        return 'Your submission could not be verified. Please try again with a clearer photo.'
+    return 'Your submission is being verified.'
+
+@app.route('/api/submissions/<int:submission_id>')
+def submission_status(submission_id):
+    user = get_current_user()
+    if user.is_anonymous:
+        abort(404)
+    submission = Submission.query.filter_by(id=submission_id, user_id=user.id).first_or_404()
+    return jsonify({
+        'id': submission.id,
+        'status': submission.status,
+        'success': submission.status == 'verified',
+        'done': submission.status in ('verified', 'rejected'),
+        'message': submission_message(submission),
+        'points_awarded': submission.points_awarded
+    })
+
+def query_arg(name, type, default, low, high, clamp=True):
+    """Query arg as type within [low, high]: default if absent, 400 if malformed, clamped (or 400 unless clamp)"""
+    if not request.args.get(name):
+        return default
+    value = request.args.get(name, type=type)
+    if value is None or value != value:  # malformed, or NaN
+        abort(400)
+    if not low <= value <= high:
+        if not clamp:
+            abort(400)
+        value = min(max(value, low), high)
+    return value
+
+def encode_cursor(cursor):
+    submitted_at, submission_id = cursor
+    return f"{submitted_at.isoformat()}_{submission_id}"
+
+def decode_cursor(value):
+    """(submitted_at, id) from a history cursor, None for the first page; 400 if malformed"""
+    if not value:
+        return None
+    try:
+        submitted_at, submission_id = value.rsplit('_', 1)
+        return datetime.fromisoformat(submitted_at), int(submission_id)
+    except ValueError:
+        abort(400)
+
+def history_entry(submission):
+    return {
+        'id': submission.id,
+        'challenge_id': submission.challenge_id,
+        'challenge_title': submission.challenge.title,
+        'category': submission.challenge.category,
+        'status': submission.status,
+        'points_awarded': submission.points_awarded,
+        'submitted_at': submission.submitted_at.isoformat(),
+        'verified_at': submission.verified_at.isoformat() if submission.verified_at else None
+    }
 
 @app.route('/profile')
 def profile():
     user = get_current_user()
-    submissions = Submission.query.filter_by(user_id=user.id).order_by(Submission.submitted_at.desc()).all()
+    if user.is_anonymous:
+        return render_template('profile.html', user=user, submissions=[], achievements=[], next_cursor=None)
+    submissions, cursor = Submission.history_page(user.id, decode_cursor(request.args.get('cursor')), HISTORY_PAGE_SIZE)
     achievements = Achievement.query.filter_by(user_id=user.id).order_by(Achievement.earned_at.desc()).all()
-    return render_template('profile.html', user=user, submissions=submissions, achievements=achievements)
+    return render_template('profile.html', user=user, submissions=submissions, achievements=achievements,
+                           next_cursor=cursor and encode_cursor(cursor))
+
+@app.route('/api/submissions')
+def submission_history():
+    user = get_current_user()
+    if user.is_anonymous:
+        return jsonify({'submissions': [], 'next_cursor': None})
+    limit = query_arg('limit', int, HISTORY_PAGE_SIZE, 1, MAX_HISTORY_PAGE_SIZE)
+    submissions, cursor = Submission.history_page(user.id, decode_cursor(request.args.get('cursor')), limit)
+    return jsonify({'submissions': [history_entry(submission) for submission in submissions],
+                    'next_cursor': cursor and encode_cursor(cursor)})
+
+@app.route('/api/submissions/export')
+def export_submission_history():
+    user = get_current_user()
+    if user.is_anonymous:
+        abort(404)
+    user_id = user.id
+    def lines():
+        # yield_per keeps one batch of rows in memory however long the history is
+        for submission in Submission.history(user_id).yield_per(HISTORY_EXPORT_BATCH):
+            yield json.dumps(history_entry(submission)) + '\n'
+    return Response(stream_with_context(lines()), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': 'attachment; filename=submissions.ndjson'})
 
 @app.route('/leaderboard')
 def leaderboard():
     user = get_current_user()
-    top_users = User.query.filter(User.total_points > 0).order_by(User.total_points.desc()).limit(20).all()
-    return render_template('leaderboard.html', user=user, top_users=top_users)
+    board = request.args.get('board', GLOBAL_BOARD)
+    top_users = leaderboard_service.top(board)
+    return render_template('leaderboard.html', user=user, top_users=top_users, boards=leaderboard_service.board_names(), selected_board=board)
+
+@app.route('/api/leaderboard')
+def leaderboard_api():
+    board = request.args.get('board', GLOBAL_BOARD)
+    return jsonify({'board': board, 'entries': [entry._asdict() for entry in leaderboard_service.top(board)]})
+
+@app.route('/api/rank')
+def rank():
+    user = get_current_user()
+    size = query_arg('window', int, 2, 0, 25)
+    neighbors = user.get_neighbors(size)
+    usernames = dict(db.session.query(User.id, User.username).filter(User.id.in_([user_id for _, user_id, _ in neighbors])))
+    return jsonify({
+        'rank': user.get_rank(),
+        'total_points': user.total_points,
+        'around': [{'rank': rank, 'username': usernames.get(user_id), 'total_points': points, 'is_you': user_id == user.id}
+                   for rank, user_id, points in neighbors]
+    })
 
 @app.route('/api/challenges/nearby')
 def nearby_challenges():
-    lat = float(request.args.get('lat', 0))
-    lng = float(request.args.get('lng', 0))
-    challenges = Challenge.query.filter_by(is_active=True).all()
+    lat = query_arg('lat', float, 0.0, -90.0, 90.0, clamp=False)
+    lng = query_arg('lng', float, 0.0, -180.0, 180.0, clamp=False)
+    radius_km = query_arg('radius_km', float, DEFAULT_RADIUS_KM, 0.0, MAX_RADIUS_KM)
+    limit = query_arg('limit', int, DEFAULT_NEARBY_LIMIT, 1, MAX_NEARBY_LIMIT)
+    lat, lng = round(lat, NEARBY_COORDINATE_DECIMALS), round(lng, NEARBY_COORDINATE_DECIMALS)
+    key = app_cache.versioned_key(CHALLENGE_CATALOGUE, 'nearby', lat, lng, radius_km, limit)
+    return jsonify(app_cache.get_or_set(key, lambda: nearby_payload(lat, lng, radius_km, limit), ttl=NEARBY_CACHE_TTL))
+
+def nearby_payload(lat, lng, radius_km, limit):
     challenge_data = []
-    for challenge in challenges:
+    for challenge, distance_km in Challenge.nearby(lat, lng, radius_km, limit):
         challenge_data.append({
             'id': challenge.id,
             'title': challenge.title,
@@ -171,14 +314,83 @@ def nearby_challenges():
             'points': challenge.points,
             'latitude': challenge.latitude,
             'longitude': challenge.longitude,
+            'distance_km': round(distance_km, 3),
             'completions': challenge.get_completion_count()
         })
-    return jsonify(challenge_data)
+    return challenge_data
+
+@app.route('/api/stats/daily')
+def daily_stats():
+    days = query_arg('days', int, 30, 1, MAX_STATS_DAYS)
+    challenge_id = query_arg('challenge_id', int, None, 1, 2 ** 63 - 1, clamp=False)
+    return jsonify({'as_of': isoformat(analytics.rolled_up_to()), 'days': analytics.daily_stats(days, challenge_id)})
+
+@app.route('/api/stats/categories')
+def category_stats():
+    hours = query_arg('hours', int, 24, 1, MAX_STATS_HOURS)
+    return jsonify({'as_of': isoformat(analytics.rolled_up_to()), 'categories': analytics.category_stats(hours)})
+
+def isoformat(moment):
+    return moment.isoformat() if moment else None
+
+def require_admin():
+    """404 unless ADMIN_TOKEN is set, 401 unless the request carries it as a bearer token"""
+    if not ADMIN_TOKEN:
+        abort(404)
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+        abort(401)
+
+@app.route('/admin/challenges/import', methods=['POST'])
+def import_challenges():
+    require_admin()
+    fmt = request.args.get('format') or challenge_io.format_for(mimetype=request.mimetype)
+    if fmt not in challenge_io.READERS:
+        return jsonify({'success': False, 'message': 'Send CSV, NDJSON or GeoJSON, with ?format=csv|ndjson|geojson or a matching Content-Type.'}), 400
+    # Stream the raw body through the parser; it is never held in memory or parsed as a form
+    request.max_content_length = CHALLENGE_IMPORT_MAX_BYTES
+    stream = io.TextIOWrapper(io.BufferedReader(request.stream), encoding='utf-8', newline='')
+    try:
+        result = challenge_io.import_file(stream, fmt, query_arg('batch_size', int, challenge_io.BATCH_SIZE, 1, MAX_IMPORT_BATCH))
+    except ValueError as e:  # malformed file or not UTF-8
+        return jsonify({'success': False, 'message': f"{e} (batches before this point were imported)"}), 400
+    return jsonify({'success': True, **result._asdict()})
+
+@app.route('/admin/challenges/export')
+def export_challenges():
+    require_admin()
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in challenge_io.WRITERS:
+        return jsonify({'success': False, 'message': 'format must be csv, ndjson or geojson.'}), 400
+    return Response(stream_with_context(challenge_io.export(fmt)), mimetype=challenge_io.MIMETYPES[fmt],
+                    headers={'Content-Disposition': f'attachment; filename=challenges.{fmt}'})
+
+metrics.gauge('gooddeedgo_verification_queue_depth', 'Submissions waiting for verification', callback=Submission.queue_depth)
+
 
 @app.route("/status")
 def status():
-    return {
-        "status": "✅ Backend is running",
-        "model": "⚠️ Not loaded (TensorFlow disabled)",
-        "database": "🗃️ Active (assumed if db import didn't crash)"
-    }
+    """Health summary: model files and engines, database, verification backlog and hot-path timings"""
+    import backends
+    import tflite
+    try:
+        queue_depth = Submission.queue_depth()
+        database = 'ok'
+    except Exception as e:
+        logging.error(f"Status check could not reach the database: {e}")
+        queue_depth, database = None, 'unavailable'
+
+    available = sorted(backends.available())
+    return jsonify({
+        'status': 'ok' if database == 'ok' and available else 'degraded',
+        'model': {
+            'available': available,
+            'routed': backends.routed_backends() if available else [],
+            # Inference runs in worker.py; engines only load here if this process verifies photos itself
+            'loaded_in_process': tflite.loaded_backends()
+        },
+        'database': database,
+        'verification_queue_depth': queue_depth,
+        'stages': metrics.summary(metrics.STAGE_SECONDS, 'stage'),
+        'endpoints': metrics.summary(metrics.REQUEST_SECONDS, 'endpoint')
+    })
@@ -0,0 +1,32 @@
+"""Every test run gets a fresh SQLite database, chosen before the app is imported"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SCRATCH = tempfile.mkdtemp(prefix='gooddeedgo-tests-')
+atexit.register(shutil.rmtree, SCRATCH, ignore_errors=True)
+# TEST_DATABASE_URL runs the tests against another database, e.g. a scratch Postgres one; they empty it
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL') or f"sqlite:///{os.path.join(SCRATCH, 'test.db')}"
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import app
+    from commands import init_db
+
+    with app.app_context():
+        init_db()
+    return app
+
+
+@pytest.fixture
+def app_context(app):
+    with app.app_context():
+        yield
@@ -0,0 +1,228 @@
+"""Point awards and idempotent submissions stay exact while processes race on one database.
+
+Phases:
+    awards       every process finalizes a share of the same queue of submissions,
+                 made for a few users with several submissions per (user, challenge),
+                 so point awards and completions of one challenge race each other;
+                 then every process replays the whole queue
+    idempotency  every process posts the same Idempotency-Keys for one user at once
+
+The test database is emptied and reseeded first. SQLite holds one write
+lock per transaction, so a read-modify-write award cannot lose updates
+there; point TEST_DATABASE_URL at a scratch Postgres database, where
+concurrent transactions really interleave, to exercise the atomic UPDATEs.
+"""
+import io
+import multiprocessing
+import random
+from datetime import datetime
+
+import pytest
+
+SEED = 20240601
+STUB_VERIFICATION_RESULT = 'recycling'
+CATEGORIES = ['recycling', 'community', 'environment', 'transport']
+PROCESSES = 4
+USERS = 3  # few users, so awards to each of them race
+CHALLENGES = 12
+SUBMISSIONS = 240
+KEYS = 20  # Idempotency-Keys posted by every process
+TIMEOUT = 120
+
+
+def setup(users, challenges, submissions):
+    from app import db
+    from commands import init_db
+    from models import User, Challenge, Submission
+
+    rng = random.Random(SEED)
+    db.drop_all()
+    init_db(seed=False)
+    db.session.execute(User.__table__.insert(), [
+        {'id': user_id, 'username': f"stress_{user_id}", 'email': f"stress_{user_id}@gooddeedgo.app",
+         'total_points': 0, 'level': 'Bronze', 'created_at': datetime.utcnow()}
+        for user_id in range(1, users + 2)])  # the last one is for the idempotency phase
+    for challenge_id in range(1, challenges + 1):
+        db.session.add(Challenge(id=challenge_id, title=f"Stress {challenge_id}", description='Stress test',
+                                 category=CATEGORIES[challenge_id % len(CATEGORIES)], points=rng.randint(5, 25),
+                                 latitude=40.7580, longitude=-73.9855, verification_prompt='Stress test'))
+    db.session.flush()
+    now = datetime.utcnow()
+    db.session.execute(Submission.__table__.insert(), [
+        {'id': submission_id, 'user_id': submission_id % users + 1, 'challenge_id': rng.randint(1, challenges),
+         'image_path': '', 'user_location_lat': 40.7580, 'user_location_lng': -73.9855,
+         'status': 'processing', 'claimed_at': now, 'submitted_at': now}
+        for submission_id in range(1, submissions + 1)])
+    db.session.commit()
+
+
+# --- Run in spawned processes ---
+
+def finalize_share(share, barrier, results):
+    from app import app
+    import worker
+
+    errors = []
+    with app.app_context():
+        barrier.wait()
+        for submission_id in share:
+            try:
+                worker.finalize_submission(submission_id, verification_result=STUB_VERIFICATION_RESULT)
+            except Exception as e:
+                errors.append(f"finalize {submission_id} failed: {e}")
+    results.put(errors)
+
+
+def post_keys(keys, user_id, photo, scratch, barrier, results):
+    from app import app
+    import storage
+
+    storage.image_store = storage.LocalBackend(scratch)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+    answers = []
+    barrier.wait()
+    for key in keys:
+        response = client.post('/challenge/1?user_lat=40.7580&user_lng=-73.9855', content_type='multipart/form-data',
+                               headers={'Idempotency-Key': key},
+                               data={'photo': (io.BytesIO(photo + key.encode()), 'stress.jpg')})
+        answers.append((key, response.status_code, (response.get_json() or {}).get('submission_id')))
+    results.put(answers)
+
+
+def run_parallel(target, shares, *args):
+    """What target put on the queue in each process, once they have all exited"""
+    context = multiprocessing.get_context('spawn')  # fresh engines and connections in every process
+    barrier = context.Barrier(len(shares))
+    results = context.Queue()
+    processes = [context.Process(target=target, args=(share, *args, barrier, results)) for share in shares]
+    for process in processes:
+        process.start()
+    try:
+        collected = [results.get(timeout=TIMEOUT) for _ in processes]
+    finally:
+        for process in processes:
+            process.join(timeout=TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+    return collected
+
+
+# --- Invariants ---
+
+def award_problems():
+    """Ways the awards differ from the verified submissions"""
+    from sqlalchemy import func
+    from app import db
+    from models import User, Challenge, Submission, UserCategoryStat, LEVELS
+
+    problems = []
+    db.session.expire_all()
+    earned = dict(db.session.query(Submission.user_id, func.sum(Submission.points_awarded))
+                  .filter(Submission.status == 'verified').group_by(Submission.user_id))
+    for user in User.query:
+        expected = earned.get(user.id) or 0
+        if user.total_points != expected:
+            problems.append(f"user {user.id}: total_points {user.total_points}, verified submissions earned {expected}")
+        level = next((name for name, minimum in LEVELS if expected >= minimum), 'Bronze')
+        if user.level != level:
+            problems.append(f"user {user.id}: level {user.level}, expected {level}")
+
+    twice = db.session.query(Submission.user_id, Submission.challenge_id, func.count(Submission.id)) \
+        .filter(Submission.status == 'verified').group_by(Submission.user_id, Submission.challenge_id) \
+        .having(func.count(Submission.id) > 1).all()
+    problems += [f"user {user_id} verified challenge {challenge_id} {count} times" for user_id, challenge_id, count in twice]
+
+    completions = Challenge.completion_counts()
+    for challenge in Challenge.query:
+        if challenge.verified_completions != completions.get(challenge.id, 0):
+            problems.append(f"challenge {challenge.id}: verified_completions {challenge.verified_completions}, "
+                            f"expected {completions.get(challenge.id, 0)}")
+
+    per_category = {(user_id, category): count for user_id, category, count in
+                    db.session.query(Submission.user_id, Challenge.category, func.count(Submission.id))
+                    .join(Challenge, Submission.challenge_id == Challenge.id)
+                    .filter(Submission.status == 'verified').group_by(Submission.user_id, Challenge.category)}
+    counters = {(stat.user_id, stat.category): stat.verified_count for stat in UserCategoryStat.query}
+    if counters != per_category:
+        problems.append(f"category counters differ from verified submissions for "
+                        f"{len(set(counters.items()) ^ set(per_category.items()))} (user, category) pair(s)")
+    db.session.rollback()
+    return problems
+
+
+def idempotency_problems(answers):
+    """Ways the submissions stored for each Idempotency-Key differ from one per key, named in every answer"""
+    from sqlalchemy import func
+    from app import db
+    from models import Submission
+
+    problems = []
+    stored = {key: (count, submission_id) for key, count, submission_id in
+              db.session.query(Submission.idempotency_key, func.count(Submission.id), func.min(Submission.id))
+              .filter(Submission.idempotency_key.isnot(None)).group_by(Submission.idempotency_key)}
+    db.session.rollback()
+    for key, (count, _) in stored.items():
+        if count != 1:
+            problems.append(f"Idempotency-Key {key} produced {count} submissions")
+    for key, status, submission_id in answers:
+        if status != 202:
+            problems.append(f"Idempotency-Key {key}: HTTP {status}")
+        elif key not in stored or submission_id != stored[key][1]:
+            problems.append(f"Idempotency-Key {key}: answered with submission {submission_id}, stored {stored.get(key)}")
+    return problems
+
+
+def sample_photo():
+    from PIL import Image
+
+    out = io.BytesIO()
+    Image.new('RGB', (64, 64), (40, 160, 90)).save(out, 'JPEG')
+    return out.getvalue()
+
+
+@pytest.fixture(scope='module')
+def stress_db(app):
+    with app.app_context():
+        setup(USERS, CHALLENGES, SUBMISSIONS)
+    return app
+
+
+@pytest.fixture
+def unlimited(monkeypatch):
+    # Every process posts as the same user on purpose; spawned processes inherit the environment
+    monkeypatch.setenv('SUBMISSION_RATE_PER_MINUTE', '0')
+
+
+def test_concurrent_awards_are_exact(stress_db, app_context):
+    from app import db
+    from models import User, Submission
+
+    submission_ids = list(range(1, SUBMISSIONS + 1))
+    errors = run_parallel(finalize_share, [submission_ids[i::PROCESSES] for i in range(PROCESSES)])
+    assert not sum(errors, [])
+    assert not award_problems()
+    assert Submission.query.filter(Submission.status.in_(['pending', 'processing'])).count() == 0
+    assert db.session.query(db.func.sum(User.total_points)).scalar() > 0
+    db.session.rollback()
+
+
+def test_replayed_awards_change_nothing(stress_db, app_context):
+    from app import db
+    from models import User
+
+    before = {user.id: user.total_points for user in User.query}
+    db.session.rollback()
+    submission_ids = list(range(1, SUBMISSIONS + 1))
+    errors = run_parallel(finalize_share, [submission_ids] * PROCESSES)
+    assert not sum(errors, [])
+    assert not award_problems()
+    assert {user.id: user.total_points for user in User.query} == before
+    db.session.rollback()
+
+
+def test_concurrent_idempotency_keys_make_one_submission_each(stress_db, app_context, unlimited, tmp_path):
+    keys = [f"stress-{i}" for i in range(KEYS)]
+    answers = run_parallel(post_keys, [keys] * PROCESSES, USERS + 1, sample_photo(), str(tmp_path))
+    assert not idempotency_problems([answer for process_answers in answers for answer in process_answers])
@@ -0,0 +1,39 @@
+"""Model registry and the input/output conversions for quantized models"""
+import importlib
+
+import numpy as np
+
+import backends
+
+
+def test_variants_are_registered_only_with_their_file(tmp_path, monkeypatch):
+    (tmp_path / 'model.tflite').write_bytes(b'')
+    (tmp_path / 'model_int8.tflite').write_bytes(b'')
+    monkeypatch.setenv('TFLITE_MODEL_DIR', str(tmp_path))
+    try:
+        importlib.reload(backends)
+        assert sorted(backends.available()) == ['float32', 'int8']
+        assert 'float16' not in backends._registry
+    finally:
+        monkeypatch.undo()
+        importlib.reload(backends)
+
+
+def test_int8_round_trip():
+    pixels = np.array([0, 64, 128, 255], dtype=np.float32) / 255.0
+    quantization = (1 / 255.0, -128)
+    values = backends.quantize(pixels, np.int8, quantization)
+    assert values.dtype == np.int8 and values.tolist() == [-128, -64, 0, 127]
+    assert np.allclose(backends.dequantize(values, quantization), pixels, atol=1 / 255.0)
+
+
+def test_zero_scale_does_not_divide():
+    pixels = np.array([0.0, 3.4, 300.0], dtype=np.float32)
+    with np.errstate(all='raise'):
+        assert backends.quantize(pixels, np.uint8, (0.0, 0)).tolist() == [0, 3, 255]
+        assert backends.dequantize(np.array([7], dtype=np.uint8), (0.0, 0)).tolist() == [7.0]
+
+
+def test_float_inputs_are_only_cast():
+    pixels = np.array([0.5], dtype=np.float64)
+    assert backends.quantize(pixels, np.float32, (0.0, 0)).dtype == np.float32
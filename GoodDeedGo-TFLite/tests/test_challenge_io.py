@@ -0,0 +1,54 @@
+"""Bulk challenge import: unreadable files and bad records are reported, not raised"""
+import csv
+import io
+import uuid
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+import challenge_io
+
+RECORD = {'title': 'Import test', 'description': 'Import test', 'category': 'recycling', 'points': '10',
+          'latitude': '40.7580', 'longitude': '-73.9855', 'verification_prompt': 'Import test'}
+
+
+def test_unreadable_csv_is_a_value_error_with_its_line():
+    stream = io.StringIO(f"title,points\nfine,10\n{'x' * (csv.field_size_limit() + 1)},10\n", newline='')
+    with pytest.raises(ValueError, match='line 3'):
+        list(challenge_io.read_csv(stream))
+
+
+@pytest.mark.parametrize('points, expected', [('10', 10), ('10.0', 10), (0, 0), (25.0, 25)])
+def test_points_accept_whole_numbers(points, expected):
+    assert challenge_io.to_mapping(dict(RECORD, points=points))['points'] == expected
+
+
+@pytest.mark.parametrize('points', ['-5', '2.5', 'ten', 'nan', '1e12'])
+def test_points_reject_the_rest(points):
+    with pytest.raises(ValueError):
+        challenge_io.to_mapping(dict(RECORD, points=points))
+
+
+def test_batch_inserted_concurrently_becomes_an_update(app_context, monkeypatch):
+    from app import db
+    from models import Challenge
+
+    external_id = f"race-{uuid.uuid4().hex[:8]}"
+    write = challenge_io._write
+    attempts = []
+
+    def racing(batch):
+        attempts.append(len(batch))
+        if len(attempts) == 1:
+            # Another import commits the same external id between our lookup and our insert
+            db.session.execute(db.insert(Challenge), [dict(challenge_io.to_mapping(dict(RECORD, external_id=external_id)),
+                                                          title='Other import', geohash='dr5ru')])
+            db.session.commit()
+            raise IntegrityError('INSERT', {}, Exception('UNIQUE constraint failed: challenge.external_id'))
+        return write(batch)
+
+    monkeypatch.setattr(challenge_io, '_write', racing)
+    result = challenge_io.import_records([dict(RECORD, external_id=external_id)])
+    assert (result.inserted, result.updated, len(attempts)) == (0, 1, 2)
+    assert Challenge.query.filter_by(external_id=external_id).one().title == 'Import test'
+    db.session.rollback()
@@ -0,0 +1,58 @@
+"""SQLite-backed shared state opens a connection of its own in every forked process"""
+import os
+import traceback
+
+import pytest
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork()')
+
+
+def in_child(function):
+    """Exit code of a forked child that runs function: 0 if it returned"""
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            function()
+            code = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    return os.waitstatus_to_exitcode(status)
+
+
+def test_shared_cache_reconnects_after_fork(tmp_path):
+    from cache import SQLiteBackend
+
+    backend = SQLiteBackend(str(tmp_path / 'cache.db'))
+    backend.set('parent', 1, 60)
+    parent_connection = backend._db
+
+    def child():
+        assert backend._db is not parent_connection
+        backend.set('child', 2, 60)
+        assert backend.get('parent') == 1
+
+    assert in_child(child) == 0
+    assert backend._db is parent_connection
+    assert backend.get('child') == 2
+
+
+def test_shared_rate_limiter_reconnects_after_fork(app, tmp_path):
+    from ratelimit import SQLiteBackend
+
+    backend = SQLiteBackend(str(tmp_path / 'ratelimit.db'))
+    assert backend.take('parent', rate=0.001, burst=2)[0]
+    parent_connection = backend._db()
+
+    def child():
+        assert backend._db() is not parent_connection
+        assert backend.take('parent', rate=0.001, burst=2)[0]  # the parent's bucket: its last token
+        assert not backend.take('parent', rate=0.001, burst=2)[0]
+
+    assert in_child(child) == 0
+    assert backend._db() is parent_connection
+    allowed, wait = backend.take('parent', rate=0.001, burst=2)
+    assert not allowed and wait > 0  # the child's takes are in the shared file
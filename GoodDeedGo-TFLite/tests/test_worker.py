@@ -0,0 +1,90 @@
+"""The verification worker outlives submissions that cannot be finalized"""
+import uuid
+from datetime import datetime
+
+import pytest
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+VERDICT = 'recycling'
+
+
+@pytest.fixture
+def claimed(app_context):
+    """Two submissions in 'processing', by a new user for a new challenge each"""
+    from app import db
+    from models import User, Challenge, Submission
+
+    name = f"worker_{uuid.uuid4().hex[:8]}"
+    user = User(username=name, email=f"{name}@gooddeedgo.app")
+    challenges = [Challenge(title=f"Worker {i}", description='Worker test', category='recycling', points=10,
+                            latitude=40.7580, longitude=-73.9855, verification_prompt='Worker test') for i in range(2)]
+    db.session.add_all([user, *challenges])
+    db.session.flush()
+    now = datetime.utcnow()
+    submissions = [Submission(user_id=user.id, challenge_id=challenge.id, image_path='', user_location_lat=40.7580,
+                              user_location_lng=-73.9855, status='processing', claimed_at=now, submitted_at=now)
+                   for challenge in challenges]
+    db.session.add_all(submissions)
+    db.session.commit()
+    return [submission.id for submission in submissions]
+
+
+def job(submission_id):
+    return (submission_id, '', 'recycling', 'test', None, None, None)
+
+
+@pytest.mark.parametrize('failure', [IntegrityError('INSERT', {}, Exception('duplicate')),
+                                     OperationalError('UPDATE', {}, Exception('database is locked'))])
+def test_failed_finalize_does_not_stop_the_loop(claimed, monkeypatch, failure):
+    from app import db
+    from models import Submission
+    import worker
+
+    first, second = claimed
+    finalize = worker._finalize
+    attempts = []
+
+    def flaky(submission_id, verification_result, error):
+        if submission_id == first:
+            attempts.append(submission_id)
+            raise failure
+        return finalize(submission_id, verification_result, error)
+
+    monkeypatch.setattr(worker, '_finalize', flaky)
+    worker.finish_jobs([(job(first), VERDICT), (job(second), VERDICT)])
+
+    assert len(attempts) == (2 if isinstance(failure, IntegrityError) else 1)  # IntegrityError is retried once
+    assert db.session.get(Submission, first).status == 'processing'  # claimed again after CLAIM_TIMEOUT
+    assert db.session.get(Submission, second).status == 'verified'
+    db.session.rollback()
+
+
+def test_failed_claim_does_not_stop_the_loop(app_context, monkeypatch):
+    import worker
+
+    class Derivatives:
+        def poll(self):
+            pass
+
+    def locked(limit):
+        raise OperationalError('UPDATE', {}, Exception('database is locked'))
+
+    monkeypatch.setattr(worker, 'claim_batch', locked)
+    assert worker.claim_jobs(Derivatives()) == []
+
+
+def test_only_exact_copies_of_another_users_photo_are_rejected(app, monkeypatch):
+    from types import SimpleNamespace
+    from verification_cache import VerificationCache
+    import worker
+
+    cache = VerificationCache(db_path=None)
+    cache.put('ns', 'a' * 64, 'ffff0000ffff0000', VERDICT, user_id=1, submission_id=1)
+    monkeypatch.setattr(worker, 'verification_cache', cache)
+
+    def submission(user_id, sha256, phash):
+        return SimpleNamespace(id=2, user_id=user_id, image_sha256=sha256, image_phash=phash)
+
+    assert worker.cached_result(submission(2, 'a' * 64, 'ffff0000ffff0000'), 'ns') == worker.DUPLICATE_PHOTO
+    assert worker.cached_result(submission(2, 'b' * 64, 'fffe0000ffff0001'), 'ns') is None  # the same landmark
+    assert worker.cached_result(submission(1, 'b' * 64, 'fffe0000ffff0001'), 'ns') == VERDICT
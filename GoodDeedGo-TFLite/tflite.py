@@ -1,24 +1,285 @@
-import numpy as np
-from PIL import Image
-import tensorflow as tf
-
-LABELS = ['not_a_deed', 'planting', 'trash_pickup', 'recycling']  
-
-interpreter = tf.lite.Interpreter(model_path="model.tflite")
-interpreter.allocate_tensors()
-
-input_details = interpreter.get_input_details()
-output_details = interpreter.get_output_details()
-
-def verify_challenge_completion(photo_path):
-    # Preprocess image to match your model's input
-    img = Image.open(photo_path).resize((224, 224)).convert("RGB")
-    input_data = np.expand_dims(np.array(img) / 255.0, axis=0).astype(np.float32)
-
-    interpreter.set_tensor(input_details[0]['index'], input_data)
-    interpreter.invoke()
-
-    output_data = interpreter.get_tensor(output_details[0]['index'])
-    predicted_index = int(np.argmax(output_data))
-
-    return LABELS[predicted_index]
+import os
+import queue
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+
+import numpy as np
+
+import backends
+import metrics
+from imaging import load_model_input
+from metrics import timer
+
+# Engine tuning, overridable per deployment (per-model settings live in backends.py)
+POOL_SIZE = int(os.environ.get("TFLITE_POOL_SIZE", 2))
+MAX_BATCH_SIZE = int(os.environ.get("TFLITE_MAX_BATCH_SIZE", 8))
+MAX_LATENCY_MS = float(os.environ.get("TFLITE_MAX_LATENCY_MS", 10))
+REQUEST_TIMEOUT = float(os.environ.get("TFLITE_REQUEST_TIMEOUT", 30))
+
+BATCH_SIZES = metrics.histogram('gooddeedgo_inference_batch_size', 'Photos per interpreter invoke()', metrics.COUNT_BUCKETS)
+
+
+def interpreter_class():
+    """The lightest TFLite interpreter installed: tflite_runtime, then LiteRT, then full TensorFlow"""
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        try:
+            from ai_edge_litert.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+def _interpreter_options(config):
+    options = {'num_threads': config.num_threads}
+    if not config.xnnpack:
+        # XNNPACK is applied by default; this resolver runs the plain builtin kernels instead
+        resolver = getattr(sys.modules[interpreter_class().__module__], 'OpResolverType', None)
+        if resolver is not None:
+            options['experimental_op_resolver_type'] = resolver.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+    return options
+
+
+def _padded_batch_size(n, max_batch_size):
+    """Round n up to a power of two so interpreters only reallocate for a few shapes"""
+    size = 1
+    while size < n:
+        size *= 2
+    return min(size, max_batch_size)
+
+
+class BatchingEngine:
+    """Micro-batching inference over a pool of TFLite interpreters.
+
+    One engine serves one backend. Callers enqueue an input from
+    preprocess() and get a Future for the raw output row back. Each
+    interpreter owns a worker thread that drains the queue into a batch of
+    up to max_batch_size images, waiting at most max_latency_ms after the
+    first image arrives, then resizes its input tensor and runs one invoke()
+    for the whole batch.
+    """
+
+    def __init__(self, config, pool_size=POOL_SIZE, max_batch_size=MAX_BATCH_SIZE,
+                 max_latency_ms=MAX_LATENCY_MS, model_content=None):
+        self.config = config
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_latency = max_latency_ms / 1000.0
+        self.queue = queue.Queue()
+        self.workers = []
+
+        Interpreter = interpreter_class()
+        options = _interpreter_options(config)
+        for i in range(max(1, pool_size)):
+            if model_content is not None:
+                interpreter = Interpreter(model_content=model_content, **options)
+            else:
+                interpreter = Interpreter(model_path=backends.model_path(config), **options)
+            interpreter.allocate_tensors()
+            if i == 0:
+                self.input_details = interpreter.get_input_details()[0]
+                self.output_details = interpreter.get_output_details()[0]
+            worker = threading.Thread(target=self._run, args=(interpreter,), name=f"tflite-{config.name}-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def preprocess(self, photo_path):
+        """Decode an image into one input for this model, quantized if the model expects integers"""
+        with timer('preprocess'):
+            pixels = load_model_input(photo_path, self.config.input_size).astype(np.float32)
+            pixels = pixels * self.config.pixel_scale + self.config.pixel_offset
+            return backends.quantize(pixels, self.input_details['dtype'], self.input_details['quantization'])
+
+    def scores(self, output_row):
+        return backends.dequantize(output_row, self.output_details['quantization'])
+
+    def label(self, output_row):
+        return self.config.labels[int(np.argmax(self.scores(output_row)))]
+
+    def submit(self, input_data):
+        """Queue one preprocessed input and return a Future for its output row"""
+        future = Future()
+        self.queue.put((input_data, future))
+        return future
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def shutdown(self):
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def _collect_batch(self):
+        item = self.queue.get()
+        if item is None:
+            return None
+
+        batch = [item]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Hand the shutdown sentinel back so this worker exits after the batch
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self, interpreter):
+        input_details = interpreter.get_input_details()[0]
+        output_index = interpreter.get_output_details()[0]['index']
+        allocated_size = int(input_details['shape'][0])
+
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                return
+
+            batch = [(data, future) for data, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                batch_size = _padded_batch_size(len(batch), self.max_batch_size)
+                if batch_size != allocated_size:
+                    interpreter.resize_tensor_input(input_details['index'], [batch_size, *input_details['shape'][1:]])
+                    interpreter.allocate_tensors()
+                    allocated_size = batch_size
+
+                input_data = np.zeros((batch_size, *input_details['shape'][1:]), dtype=input_details['dtype'])
+                input_data[:len(batch)] = np.stack([data for data, _ in batch])
+
+                with timer('inference'):
+                    interpreter.set_tensor(input_details['index'], input_data)
+                    interpreter.invoke()
+                    output_data = interpreter.get_tensor(output_index)
+                BATCH_SIZES.observe(len(batch), backend=self.config.name)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for row, (_, future) in zip(output_data, batch):
+                future.set_result(row)
+
+
+_engines = {}
+_engine_lock = threading.Lock()
+_model_content = {}
+
+
+def preload(names=None):
+    """Import the interpreter and read models into memory ahead of a fork.
+
+    Processes forked afterwards share these pages copy-on-write and build
+    their interpreters from the in-memory models. No threads are started
+    here, so forking stays safe. Defaults to every backend the current
+    category routing can pick.
+    """
+    interpreter_class()
+    for name in names or backends.routed_backends():
+        if name not in _model_content:
+            with open(backends.model_path(backends.get_config(name)), 'rb') as model_file:
+                _model_content[name] = model_file.read()
+    return _model_content
+
+
+def loaded_backends():
+    """Backends with an engine running in this process"""
+    return sorted(_engines)
+
+
+def queue_depth():
+    """Inputs waiting for an interpreter across this process's engines"""
+    return sum(engine.queue_depth() for engine in list(_engines.values()))
+
+
+metrics.gauge('gooddeedgo_inference_queue_depth', 'Inputs waiting for a TFLite interpreter', callback=queue_depth)
+
+
+def get_engine(name=None):
+    """The process's batching engine for a backend, created on first use"""
+    name = name or backends.backend_for()
+    engine = _engines.get(name)
+    if engine is None:
+        with _engine_lock:
+            engine = _engines.get(name)
+            if engine is None:
+                engine = BatchingEngine(backends.get_config(name), model_content=_model_content.get(name))
+                _engines[name] = engine
+    return engine
+
+
+def verify_challenge_completion(photo_path, category=None):
+    engine = get_engine(backends.backend_for(category))
+    # Preprocess in the caller's thread so decoding runs in parallel with inference
+    input_data = engine.preprocess(photo_path)
+    output_data = engine.submit(input_data).result(timeout=REQUEST_TIMEOUT)
+
+    return engine.label(output_data)
+
+
+def _submit(engine, photo_paths):
+    futures = []
+    for photo_path in photo_paths:
+        try:
+            futures.append(engine.submit(engine.preprocess(photo_path)))
+        except Exception as e:
+            futures.append(e)
+    return futures
+
+
+def _collect(engine, futures):
+    results = []
+    for future in futures:
+        if isinstance(future, Exception):
+            results.append(future)
+            continue
+        try:
+            output_data = future.result(timeout=REQUEST_TIMEOUT)
+            results.append((engine.label(output_data), engine.scores(output_data)))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def predict(photo_paths, name=None):
+    """(label, scores) per path from one backend, or the exception raised for that photo"""
+    engine = get_engine(name)
+    return _collect(engine, _submit(engine, photo_paths))
+
+
+def verify_many(photo_paths, categories=None):
+    """Verify several photos concurrently so they share engine batches.
+
+    Each photo goes to its category's backend. Returns one label per path,
+    or the exception raised for that photo.
+    """
+    categories = categories or [None] * len(photo_paths)
+    by_backend = defaultdict(list)
+    for position, category in enumerate(categories):
+        by_backend[backends.backend_for(category)].append(position)
+
+    # Queue every backend's photos before waiting, so the engines run side by side
+    pending = []
+    for name, positions in by_backend.items():
+        engine = get_engine(name)
+        pending.append((engine, positions, _submit(engine, [photo_paths[i] for i in positions])))
+
+    results = [None] * len(photo_paths)
+    for engine, positions, futures in pending:
+        for position, result in zip(positions, _collect(engine, futures)):
+            results[position] = result if isinstance(result, Exception) else result[0]
+    return results
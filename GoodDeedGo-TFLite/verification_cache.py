@@ -0,0 +1,154 @@
+"""Cache of verification results keyed by image fingerprint.
+
+Entries are scoped by a namespace (the model version, or for Gemini the
+model plus the challenge prompt) and keyed by the upload's SHA-256. A miss
+on the exact hash falls back to the perceptual hash: a stored image whose
+pHash is within PHASH_MAX_DISTANCE bits counts as the same photo. To avoid
+comparing against every entry, each pHash is split into four 16-bit bands;
+two hashes at most 3 bits apart must agree on at least one band, so only
+entries sharing a band are compared. A larger VERIFICATION_CACHE_PHASH_DISTANCE
+would miss matches that share no band, so it is lowered to 3.
+
+The in-memory tier is an LRU. An optional SQLite file adds a persistent
+tier shared by every worker process on the host.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+CACHE_SIZE = int(os.environ.get("VERIFICATION_CACHE_SIZE", 10000))
+CACHE_DB = os.environ.get("VERIFICATION_CACHE_DB")  # e.g. instance/verification_cache.db
+PHASH_MAX_DISTANCE = int(os.environ.get("VERIFICATION_CACHE_PHASH_DISTANCE", 3))
+
+BANDS = 4
+
+CachedVerification = namedtuple('CachedVerification', ['result', 'user_id', 'submission_id', 'exact'])
+
+
+def _bands(phash):
+    return [phash[i * 4:(i + 1) * 4] for i in range(BANDS)]
+
+
+def hamming_distance(phash_a, phash_b):
+    return bin(int(phash_a, 16) ^ int(phash_b, 16)).count('1')
+
+
+class VerificationCache:
+    def __init__(self, capacity=CACHE_SIZE, db_path=CACHE_DB, max_distance=PHASH_MAX_DISTANCE):
+        if max_distance > BANDS - 1:
+            logging.warning(f"pHash distance {max_distance} is beyond what {BANDS} bands can find, using {BANDS - 1}")
+            max_distance = BANDS - 1
+        self.capacity = capacity
+        self.max_distance = max_distance
+        self._entries = OrderedDict()  # (namespace, sha256) -> (phash, result, user_id, submission_id)
+        self._band_index = {}  # (namespace, band number, band) -> {sha256}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS verification_cache (
+                    namespace TEXT NOT NULL, sha256 TEXT NOT NULL, phash TEXT,
+                    band0 TEXT, band1 TEXT, band2 TEXT, band3 TEXT,
+                    result TEXT NOT NULL, user_id INTEGER, submission_id INTEGER, created_at REAL,
+                    PRIMARY KEY (namespace, sha256)
+                )""")
+            for band in range(BANDS):
+                self._db.execute(f"CREATE INDEX IF NOT EXISTS ix_verification_cache_band{band} "
+                                 f"ON verification_cache (namespace, band{band})")
+
+    def get(self, namespace, sha256, phash=None):
+        """CachedVerification for this image, or None"""
+        with self._lock:
+            hit = self._get_memory(namespace, sha256, phash)
+        if hit is None and self._db is not None:
+            hit = self._get_disk(namespace, sha256, phash)
+        if hit is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return hit
+
+    def put(self, namespace, sha256, phash, result, user_id=None, submission_id=None):
+        with self._lock:
+            self._put_memory(namespace, sha256, phash, result, user_id, submission_id)
+        if self._db is not None:
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO verification_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (namespace, sha256, phash, *(_bands(phash) if phash else [None] * BANDS),
+                     result, user_id, submission_id, time.time()))
+            except sqlite3.Error as e:
+                logging.warning(f"Verification cache write failed: {e}")
+
+    def _get_memory(self, namespace, sha256, phash):
+        entry = self._entries.get((namespace, sha256))
+        if entry is not None:
+            self._entries.move_to_end((namespace, sha256))
+            return CachedVerification(entry[1], entry[2], entry[3], True)
+        if not phash:
+            return None
+
+        candidates = set()
+        for band_number, band in enumerate(_bands(phash)):
+            candidates |= self._band_index.get((namespace, band_number, band), set())
+        for candidate in candidates:
+            entry = self._entries[(namespace, candidate)]
+            if hamming_distance(phash, entry[0]) <= self.max_distance:
+                self._entries.move_to_end((namespace, candidate))
+                return CachedVerification(entry[1], entry[2], entry[3], False)
+        return None
+
+    def _put_memory(self, namespace, sha256, phash, result, user_id, submission_id):
+        key = (namespace, sha256)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        elif phash:
+            for band_number, band in enumerate(_bands(phash)):
+                self._band_index.setdefault((namespace, band_number, band), set()).add(sha256)
+        self._entries[key] = (phash, result, user_id, submission_id)
+
+        while len(self._entries) > self.capacity:
+            (old_namespace, old_sha256), (old_phash, *_) = self._entries.popitem(last=False)
+            if old_phash:
+                for band_number, band in enumerate(_bands(old_phash)):
+                    bucket = self._band_index.get((old_namespace, band_number, band))
+                    if bucket is not None:
+                        bucket.discard(old_sha256)
+                        if not bucket:
+                            del self._band_index[(old_namespace, band_number, band)]
+
+    def _get_disk(self, namespace, sha256, phash):
+        try:
+            row = self._db.execute(
+                "SELECT phash, result, user_id, submission_id FROM verification_cache WHERE namespace = ? AND sha256 = ?",
+                (namespace, sha256)).fetchone()
+            exact = row is not None
+            if row is None and phash:
+                band_filter = " OR ".join(f"band{band} = ?" for band in range(BANDS))
+                for candidate in self._db.execute(
+                        f"SELECT phash, result, user_id, submission_id, sha256 FROM verification_cache "
+                        f"WHERE namespace = ? AND ({band_filter})", (namespace, *_bands(phash))):
+                    if candidate[0] and hamming_distance(phash, candidate[0]) <= self.max_distance:
+                        row = candidate
+                        sha256 = candidate[4]
+                        break
+        except sqlite3.Error as e:
+            logging.warning(f"Verification cache read failed: {e}")
+            return None
+        if row is None:
+            return None
+
+        with self._lock:
+            self._put_memory(namespace, sha256, row[0], row[1], row[2], row[3])
+        return CachedVerification(row[1], row[2], row[3], exact)
+
+
+verification_cache = VerificationCache()
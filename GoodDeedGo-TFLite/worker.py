@@ -0,0 +1,374 @@
+"""Background verification worker.
+
+Pending submissions are the job queue: the upload endpoint stores a
+Submission with status='pending' and returns straight away, and this worker
+claims pending rows, runs TFLite verification in a process pool and applies
+the verified/rejected transition, points and achievements.
+
+Run alongside the web server with `python worker.py`. Several workers can
+run at once; claiming a row is a conditional UPDATE so each submission is
+only processed by one of them.
+"""
+import hashlib
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import User, Challenge, Submission, UserCategoryStat
+from ranking import rank_service
+from leaderboard import leaderboard_service
+from verification_cache import verification_cache
+import achievements
+import analytics
+import storage
+from metrics import timer
+import backends
+import metrics
+import tflite
+
+POLL_INTERVAL = float(os.environ.get("WORKER_POLL_INTERVAL", 1.0))
+BATCH_SIZE = int(os.environ.get("WORKER_BATCH_SIZE", 16))
+PROCESSES = int(os.environ.get("WORKER_PROCESSES", 2))
+# Submissions stuck in 'processing' longer than this (e.g. a worker crashed) are picked up again
+CLAIM_TIMEOUT = timedelta(seconds=int(os.environ.get("WORKER_CLAIM_TIMEOUT", 300)))
+# Load the model once here and fork the pool from it, instead of spawning fresh interpreters
+PRELOAD_MODEL = os.environ.get("WORKER_PRELOAD_MODEL", "0") == "1"
+METRICS_PORT = int(os.environ.get("WORKER_METRICS_PORT", 0))  # serve /metrics from the worker when set
+# Dormant zero-point users (visitors who submitted once and never scored) are pruned this often; 0 disables
+PRUNE_INTERVAL = float(os.environ.get("WORKER_PRUNE_INTERVAL", 6 * 3600))
+USER_IDLE_DAYS = int(os.environ.get("USER_IDLE_DAYS", 30))
+# Released and unreferenced photos are removed from the image store this often; 0 disables
+GC_INTERVAL = float(os.environ.get("WORKER_GC_INTERVAL", 3600))
+# Newly settled submissions are added to the analytics rollups this often; 0 disables
+ROLLUP_INTERVAL = float(os.environ.get("WORKER_ROLLUP_INTERVAL", 300))
+
+# Verdict for a photo another user already submitted; always a rejection
+DUPLICATE_PHOTO = "Duplicate of a photo submitted by another user"
+
+VERIFICATIONS = metrics.counter('gooddeedgo_verifications_total', 'Finalized submissions by outcome')
+
+
+def _claimable():
+    stale = datetime.utcnow() - CLAIM_TIMEOUT
+    return or_(
+        Submission.status == 'pending',
+        and_(Submission.status == 'processing', Submission.claimed_at < stale)
+    )
+
+
+def claim_queries():
+    """Pending submissions, then ones stuck in 'processing', oldest first"""
+    # Two queries rather than one OR: each is a search on the status index, which already
+    # yields ids in order, so an empty queue never costs a table scan
+    stale = datetime.utcnow() - CLAIM_TIMEOUT
+    return [
+        db.session.query(Submission.id).filter(Submission.status == 'pending').order_by(Submission.id),
+        db.session.query(Submission.id).filter(Submission.status == 'processing', Submission.claimed_at < stale).order_by(Submission.id),
+    ]
+
+
+def claim_batch(limit=BATCH_SIZE):
+    """Move up to limit pending submissions to 'processing' and return them"""
+    candidate_ids = []
+    for query in claim_queries():
+        if len(candidate_ids) < limit:
+            candidate_ids += [row.id for row in query.limit(limit - len(candidate_ids))]
+
+    claimed_ids = []
+    for submission_id in candidate_ids:
+        # Conditional update: only one worker can win the pending -> processing transition
+        updated = Submission.query.filter(Submission.id == submission_id, _claimable()).update(
+            {'status': 'processing', 'claimed_at': datetime.utcnow()}, synchronize_session=False)
+        if updated:
+            claimed_ids.append(submission_id)
+    db.session.commit()
+
+    if not claimed_ids:
+        return []
+    return Submission.query.filter(Submission.id.in_(claimed_ids)).order_by(Submission.id).all()
+
+
+_namespaces = {}
+
+
+def cache_namespace(category=None):
+    """Verification cache namespace: cached labels are only valid for the model that produced them"""
+    name = backends.backend_for(category)
+    if name not in _namespaces:
+        version = os.environ.get("TFLITE_MODEL_VERSION")
+        if not version:
+            with open(backends.model_path(backends.get_config(name)), 'rb') as model_file:
+                version = hashlib.sha256(model_file.read()).hexdigest()[:12]
+        _namespaces[name] = f"tflite:{name}:{version}"
+    return _namespaces[name]
+
+
+def cached_result(submission, namespace):
+    """Label from the verification cache for this photo, DUPLICATE_PHOTO, or None to run the model.
+
+    Only the submitter's own earlier verdicts are reused. Another user's photo with the same
+    SHA-256 is rejected as DUPLICATE_PHOTO; one that only looks alike (a pHash match, such as
+    the same landmark) is verified like any new photo.
+    """
+    if not submission.image_sha256:
+        return None
+    cached = verification_cache.get(namespace, submission.image_sha256, submission.image_phash)
+    if cached is None or cached.user_id is None:
+        return None
+    if cached.user_id != submission.user_id:
+        if not cached.exact:
+            return None
+        logging.warning(f"Submission {submission.id} reuses a photo from user {cached.user_id} "
+                        f"(submission {cached.submission_id}), rejecting it")
+        return DUPLICATE_PHOTO
+    return cached.result
+
+
+def is_verified(verification_result):
+    return verification_result not in ("not_a_deed", DUPLICATE_PHOTO)
+
+
+def finalize_submission(submission_id, verification_result=None, error=None):
+    """Apply the verified/rejected transition for a processed submission"""
+    try:
+        return _finalize(submission_id, verification_result, error)
+    except IntegrityError:
+        # Another worker verified the same challenge for this user, awarded one of the same
+        # achievements or opened the same category counter first; start again on top of their rows
+        db.session.rollback()
+        return _finalize(submission_id, verification_result, error)
+
+
+def finalize_or_skip(submission_id, verification_result=None, error=None):
+    """finalize_submission for the worker loop, which must outlive any one submission.
+
+    A submission that cannot be finalized (a second IntegrityError, a locked database)
+    is logged and stays 'processing' until it is claimed again after CLAIM_TIMEOUT.
+    """
+    try:
+        return finalize_submission(submission_id, verification_result, error)
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Finalizing submission {submission_id} failed, leaving it to be claimed again: {e}")
+        return None
+
+
+def claim_or_skip(limit=BATCH_SIZE):
+    """claim_batch for the worker loop: nothing claimed this round if the database refuses"""
+    try:
+        return claim_batch(limit)
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Claiming submissions failed: {e}")
+        return []
+
+
+def _finalize(submission_id, verification_result, error):
+    submission = Submission.query.get(submission_id)
+    if submission is None or submission.status != 'processing':
+        return None
+
+    user = submission.user
+    challenge = submission.challenge
+    already_completed = Submission.query.filter_by(user_id=user.id, challenge_id=challenge.id, status='verified').first()
+
+    if error is not None:
+        logging.error(f"Verification failed for submission {submission.id}: {error}")
+        outcome = {'status': 'rejected', 'ai_verification_result': f"Verification failed: {error}"}
+    elif is_verified(verification_result) and already_completed is None:
+        outcome = {'status': 'verified', 'ai_verification_result': verification_result,
+                   'points_awarded': challenge.points, 'verified_at': datetime.utcnow()}
+    else:
+        outcome = {'status': 'rejected', 'ai_verification_result': verification_result}
+
+    # Conditional: a submission re-claimed after CLAIM_TIMEOUT is still only finalized once.
+    # A second verified completion of the challenge fails here on uq_submission_verified_user_challenge.
+    if not Submission.query.filter_by(id=submission.id, status='processing').update(outcome, synchronize_session=False):
+        db.session.rollback()
+        return None
+    if outcome['status'] == 'verified':
+        Challenge.record_completion(challenge.id)
+        UserCategoryStat.record_completion(user.id, challenge.category)
+        User.award_points(user.id, challenge.points)
+        db.session.expire(user)  # the rules below read the new total
+        with timer('achievements'):
+            achievements.award(user)
+
+    with timer('db_commit'):
+        db.session.commit()
+    VERIFICATIONS.inc(outcome='error' if error is not None else outcome['status'])
+    if outcome['status'] == 'verified':
+        rank_service.record(user.id, user.total_points, user.username, user.level)
+        leaderboard_service.record_award(user.id, challenge.category, challenge.points)
+    return submission
+
+
+def _verify_many(photo_paths, categories):
+    # Runs inside a pool process; the chunk shares that process's batching engines.
+    # Timings recorded here are handed back so the parent process can export them.
+    metrics.collect_for_parent()
+    results = tflite.verify_many(photo_paths, categories)
+    return results, metrics.drain(), os.getpid(), tflite.queue_depth()
+
+
+_child_queue_depths = {}
+
+
+_pruned_at = None
+
+
+def prune_dormant_users():
+    """Delete dormant zero-point users, at most once every PRUNE_INTERVAL seconds"""
+    global _pruned_at
+    if not PRUNE_INTERVAL or (_pruned_at is not None and time.monotonic() - _pruned_at < PRUNE_INTERVAL):
+        return
+    _pruned_at = time.monotonic()
+    try:
+        removed = User.prune_dormant(USER_IDLE_DAYS)
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Pruning dormant users failed: {e}")
+        return
+    if removed:
+        logging.info(f"Pruned {removed} dormant user(s)")
+
+
+_collected_at = None
+
+
+def collect_image_garbage():
+    """Run the image store's garbage collector, at most once every GC_INTERVAL seconds"""
+    global _collected_at
+    if not GC_INTERVAL or (_collected_at is not None and time.monotonic() - _collected_at < GC_INTERVAL):
+        return
+    _collected_at = time.monotonic()
+    try:
+        released, deleted = storage.collect_garbage()
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Image garbage collection failed: {e}")
+        return
+    if released or deleted:
+        logging.info(f"Released {released} rejected submission photo(s), deleted {deleted} unreferenced photo(s)")
+
+
+_rolled_up_at = None
+
+
+def update_analytics():
+    """Bring the analytics rollups up to date, at most once every ROLLUP_INTERVAL seconds"""
+    global _rolled_up_at
+    if not ROLLUP_INTERVAL or (_rolled_up_at is not None and time.monotonic() - _rolled_up_at < ROLLUP_INTERVAL):
+        return
+    _rolled_up_at = time.monotonic()
+    try:
+        analytics.update_rollups()
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Analytics rollup failed: {e}")
+
+
+def _pending_submissions():
+    with app.app_context():
+        return Submission.queue_depth()
+
+
+def start_metrics():
+    """Count SQL statements and export the worker's metrics on WORKER_METRICS_PORT"""
+    metrics.instrument_engine()
+    metrics.gauge('gooddeedgo_verification_queue_depth', 'Submissions waiting for verification', callback=_pending_submissions)
+    # Engines live in the pool processes, which report their queue depth with each chunk
+    metrics.gauge('gooddeedgo_inference_queue_depth', 'Inputs waiting for a TFLite interpreter',
+                  callback=lambda: sum(_child_queue_depths.values()))
+    metrics.gauge('gooddeedgo_verification_cache_hits', 'Verification cache hits', callback=lambda: verification_cache.hits)
+    metrics.gauge('gooddeedgo_verification_cache_misses', 'Verification cache misses', callback=lambda: verification_cache.misses)
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+
+
+def _forget_parent_connections():
+    # A forked child inherits the parent's pooled connections; drop them without closing the parent's sockets
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def claim_jobs(derivatives, limit=BATCH_SIZE):
+    """Housekeeping, then claim up to limit submissions; returns the ones the model still has to label"""
+    with app.app_context():
+        prune_dormant_users()
+        collect_image_garbage()
+        update_analytics()
+        derivatives.poll()
+        jobs = []
+        for submission in claim_or_skip(limit):
+            category = submission.challenge.category
+            namespace = cache_namespace(category)
+            result = cached_result(submission, namespace)
+            if result is not None:
+                finalize_or_skip(submission.id, verification_result=result)
+                continue
+            jobs.append((submission.id, storage.image_store.local_path(submission.image_path), category, namespace,
+                         submission.image_sha256, submission.image_phash, submission.user_id))
+        return jobs
+
+
+def finish_jobs(finished):
+    """Cache and finalize (job, label or exception) pairs"""
+    with app.app_context():
+        for (submission_id, _, _, namespace, sha256, phash, user_id), result in finished:
+            if isinstance(result, Exception):
+                finalize_or_skip(submission_id, error=result)
+                continue
+            if sha256:
+                verification_cache.put(namespace, sha256, phash, result, user_id, submission_id)
+            finalize_or_skip(submission_id, verification_result=result)
+
+
+def run_worker():
+    if PRELOAD_MODEL:
+        # Only the model bytes and interpreter module are loaded here; engines (and their
+        # threads) are created lazily inside each child
+        tflite.preload()
+        context, initializer = multiprocessing.get_context('fork'), _forget_parent_connections
+    else:
+        # spawn, not fork: each child imports and loads the model for itself
+        context, initializer = multiprocessing.get_context('spawn'), None
+    with ProcessPoolExecutor(max_workers=PROCESSES, mp_context=context, initializer=initializer) as pool:
+        if PRELOAD_MODEL:
+            # A fork pool starts all of its processes on the first submit. Do that while this
+            # process has no other thread yet: a child forked beside the metrics server or the
+            # derivative threads could inherit a lock one of them held, and deadlock on it.
+            pool.submit(os.getpid).result()
+        start_metrics()
+        derivatives = storage.DerivativeWorker()
+        logging.info(f"Verification worker started with {PROCESSES} processes")
+        while True:
+            to_verify = claim_jobs(derivatives)
+            chunks = [to_verify[i::PROCESSES] for i in range(PROCESSES)]
+            jobs = {pool.submit(_verify_many, [job[1] for job in chunk], [job[2] for job in chunk]): chunk
+                    for chunk in chunks if chunk}
+            if not jobs:
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            for future in as_completed(jobs):
+                chunk = jobs[future]
+                try:
+                    results, observations, pid, queue_depth = future.result()
+                    metrics.replay(observations)
+                    _child_queue_depths[pid] = queue_depth
+                except Exception as e:
+                    results = [e] * len(chunk)
+
+                finish_jobs(zip(chunk, results))
+
+
+if __name__ == "__main__":
+    run_worker()